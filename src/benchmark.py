@@ -0,0 +1,249 @@
+# ====================================================================
+# End to end benchmarks on synthetic tiny-webs (see synthweb.py)
+#
+# Cases
+#   links        - getLinksFromSoup (parse + filter) and getLinksFromHTML on a sample of pages
+#   termfreq     - generateTermFreqFromPage on a sample of pages
+#   crawl        - webpageBFS over the tiny-web, served from disk instead of the network (pages/s)
+#   index        - updateWebIndex over every page into a new link graph
+#   eigenranking - determineEigenRankings on that graph
+#   query        - Term frequencies, inverted index, then latency of sampled queries
+#
+# Results are written as json, one file per run, so runs can be diffed for regressions,
+# along with the stage metrics (see metrics.py) collected while each size ran
+#   python benchmark.py -n 10000 100000 -o bench/results.json
+#
+import os
+import sys
+import shutil
+import argparse
+import platform
+import subprocess
+import numpy as np
+from contextlib import redirect_stdout
+from json import dumps as json_dumps
+from multiprocessing import cpu_count
+from time import time, perf_counter
+
+from bs4 import BeautifulSoup
+from htmlparse import getLinksFromSoup, getLinksFromHTML, getURLAndHostFromFileName, readLocalPage
+from linkgraph import LinkGraph
+from index import updateWebIndex
+from eigenranking import determineEigenRankings
+from synthweb import generateTinyWeb
+from fetcher import FetchResult
+from spider import webpageBFS
+from metrics import setPageLogging, drainMetrics
+from manifest import setGenerationPath
+
+CASES = ("links", "termfreq", "crawl", "index", "eigenranking", "query")
+
+def timings(seconds: list):
+    """
+        Summary of a list of timings, in seconds.
+    """
+    seconds = np.asarray(seconds, dtype=np.float64)
+    return {
+        "n": int(len(seconds)),
+        "total": float(seconds.sum()),
+        "mean": float(seconds.mean()),
+        "min": float(seconds.min()),
+        "p50": float(np.percentile(seconds, 50)),
+        "p95": float(np.percentile(seconds, 95)),
+        "p99": float(np.percentile(seconds, 99)),
+    }
+
+def timeCall(f, *args, **kwargs):
+    """
+        Returns (seconds, result) of one call, with its prints thrown away
+        (per page prints are turned off entirely, see runBenchmarks).
+    """
+    with open(os.devnull, mode='w') as devnull, redirect_stdout(devnull):
+        t0 = perf_counter()
+        result = f(*args, **kwargs)
+        return perf_counter() - t0, result
+
+def samplePages(htmlPages: list, numSamples: int, seed: int):
+    rng = np.random.default_rng(seed)
+    return [htmlPages[i] for i in rng.choice(len(htmlPages), size=min(numSamples, len(htmlPages)), replace=False)]
+
+## ===== ##
+## Cases ##
+## ===== ##
+
+def benchLinks(webDir: str, htmlPages: list, numSamples=200, seed=0):
+    soupTimes = []
+    streamTimes = []
+    for htmlPage in samplePages(htmlPages, numSamples, seed):
+        _, host = getURLAndHostFromFileName(htmlPage[:-5])
+        html = readLocalPage(f"{webDir}/{htmlPage}")
+        soupTimes.append(timeCall(lambda: getLinksFromSoup(BeautifulSoup(html, 'html.parser'), host))[0])
+        streamTimes.append(timeCall(getLinksFromHTML, html, host)[0])
+    return {"getLinksFromSoup": timings(soupTimes), "getLinksFromHTML": timings(streamTimes)}
+
+def benchTermFreq(webDir: str, htmlPages: list, numSamples=200, seed=0):
+    from nlp import generateTermFreqFromPage
+
+    results = {}
+    for parser in ("stream", "html.parser"):
+        pageTimes = []
+        for htmlPage in samplePages(htmlPages, numSamples, seed):
+            url, host = getURLAndHostFromFileName(htmlPage[:-5])
+            pageTimes.append(timeCall(generateTermFreqFromPage, f"{webDir}/{htmlPage}", url, host, parser)[0])
+        results[parser] = timings(pageTimes)
+    return results
+
+class LocalWebFetcher:
+    """
+        Serves the pages of a tiny-web from disk, so a crawl is timed without the network or rate limits.
+    """
+
+    def __init__(self, webDir: str, htmlPages: list):
+        self.webDir = webDir
+        self.fileNames = {getURLAndHostFromFileName(htmlPage[:-5])[0]: htmlPage for htmlPage in htmlPages}
+
+    def fetch(self, url: str, revalidate=False):
+        htmlPage = self.fileNames.get(url)
+        if htmlPage is None:
+            return FetchResult(404, None, url)
+        return FetchResult(200, readLocalPage(f"{self.webDir}/{htmlPage}").encode('utf-8'), url)
+
+    def close(self):
+        pass
+
+def benchCrawl(webDir: str, htmlPages: list, crawlDir: str, numWorkers=4):
+    if os.path.exists(crawlDir): shutil.rmtree(crawlDir)
+
+    # One seed per host, the tiny-web's hosts don't link to each other
+    seeds = {}
+    for htmlPage in htmlPages:
+        url, host = getURLAndHostFromFileName(htmlPage[:-5])
+        seeds.setdefault(host, url)
+    rates = {host: 1e9 for host in seeds.keys()}
+    seconds, numCrawled = timeCall(webpageBFS, [(url, host) for host, url in seeds.items()], crawlDir, numWorkers, rates,
+                                   maxQueue=2 * len(htmlPages), fetcher=LocalWebFetcher(webDir, htmlPages))
+    return {"seconds": seconds, "numPages": numCrawled, "pagesPerSecond": numCrawled / seconds}
+
+def benchIndex(webDir: str, htmlPages: list, graphDir: str):
+    if os.path.exists(graphDir): shutil.rmtree(graphDir)
+    graph = LinkGraph(graphDir)
+    seconds, _ = timeCall(updateWebIndex, htmlPages, graph, webDir)
+    return {"seconds": seconds, "pagesPerSecond": len(htmlPages) / seconds, "numLinks": graph.numLinks + graph.numExtra}
+
+def benchEigenRanking(graphDir: str, solvers=("power", "extrapolated")):
+    results = {}
+    for solver in solvers:
+        seconds, ranks = timeCall(determineEigenRankings, graphDir, solver=solver)
+        results[solver] = {"seconds": seconds, "numPages": len(ranks)}
+    return results
+
+def benchQuery(webDir: str, htmlPages: list, workDir: str, numQueries=1000, seed=0):
+    from nlp import updateTermFreqCache
+    from tfstore import TermFreqStore
+    from invertedindex import buildInvertedIndexFromStore
+    from search import SearchEngine
+
+    results = {}
+    storeDir = f"{workDir}/tfstore"
+    invertedDir = f"{workDir}/inverted"
+    for dirPath in (storeDir, invertedDir):
+        if os.path.exists(dirPath): shutil.rmtree(dirPath)
+
+    store = TermFreqStore(storeDir)
+    seconds, _ = timeCall(updateTermFreqCache, htmlPages, webDir, None, "stream", cpu_count(), store=store)
+    results["termFreqCache"] = {"seconds": seconds, "pagesPerSecond": len(htmlPages) / seconds}
+
+    seconds, _ = timeCall(buildInvertedIndexFromStore, storeDir, invertedDir)
+    results["invertedIndex"] = {"seconds": seconds}
+
+    seconds, engine = timeCall(SearchEngine, invertedDir)
+    results["loadEngine"] = {"seconds": seconds}
+
+    # Queries of 1 to 3 terms, drawn by how many docs each term is in, like real queries lean on common words
+    rng = np.random.default_rng(seed)
+    terms = list(engine.index.lexicon.keys())
+    docFreqs = np.fromiter((engine.index.lexicon[term][0] for term in terms), dtype=np.float64, count=len(terms))
+    termP = docFreqs / docFreqs.sum()
+    queries = [" ".join(terms[i] for i in rng.choice(len(terms), size=rng.integers(1, 4), p=termP)) for _ in range(numQueries)]
+
+    queryTimes = [timeCall(engine.search, query)[0] for query in queries]
+    results["search"] = timings(queryTimes)
+    return results
+
+## ====== ##
+## Runner ##
+## ====== ##
+
+def _gitRevision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def runBenchmarks(sizes: list, workDir: str, cases=CASES, seed=0, numSamples=200, numQueries=1000):
+    """
+        Runs the benchmark cases on a synthetic tiny-web of each size.
+        Returns the results as a json-able dict.
+    """
+
+    run = {
+        "timestamp": time(),
+        "git": _gitRevision(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpus": cpu_count(),
+        "seed": seed,
+        "sizes": {},
+    }
+
+    setPageLogging(False)
+    setGenerationPath(None)     # Leave the real index's generation alone
+    for numPages in sizes:
+        sizeDir = f"{workDir}/{numPages}"
+        webDir = f"{sizeDir}/tinyweb"
+        graphDir = f"{sizeDir}/graph"
+
+        print(f"[Bench] {numPages} pages: generating...")
+        seconds, htmlPages = timeCall(generateTinyWeb, webDir, numPages, seed=seed)
+        results = {"generate": {"seconds": seconds}}
+        drainMetrics()
+
+        for case in cases:
+            print(f"[Bench] {numPages} pages: {case}...")
+            if case == "links":
+                results[case] = benchLinks(webDir, htmlPages, numSamples, seed)
+            elif case == "termfreq":
+                results[case] = benchTermFreq(webDir, htmlPages, numSamples, seed)
+            elif case == "crawl":
+                results[case] = benchCrawl(webDir, htmlPages, f"{sizeDir}/crawl")
+            elif case == "index":
+                results[case] = benchIndex(webDir, htmlPages, graphDir)
+            elif case == "eigenranking":
+                if not os.path.exists(graphDir): benchIndex(webDir, htmlPages, graphDir)
+                results[case] = benchEigenRanking(graphDir)
+            elif case == "query":
+                results[case] = benchQuery(webDir, htmlPages, sizeDir, numQueries, seed)
+
+        results["metrics"] = drainMetrics()
+        run["sizes"][str(numPages)] = results
+
+    return run
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--sizes", help="Numbers of pages to benchmark at", type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument("-d", "--workDir", help="Directory for the generated webs and indexes (reused between runs)", type=str, default="bench/")
+    parser.add_argument("-c", "--cases", help="Cases to run", type=str, nargs='+', choices=CASES, default=list(CASES))
+    parser.add_argument("-s", "--seed", help="Random seed for the webs and samples", type=int, default=0)
+    parser.add_argument("--samples", help="Pages sampled by the per page cases", type=int, default=200)
+    parser.add_argument("--queries", help="Queries timed by the query case", type=int, default=1000)
+    parser.add_argument("-o", "--output", help="Json file to write the results to", type=str, default=None)
+    args = parser.parse_args()
+
+    run = runBenchmarks(args.sizes, args.workDir, args.cases, args.seed, args.samples, args.queries)
+
+    output = args.output or f"{args.workDir}/results-{int(run['timestamp'])}.json"
+    with open(output, mode='w') as fp:
+        fp.write(json_dumps(run, indent=2))
+    print(f"[Bench] Results written to \"{output}\".")
@@ -0,0 +1,255 @@
+# ====================================================================
+# Finds duplicate pages in the tiny-web (mirrors, redirects, slug variants)
+#
+#   Exact duplicates - SHA-1 of the page bytes, checked by the spider as it downloads
+#                      (and never requested again on later crawls)
+#   Near duplicates  - 64 bit SimHash of each page's term frequencies
+#                      (see nlp.generateTermFreqFromPage), pages a few bits apart are clustered
+#
+# Every duplicate maps to a canonical url, kept in a SQLite file (index/dedup.db)
+#   hashes(hash PRIMARY KEY, url)     - First url seen with each content hash
+#   canonical(url PRIMARY KEY, canonical)
+#
+# The indexer skips duplicate pages and points links at the canonical url,
+# eigenranking merges the duplicates into their canonical page
+#
+import os
+import argparse
+import sqlite3
+import numpy as np
+from hashlib import sha1, blake2b
+from threading import Lock
+from json import loads as json_loads
+
+from tfstore import TermFreqStore, FIELDS
+
+SIMHASH_BITS = 64
+
+## ========= ##
+## Canonical ##
+## ========= ##
+
+class DedupStore:
+    """
+        Persistent content hashes and duplicate -> canonical url mappings.
+        Safe to share between the spider's worker threads.
+    """
+
+    def __init__(self, dbPath: str):
+        self.lock = Lock()
+        self.db = sqlite3.connect(dbPath, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS hashes (hash TEXT PRIMARY KEY, url TEXT NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS canonical (url TEXT PRIMARY KEY, canonical TEXT NOT NULL)")
+        self.db.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM canonical").fetchone()[0]
+
+    def _resolve(self, url: str):
+        seen = {url}
+        while True:
+            row = self.db.execute("SELECT canonical FROM canonical WHERE url = ?", (url,)).fetchone()
+            if row is None or row[0] in seen:
+                return url
+            url = row[0]
+            seen.add(url)
+
+    def _setCanonical(self, url: str, canonical: str):
+        canonical = self._resolve(canonical)
+        if canonical != url:
+            self.db.execute("INSERT OR REPLACE INTO canonical (url, canonical) VALUES (?, ?)", (url, canonical))
+
+    def checkContent(self, url: str, content: bytes):
+        """
+            Records the hash of a page's bytes.
+            Returns the canonical url if another url already had the same bytes, None otherwise.
+        """
+        digest = sha1(content).hexdigest()
+        with self.lock:
+            self.db.execute("INSERT OR IGNORE INTO hashes (hash, url) VALUES (?, ?)", (digest, url))
+            firstURL = self.db.execute("SELECT url FROM hashes WHERE hash = ?", (digest,)).fetchone()[0]
+            if firstURL != url:
+                self._setCanonical(url, firstURL)
+            self.db.commit()
+            return self._resolve(url) if firstURL != url else None
+
+    def getCanonical(self, url: str):
+        """
+            Returns the canonical url of a known duplicate, None if url isn't one.
+        """
+        with self.lock:
+            canonical = self._resolve(url)
+        return canonical if canonical != url else None
+
+    def setCanonical(self, url: str, canonical: str):
+        with self.lock:
+            self._setCanonical(url, canonical)
+            self.db.commit()
+
+    def getCanonicalMap(self):
+        """
+            Returns a dict of duplicate url -> canonical url (chains already followed).
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT url, canonical FROM canonical").fetchall()
+        canonical = dict(rows)
+        for url in canonical.keys():
+            target = canonical[url]
+            seen = {url}
+            while target in canonical and target not in seen:
+                seen.add(target)
+                target = canonical[target]
+            canonical[url] = target
+        return canonical
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+def loadCanonicalMap(dbPath: str):
+    """
+        Returns the duplicate url -> canonical url map of a dedup db, empty if there is none.
+    """
+    if not os.path.exists(dbPath):
+        return {}
+    dedup = DedupStore(dbPath)
+    canonical = dedup.getCanonicalMap()
+    dedup.close()
+    return canonical
+
+def canonicalizeLinks(links, canonical: dict):
+    """
+        Returns the set of links with every duplicate replaced by its canonical url.
+    """
+    return {canonical.get(link, link) for link in links}
+
+## ============== ##
+## Near Duplicate ##
+## ============== ##
+
+def _termHashes(terms: list):
+    return np.fromiter((int.from_bytes(blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little') for term in terms), dtype=np.uint64, count=len(terms))
+
+def simHash(terms: list, weights: np.ndarray):
+    """
+        64 bit SimHash (Charikar) of a weighted bag of terms.
+        Each bit is set if the terms whose hash has that bit set outweigh the others.
+    """
+    if len(terms) == 0:
+        return 0
+    bits = (_termHashes(terms)[:, None] >> np.arange(SIMHASH_BITS, dtype=np.uint64)) & np.uint64(1)
+    score = np.asarray(weights, dtype=np.float64) @ (2.0 * bits - 1.0)
+    return int(np.sum(np.uint64(1) << np.flatnonzero(0 < score).astype(np.uint64), dtype=np.uint64))
+
+def simHashFromPage(pageIndex: dict):
+    """
+        SimHash of a page in the term freq json format, each term weighted by its count over every field.
+    """
+    counts = {}
+    for field in FIELDS:
+        for term, count in pageIndex[field].items():
+            counts[term] = counts.get(term, 0) + count
+    return simHash(list(counts.keys()), np.fromiter(counts.values(), dtype=np.float64, count=len(counts)))
+
+def hammingDistance(a: int, b: int):
+    return bin(a ^ b).count("1")
+
+def findNearDuplicates(fingerprints: dict, maxDistance=3):
+    """
+        Clusters urls whose SimHash differ in at most maxDistance bits.
+        The fingerprint is split into maxDistance+1 bands, two fingerprints that close must agree on
+        at least one band, so only urls sharing a band are compared.
+        Returns a list of clusters (lists of urls), only clusters of two or more.
+
+        :param fingerprints: Dict of url -> SimHash
+    """
+
+    urls = list(fingerprints.keys())
+    parent = list(range(len(urls)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    numBands = maxDistance + 1
+    bandBits = -(-SIMHASH_BITS // numBands)
+    for band in range(numBands):
+        buckets = {}
+        for i, url in enumerate(urls):
+            key = (fingerprints[url] >> (band * bandBits)) & ((1 << bandBits) - 1)
+            buckets.setdefault(key, []).append(i)
+
+        for members in buckets.values():
+            for a in range(len(members)):
+                for b in range(a + 1, len(members)):
+                    i, j = members[a], members[b]
+                    if find(i) != find(j) and hammingDistance(fingerprints[urls[i]], fingerprints[urls[j]]) <= maxDistance:
+                        parent[find(i)] = find(j)
+
+    clusters = {}
+    for i, url in enumerate(urls):
+        clusters.setdefault(find(i), []).append(url)
+    return [cluster for cluster in clusters.values() if 1 < len(cluster)]
+
+def chooseCanonical(cluster: list):
+    """
+        The shortest url of a cluster (ties broken alphabetically), so the choice is stable between runs.
+    """
+    return min(cluster, key=lambda url: (len(url), url))
+
+def dedupTermFreqs(termFreqDir: str, dedup: DedupStore, maxDistance=3, store=None):
+    """
+        Finds near duplicate pages in the term frequency cache and records their canonical urls.
+        Returns the number of duplicate pages found.
+
+        :param termFreqDir: Directory of the term frequency json files
+        :param dedup: DedupStore to record the mappings in
+        :param maxDistance: Max SimHash bits apart for two pages to be duplicates
+        :param store: Read this TermFreqStore instead of the json files
+    """
+
+    fingerprints = {}
+    if store is not None:
+        for url, fields, _ in store.scan():
+            termIds = np.concatenate([ids for ids, _ in fields])
+            counts = np.concatenate([fieldCounts for _, fieldCounts in fields]).astype(np.float64)
+            termIds, inverse = np.unique(termIds, return_inverse=True)
+            fingerprints[url] = simHash([store.terms[i] for i in termIds.tolist()], np.bincount(inverse, weights=counts))
+    else:
+        for jsonFile in os.listdir(termFreqDir):
+            if jsonFile.endswith(".json"):
+                with open(f"{termFreqDir}/{jsonFile}", mode='r') as fp:
+                    pageIndex = json_loads(fp.read())
+                fingerprints[pageIndex["url"]] = simHashFromPage(pageIndex)
+
+    numDuplicates = 0
+    for cluster in findNearDuplicates(fingerprints, maxDistance):
+        canonicalURL = chooseCanonical(cluster)
+        for url in cluster:
+            if url != canonicalURL:
+                dedup.setCanonical(url, canonicalURL)
+                numDuplicates += 1
+
+    return numDuplicates
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--termFreqDir", help="Directory of the term frequency cache", type=str, default="term-freq/")
+    parser.add_argument("-d", "--dedupPath", help="SQLite file of the canonical url mappings", type=str, default="index/dedup.db")
+    parser.add_argument("-k", "--maxDistance", help="Max SimHash bits apart for two pages to be duplicates", type=int, default=3)
+    parser.add_argument("-s", "--store", help="Read the binary term frequency store (termFreqDir/store/) instead of json files", action="store_true")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.termFreqDir):
+        print(f"[Dedup]\tERROR! Cannot see term frequency directory: \"{args.termFreqDir}\".")
+        exit(1)
+
+    dedup = DedupStore(args.dedupPath)
+    store = TermFreqStore(f"{args.termFreqDir}/store") if args.store else None
+    numDuplicates = dedupTermFreqs(args.termFreqDir, dedup, args.maxDistance, store)
+    print(f"[Dedup] Found {numDuplicates} near duplicate pages, {len(dedup)} duplicates in total.")
+    dedup.close()
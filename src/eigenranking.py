@@ -1,6 +1,10 @@
 # ====================================================================
 # Computes an eigenranking for all the pages in the index
 #
+# NOTE: The index can either be the legacy index.json or a linkgraph directory
+#
+# NOTE: Duplicate pages (index/dedup.db, see dedup.py) are merged into their canonical page
+#
 # NOTE: Eigenranking format sorted tab seperated list file
 #   0.0123  https://...
 #   0.0091  https://...
@@ -8,12 +12,632 @@
 #   0.0087  https://...
 # 
 from json import loads as json_loads
-from scipy.sparse import dok_matrix
+from scipy.sparse import csr_matrix, identity, tril, triu, diags
+from scipy.sparse.linalg import spsolve_triangular, gmres, bicgstab
 import numpy as np
 import os
 from time import time
+from collections import deque
+from functools import partial
+import argparse
+
+from linkgraph import loadLinkGraph
+from dedup import loadCanonicalMap
+from manifest import bumpGeneration
+from htmlparse import HOSTS
+from metrics import timer, incr, setGauge, flushMetrics, addMetricsArguments, applyMetricsArguments
+
+def buildLinkMatrix(index: dict):
+    """
+        Builds the column-stochastic link matrix for the index directly in CSR form.
+        Returns (matrix, dangling, urls)
+
+        matrix   - csr_matrix where matrix[j, i] = 1/outdegree(i) if page i links to page j
+        dangling - Boolean array, True for pages with no out-links
+        urls     - List of urls, position i is the url of row/column i
+
+        :param index: Dict of url -> list of urls on that page
+    """
+
+    urls = list(index.keys())
+    numPages = len(urls)
+    enumLookup = {url: i for i, url in enumerate(urls)}
+
+    # Flatten the links into (source, target) arrays in one pass
+    outDegree = np.fromiter((len(index[url]) for url in urls), dtype=np.int64, count=numPages)
+    sources = np.repeat(np.arange(numPages, dtype=np.int64), outDegree)
+    targets = np.fromiter((enumLookup[link] for url in urls for link in index[url]), dtype=np.int64, count=int(outDegree.sum()))
+
+    return buildLinkMatrixFromEdges(sources, targets, numPages) + (urls,)
+
+def buildLinkMatrixFromEdges(sources: np.ndarray, targets: np.ndarray, numPages: int):
+    """
+        Builds the column-stochastic link matrix from parallel edge arrays.
+        Duplicate edges are counted once.
+        Returns (matrix, dangling)
+    """
+
+    # Collapse duplicate edges so each link is only counted once
+    if 0 < len(sources):
+        edges = np.unique(np.stack((np.asarray(targets, dtype=np.int64), np.asarray(sources, dtype=np.int64))), axis=1)
+        targets, sources = edges[0], edges[1]
+
+    outDegree = np.bincount(sources, minlength=numPages).astype(np.float64)
+    dangling = outDegree == 0
+
+    # Uniform probability of following each out-link
+    data = 1.0 / outDegree[sources]
+    matSparse = csr_matrix((data, (targets, sources)), shape=(numPages, numPages), dtype=np.float64)
+
+    return matSparse, dangling
+
+def buildLinkMatrixFromCSR(offsets: np.ndarray, targets: np.ndarray):
+    """
+        Builds the column-stochastic link matrix from a linkgraph's CSR arrays.
+        Returns (matrix, dangling)
+    """
+
+    numPages = len(offsets) - 1
+    sources = np.repeat(np.arange(numPages, dtype=np.int64), np.diff(offsets))
+    return buildLinkMatrixFromEdges(sources, targets, numPages)
+
+def powerIteration(matSparse, dangling: np.ndarray, damping=0.85, epsilon=1e-6, maxIter=100000, v0=None, verbose=True):
+    """
+        Runs the damped power iteration  v <- d*(M v + (dangling . v)/N) + (1-d)/N
+        until the L1 residual drops below epsilon.
+        Returns (v, numIterations, residual)
+
+        matSparse - Column-stochastic link matrix (dangling columns all zero)
+        dangling  - Boolean array of pages with no out-links
+        damping   - Probability of following a link rather than teleporting
+        v0        - Optional starting vector (uniform if omitted)
+    """
+
+    numPages = matSparse.shape[0]
+    if v0 is None:
+        v = np.full(numPages, 1.0 / numPages, dtype=np.float64)
+    else:
+        v = np.asarray(v0, dtype=np.float64).copy()
+        v /= v.sum()
+
+    teleport = (1.0 - damping) / numPages
+    residual = np.inf
+    n = 0
+    while epsilon < residual and n < maxIter:
+        # Dangling pages spread their mass evenly over every page
+        danglingMass = v[dangling].sum()
+        vnew = damping * (matSparse @ v) + (damping * danglingMass / numPages + teleport)
+
+        residual = np.abs(vnew - v).sum()
+        v = vnew
+        n += 1
+        incr("rank_iterations")
+        setGauge("rank_residual", residual)
+        if verbose and n%1000 == 0: print(f"n={n}, epsilon={residual:.7g}")
+
+    return v, n, residual
+
+## ======= ##
+## Solvers ##
+## ======= ##
+#
+# Every solver takes (matSparse, dangling, damping, epsilon, maxIter, v0)
+# and returns (v, numIterations, residual), v a probability vector.
+# epsilon is relative: iteration stops once |v_new - v|_1 / |v_new|_1 < epsilon
+#
+
+def pageRankResidual(matSparse, dangling: np.ndarray, v: np.ndarray, damping=0.85):
+    """
+        L1 norm of v - (damped Google matrix) v, the same measure for every solver.
+    """
+    numPages = matSparse.shape[0]
+    Gv = damping * (matSparse @ v) + (damping * v[dangling].sum() + (1.0 - damping) * v.sum()) / numPages
+    return np.abs(Gv - v).sum()
+
+def _toProbability(v: np.ndarray):
+    v = np.abs(v)
+    return v / v.sum()
+
+def extrapolatedPowerIteration(matSparse, dangling: np.ndarray, damping=0.85, epsilon=1e-6, maxIter=100000, v0=None, extrapolateEvery=10):
+    """
+        Power iteration with quadratic extrapolation (Kamvar et al.) every extrapolateEvery
+        iterations, which cancels the slowest decaying error terms.
+    """
+    numPages = matSparse.shape[0]
+    v = np.full(numPages, 1.0 / numPages) if v0 is None else _toProbability(np.asarray(v0, dtype=np.float64))
+    teleport = (1.0 - damping) / numPages
+
+    history = deque(maxlen=4)
+    history.append(v)
+    residual = np.inf
+    n = 0
+    while epsilon < residual and n < maxIter:
+        vnew = damping * (matSparse @ v) + (damping * v[dangling].sum() / numPages + teleport)
+        n += 1
+        history.append(vnew)
+
+        if len(history) == 4 and n % extrapolateEvery == 0:
+            x3, x2, x1, x0 = history   # x0 newest
+            Y = np.stack((x2 - x3, x1 - x3), axis=1)
+            gammas = np.linalg.lstsq(Y, -(x0 - x3), rcond=None)[0]
+            g1, g2, g3 = gammas[0], gammas[1], 1.0
+            extrapolated = (g1 + g2 + g3) * x2 + (g2 + g3) * x1 + g3 * x0
+            if np.isfinite(extrapolated).all() and 0 < np.abs(extrapolated).sum():
+                vnew = _toProbability(extrapolated)
+                history.clear()
+                history.append(vnew)
+
+        residual = np.abs(vnew - v).sum() / vnew.sum()
+        v = vnew
+
+    return v, n, pageRankResidual(matSparse, dangling, v, damping)
+
+def _linearSystem(matSparse, damping: float):
+    """
+        PageRank with uniform dangling and teleport as a linear system:
+        x is proportional to y where (I - d M) y = 1/N
+    """
+    numPages = matSparse.shape[0]
+    A = (identity(numPages, format='csr') - damping * matSparse).tocsr()
+    b = np.full(numPages, 1.0 / numPages)
+    return A, b
+
+def _linearStart(dangling: np.ndarray, v0: np.ndarray, damping: float):
+    """
+        The solution of (I - d M) y = 1/N that a ranking v0 corresponds to.
+        v = d M v + ((1-d) + d (dangling . v))/N for a probability vector v, so y = v / ((1-d) + d (dangling . v))
+    """
+    v = np.asarray(v0, dtype=np.float64)
+    v = v / v.sum()
+    return v / ((1.0 - damping) + damping * v[dangling].sum())
+
+def sorIteration(matSparse, dangling: np.ndarray, damping=0.85, epsilon=1e-6, maxIter=100000, v0=None, omega=1.0):
+    """
+        Gauss-Seidel (omega=1) or SOR sweeps on (I - d M) y = 1/N.
+        Each sweep is one sparse triangular solve, and uses updated entries as soon as they're known.
+        The triangular solve is far slower than a matrix-vector product, so this is for comparing solvers (--compare),
+        power iteration is quicker overall.
+    """
+    A, b = _linearSystem(matSparse, damping)
+    diag = A.diagonal()
+    lower = tril(A, k=-1, format='csr')
+    upper = triu(A, k=1, format='csr')
+
+    # (D + w L) y_new = w b - (w U + (w - 1) D) y
+    T = (lower * omega + diags(diag)).tocsr()
+    y = b.copy() if v0 is None else _linearStart(dangling, v0, damping)
+    residual = np.inf
+    n = 0
+    while epsilon < residual and n < maxIter:
+        rhs = omega * b - (omega * (upper @ y) + (omega - 1.0) * diag * y)
+        ynew = spsolve_triangular(T, rhs, lower=True)
+        residual = np.abs(ynew - y).sum() / np.abs(ynew).sum()
+        y = ynew
+        n += 1
+
+    v = _toProbability(y)
+    return v, n, pageRankResidual(matSparse, dangling, v, damping)
+
+def krylovSolve(matSparse, dangling: np.ndarray, damping=0.85, epsilon=1e-6, maxIter=100000, v0=None, method="gmres"):
+    """
+        Solves (I - d M) y = 1/N with scipy's GMRES or BiCGSTAB.
+    """
+    A, b = _linearSystem(matSparse, damping)
+    x0 = None if v0 is None else _linearStart(dangling, v0, damping)
+
+    numIter = [0]
+    def countIteration(_):
+        numIter[0] += 1
+
+    if method == "gmres":
+        y, info = gmres(A, b, x0=x0, rtol=epsilon, maxiter=maxIter, callback=countIteration, callback_type='pr_norm')
+    else:
+        y, info = bicgstab(A, b, x0=x0, rtol=epsilon, maxiter=maxIter, callback=countIteration)
+    if info != 0:
+        print(f"\tWarning! {method} did not converge (info={info}).")
+
+    v = _toProbability(y)
+    return v, numIter[0], pageRankResidual(matSparse, dangling, v, damping)
+
+def _powerSolver(matSparse, dangling, damping=0.85, epsilon=1e-6, maxIter=100000, v0=None, verbose=True):
+    v, n, _ = powerIteration(matSparse, dangling, damping, epsilon, maxIter, v0, verbose)
+    return v, n, pageRankResidual(matSparse, dangling, v, damping)
+
+SOLVERS = {
+    "power": _powerSolver,
+    "extrapolated": extrapolatedPowerIteration,
+    "gauss-seidel": sorIteration,
+    "sor": lambda *args, **kwargs: sorIteration(*args, omega=1.1, **kwargs),
+    "gmres": lambda *args, **kwargs: krylovSolve(*args, method="gmres", **kwargs),
+    "bicgstab": lambda *args, **kwargs: krylovSolve(*args, method="bicgstab", **kwargs),
+}
+
+def compareSolvers(matSparse, dangling: np.ndarray, damping=0.85, epsilon=1e-6, maxIter=100000, solvers=None):
+    """
+        Runs each solver on the same matrix.
+        Returns a list of (name, numIterations, wallTime, residual).
+    """
+    results = []
+    for name in (solvers or SOLVERS.keys()):
+        # Progress lines would land in the table and be timed, the residual is still kept in the rank_residual gauge
+        solve = partial(_powerSolver, verbose=False) if name == "power" else SOLVERS[name]
+        t0 = time()
+        _, n, residual = solve(matSparse, dangling, damping, epsilon, maxIter)
+        results.append((name, n, time() - t0, residual))
+    return results
+
+def loadLinkMatrix(indexPath: str):
+    """
+        Loads the link matrix of an index.
+        Returns (matrix, dangling, urls), (None, None, []) if the index is missing or empty.
+
+        :param indexPath: Path to the web index json or linkgraph directory
+    """
+
+    if os.path.isdir(indexPath):
+        urls, offsets, targets = loadLinkGraph(indexPath)
+        if 0 < len(urls):
+            print("Populating Sparse Matrix...")
+            return buildLinkMatrixFromCSR(offsets, targets) + (urls,)
+    elif os.path.exists(indexPath):
+        index = {}
+        with open(indexPath, mode='r') as fp:
+            index = json_loads(fp.read())
+        if 0 < len(index.keys()):
+            print("Populating Sparse Matrix...")
+            return buildLinkMatrix(index)
+
+    return None, None, []
+
+def canonicalPageIds(urls: list, canonical: dict):
+    """
+        Returns the page id of each page's canonical page, its own id if it isn't a known duplicate.
+
+        :param canonical: Dict of duplicate url -> canonical url
+    """
+    enumLookup = {url: i for i, url in enumerate(urls)}
+    canonicalIds = np.arange(len(urls), dtype=np.int64)
+    for url, canonicalURL in canonical.items():
+        if url in enumLookup and canonicalURL in enumLookup:
+            canonicalIds[enumLookup[url]] = enumLookup[canonicalURL]
+    return canonicalIds
+
+def collapseDuplicates(matSparse, dangling: np.ndarray, urls: list, canonical: dict):
+    """
+        Merges each duplicate page into its canonical page: links to the duplicate go to the canonical
+        page and the duplicate's out-links become the canonical page's.
+        Returns (matrix, dangling, urls) without the duplicates.
+
+        :param canonical: Dict of duplicate url -> canonical url
+    """
+
+    canonicalIds = canonicalPageIds(urls, canonical)
+    keep = canonicalIds == np.arange(len(urls))
+    if keep.all():
+        return matSparse, dangling, urls
+
+    edges = matSparse.tocoo()
+    sources, targets = canonicalIds[edges.col], canonicalIds[edges.row]
+
+    # A link between a page and its duplicate isnt a real link once they are one page
+    real = (sources != targets) | (edges.col == edges.row)
+    newIds = np.cumsum(keep) - 1
+    matSparse, dangling = buildLinkMatrixFromEdges(newIds[sources[real]], newIds[targets[real]], int(keep.sum()))
+
+    return matSparse, dangling, [url for url, isKept in zip(urls, keep) if isKept]
+
+## ============= ##
+## Incremental   ##
+## ============= ##
+
+def saveRankState(rankStateDir: str, urls: list, v: np.ndarray, matSparse=None):
+    """
+        Saves a rank vector along with the url of each entry, to warm start the next run.
+        With the link matrix it was ranked on, its links are saved too (offsets.npy / targets.npy,
+        CSR by source page, and a checksum of each page's links), so the next run can tell which pages changed (see pushSeeds).
+    """
+    if not os.path.exists(rankStateDir): os.makedirs(rankStateDir)
+    np.save(f"{rankStateDir}/ranks.npy", np.asarray(v, dtype=np.float64))
+    with open(f"{rankStateDir}/urls.txt", mode='w', encoding='utf-8') as fp:
+        fp.write("".join(f"{url}\n" for url in urls))
+    if matSparse is not None:
+        cscMat = matSparse.tocsc()
+        offsets = cscMat.indptr.astype(np.int64)
+        np.save(f"{rankStateDir}/offsets.npy", offsets)
+        np.save(f"{rankStateDir}/targets.npy", cscMat.indices.astype(np.int32))
+        np.save(f"{rankStateDir}/checksums.npy", _linkChecksums(offsets, cscMat.indices, len(urls)))
+    else:
+        # Links from an older run would no longer match the ranks
+        for fileName in ("offsets.npy", "targets.npy", "checksums.npy"):
+            if os.path.exists(f"{rankStateDir}/{fileName}"): os.remove(f"{rankStateDir}/{fileName}")
+
+def loadRankState(rankStateDir: str):
+    """
+        Returns (urls, v) saved by saveRankState, or None if there is no saved state.
+    """
+    ranksPath = f"{rankStateDir}/ranks.npy"
+    urlsPath = f"{rankStateDir}/urls.txt"
+    if not (os.path.exists(ranksPath) and os.path.exists(urlsPath)):
+        return None
+    with open(urlsPath, mode='r', encoding='utf-8') as fp:
+        urls = fp.read().splitlines()
+    v = np.load(ranksPath)
+    if len(urls) != len(v):
+        return None
+    return urls, v
+
+def loadRankStateLinks(rankStateDir: str, numPages: int):
+    """
+        Returns (offsets, targets, checksums) of the links saved by saveRankState for numPages pages, or None if there are none.
+    """
+    paths = [f"{rankStateDir}/{name}.npy" for name in ("offsets", "targets", "checksums")]
+    if not all(os.path.exists(path) for path in paths):
+        return None
+    offsets = np.load(paths[0])
+    if len(offsets) != numPages + 1:
+        return None
+    return offsets, np.load(paths[1], mmap_mode='r'), np.load(paths[2])
+
+def _previousIds(urls: list, prevUrls: list):
+    """
+        Returns the index in prevUrls of each url, -1 for new pages.
+    """
+    numPrev = len(prevUrls)
+    if numPrev <= len(urls) and urls[:numPrev] == prevUrls:
+        # Pages only appended since (the link graph's usual case)
+        return np.concatenate((np.arange(numPrev, dtype=np.int64), np.full(len(urls) - numPrev, -1, dtype=np.int64)))
+    prevLookup = {url: i for i, url in enumerate(prevUrls)}
+    return np.fromiter((prevLookup.get(url, -1) for url in urls), dtype=np.int64, count=len(urls))
+
+def _columnEdges(offsets: np.ndarray, columns: np.ndarray):
+    """
+        Returns the positions in a CSR / CSC index array of every entry of the given columns (rows), in order.
+    """
+    starts = offsets[columns]
+    lengths = offsets[columns + 1] - starts
+    ends = np.cumsum(lengths)
+    return np.repeat(starts - (ends - lengths), lengths) + np.arange(int(ends[-1]) if len(ends) else 0)
+
+def _linkChecksums(offsets: np.ndarray, targets: np.ndarray, numPages: int):
+    """
+        Order independent uint64 checksum of each page's links (CSR offsets / targets), the summed hashes of its targets.
+        A target of -1 (a removed page) hashes like an extra page.
+    """
+    pageHashes = np.arange(1, numPages + 2, dtype=np.uint64)
+    pageHashes *= np.uint64(0x9E3779B97F4A7C15)
+    pageHashes ^= pageHashes >> np.uint64(29)
+    pageHashes *= np.uint64(0xBF58476D1CE4E5B9)
+    sums = np.zeros(len(targets) + 1, dtype=np.uint64)
+    np.cumsum(pageHashes[targets], out=sums[1:])
+    return sums[offsets[1:]] - sums[offsets[:-1]]
+
+def warmStartVector(urls: list, prevUrls: list, prevV: np.ndarray):
+    """
+        Maps a previous rank vector onto the current pages.
+        Pages that are new get the rank of an average page (1/N), pages that were removed
+        lose theirs, and the result is renormalized to sum to 1.
+    """
+    numPages = len(urls)
+    prevIds = _previousIds(urls, prevUrls)
+    known = 0 <= prevIds
+
+    v = np.full(numPages, 1.0 / numPages, dtype=np.float64)
+    if known.any():
+        # Old ranks are rescaled so they keep their share of the pages they still cover
+        old = prevV[prevIds[known]]
+        v[known] = old * (known.sum() / numPages) / old.sum()
+    return v / v.sum()
+
+def pushSeeds(matSparse, urls: list, prevUrls: list, prevV: np.ndarray, prevOffsets: np.ndarray, prevTargets: np.ndarray, prevChecksums=None, damping=0.85):
+    """
+        Starting point of a localized update (see forwardPush) after the graph changed.
+        Returns (x, r)
+
+        x - The previous ranks on the current pages, as they were (0 for new pages)
+        r - Residual of x, only on the rows whose in-links changed: targets (old and new) of every
+            page whose out-links changed, and new pages. Every other row is taken as exact, the
+            previous ranks solved the old graph there
+
+        Residuals are against the previous run's teleport and dangling constant
+        c = (1-d)/N_old + d*(dangling_old . v_old)/N_old, so the rows left out really are at zero.
+        Any uniform difference to the new constant only rescales the solution, which is normalized at the end.
+
+        prevOffsets, prevTargets, prevChecksums - The previous links, as saved by saveRankState
+    """
+
+    numPages = len(urls)
+    numPrev = len(prevUrls)
+    prevIds = _previousIds(urls, prevUrls)
+    known = 0 <= prevIds
+    newIds = np.full(numPrev, -1, dtype=np.int64)
+    newIds[prevIds[known]] = np.flatnonzero(known)
+
+    x = np.zeros(numPages, dtype=np.float64)
+    x[known] = prevV[prevIds[known]]
+    prevOffsets = np.asarray(prevOffsets, dtype=np.int64)
+    prevOutDegree = np.diff(prevOffsets)
+    c = (1.0 - damping) / numPrev + damping * prevV[prevOutDegree == 0].sum() / numPrev
+
+    # A page's out-links changed if it is new or its set of links differs, which a hash of each
+    # link summed per page tells without sorting or comparing links. The saved checksums
+    # still hold if no page moved, else the previous links are hashed in the current page ids
+    cscMat = matSparse.tocsc()
+    offsets, targets = cscMat.indptr.astype(np.int64), cscMat.indices
+    checksums = _linkChecksums(offsets, targets, numPages)
+    if prevChecksums is None or not (newIds == np.arange(numPrev)).all():
+        prevChecksums = _linkChecksums(prevOffsets, newIds[prevTargets], numPages)
+    changed = ~known
+    keptIds = np.flatnonzero(known)
+    changed[keptIds[(checksums[keptIds] != prevChecksums[prevIds[keptIds]]) | (np.diff(offsets)[keptIds] != prevOutDegree[prevIds[keptIds]])]] = True
+
+    # Every target, before and after, of a changed (or removed) page gets a new share of its rank
+    affected = ~known
+    affected[targets[_columnEdges(offsets, np.flatnonzero(changed))]] = True
+    prevChanged = np.flatnonzero((newIds < 0) | changed[np.maximum(newIds, 0)])
+    prevChangedTargets = newIds[prevTargets[_columnEdges(prevOffsets, prevChanged)]]
+    affected[prevChangedTargets[0 <= prevChangedTargets]] = True
+
+    rows = np.flatnonzero(affected)
+    r = np.zeros(numPages, dtype=np.float64)
+    r[rows] = damping * (cscMat @ x)[rows] + c - x[rows]
+    return x, r
+
+def forwardPush(matSparse, dangling: np.ndarray, x: np.ndarray, r: np.ndarray, damping=0.85, epsilon=1e-6, maxEdges=None):
+    """
+        Localized PageRank update: pushes the residual r of an approximate solution x (see pushSeeds)
+        until no page's residual exceeds epsilon/N, or the pushes have followed maxEdges links
+        (default a quarter of the links, about the work of one power iteration). Only pages near nonzero
+        residual are ever touched, so after a small change to the graph the work stays near the changed links.
+        Returns (v, numPushes, residual), v normalized, follow up with a solver to finish converging.
+
+        Pushing page i moves r_i into x_i and spreads d*r_i over its out-links. Every page over the
+        threshold is pushed at once each round, and only pages a round touched are checked in the next.
+        A dangling page would spread d*r_i/N over every page, a uniform shift that only rescales x, so it is left out.
+    """
+
+    numPages = matSparse.shape[0]
+    x = np.array(x, dtype=np.float64)
+    r = np.array(r, dtype=np.float64)
+    cscMat = matSparse.tocsc()
+    colPtr, rowIds, vals = cscMat.indptr, cscMat.indices, cscMat.data
+
+    threshold = epsilon / numPages
+    maxEdges = maxEdges if maxEdges is not None else cscMat.nnz // 4
+    numPushes = 0
+    numEdges = 0
+    candidates = np.flatnonzero(r)
+    while 0 < len(candidates) and numEdges < maxEdges:
+        pushed = candidates[threshold < np.abs(r[candidates])]
+        numLinks = int((colPtr[pushed + 1] - colPtr[pushed]).sum())
+        if len(pushed) == 0 or (0 < numEdges and maxEdges < numEdges + numLinks):
+            break
+        rPushed = r[pushed]
+        x[pushed] += rPushed
+        r[pushed] = 0.0
+        numPushes += len(pushed)
+
+        # Gather the out-links of every pushed page in one go
+        linking = ~dangling[pushed]
+        pushed, rPushed = pushed[linking], rPushed[linking]
+        edges = _columnEdges(colPtr, pushed)
+        weights = damping * vals[edges] * np.repeat(rPushed, colPtr[pushed + 1] - colPtr[pushed])
+        if numLinks < numPages // 16:
+            np.add.at(r, rowIds[edges], weights)
+            candidates = np.unique(rowIds[edges])
+        else:
+            # A wide front is cheaper as a dense pass over every page
+            spread = np.bincount(rowIds[edges], weights=weights, minlength=numPages)
+            r += spread
+            candidates = np.flatnonzero(spread)
+        numEdges += numLinks
+
+    incr("rank_pushes", numPushes)
+    return x / x.sum(), numPushes, np.abs(r).sum()
+
+## ============ ##
+## Personalized ##
+## ============ ##
+#
+# Personalized (topic-sensitive) PageRank teleports to a seed set instead of every page,
+#   v <- d*(M v + (dangling . v) p) + (1-d) p
+# with p the personalization vector. Many p are solved at once as the columns of an
+# n x k block, so each pass over the link matrix (M @ V, sparse times dense) serves every
+# vector. With a uniform p it is the same as powerIteration.
+#
+
+def personalizationMatrix(urls: list, seedSets: dict):
+    """
+        Builds the n x k block of personalization vectors, one column per seed set.
+        Returns (names, P), names[j] the name of column j, each column sums to 1.
+
+        :param seedSets: Dict of name -> list of seed urls, or dict of seed url -> weight
+    """
+    enumLookup = {url: i for i, url in enumerate(urls)}
+    names = []
+    columns = []
+    for name, seeds in seedSets.items():
+        weights = seeds if isinstance(seeds, dict) else dict.fromkeys(seeds, 1.0)
+        p = np.zeros(len(urls), dtype=np.float64)
+        for url, weight in weights.items():
+            i = enumLookup.get(url)
+            if i is not None:
+                p[i] += weight
+        if p.sum() <= 0:
+            print(f"\tWarning! No seed of \"{name}\" is in the index, skipping it.")
+            continue
+        names.append(name)
+        columns.append(p / p.sum())
+
+    P = np.stack(columns, axis=1) if columns else np.zeros((len(urls), 0), dtype=np.float64)
+    return names, np.ascontiguousarray(P)
+
+def hostSeedSets(urls: list):
+    """
+        One seed set per host in the index (e.g. "WP", "SOF", "MW"), every page of that host.
+    """
+    seedSets = {}
+    for host, info in HOSTS.items():
+        if info.hostURL:
+            seeds = [url for url in urls if url.startswith(info.hostURL)]
+            if seeds:
+                seedSets[host.name] = seeds
+    return seedSets
+
+def blockPowerIteration(matSparse, dangling: np.ndarray, P: np.ndarray, damping=0.85, epsilon=1e-6, maxIter=100000, V0=None, verbose=True):
+    """
+        Runs the personalized power iteration for every column of P together.
+        Columns stop being updated once their L1 residual drops below epsilon,
+        so the block shrinks as the easy vectors converge.
+        Returns (V, numIterations, residuals), V n x k with each column a probability vector.
 
-def determineEigenRankings(indexPath: str):
+        P  - n x k personalization vectors, columns summing to 1
+        V0 - Optional n x k starting block (P if omitted)
+    """
+
+    P = np.ascontiguousarray(P, dtype=np.float64)
+    numPages, numVectors = P.shape
+    V = np.empty((numPages, numVectors), dtype=np.float64)
+    residuals = np.full(numVectors, np.inf)
+
+    # Va, Pa - The still active columns, kept as their own contiguous blocks (compacted as columns converge)
+    active = np.arange(numVectors)
+    Va = np.array(P if V0 is None else V0, dtype=np.float64, order='C')
+    Va /= Va.sum(axis=0)
+    Pa = P
+    buf = np.empty_like(Va)
+    n = 0
+    while 0 < len(active) and n < maxIter:
+
+        # One pass over the matrix for every active vector, dangling mass goes back to each one's seeds
+        danglingMass = Va[dangling].sum(axis=0)
+        Vnew = matSparse @ Va
+        Vnew *= damping
+        np.multiply(Pa, damping * danglingMass + (1.0 - damping), out=buf)
+        Vnew += buf
+
+        np.subtract(Vnew, Va, out=buf)
+        np.abs(buf, out=buf)
+        residuals[active] = buf.sum(axis=0)
+        Va, buf = Vnew, Va
+
+        converged = residuals[active] <= epsilon
+        if converged.any():
+            V[:, active[converged]] = Va[:, converged]
+            active = active[~converged]
+            Va = np.ascontiguousarray(Va[:, ~converged])
+            Pa = np.ascontiguousarray(Pa[:, ~converged])
+            buf = np.empty_like(Va)
+
+        n += 1
+        incr("rank_iterations")
+        setGauge("rank_residual", float(residuals.max()))
+        if verbose and n%1000 == 0: print(f"n={n}, active={len(active)}, epsilon={residuals.max():.7g}")
+
+    if 0 < len(active):
+        V[:, active] = Va
+    return V, n, residuals
+
+def determineEigenRankings(indexPath: str, damping=0.85, epsilon=1e-6, maxIter=100000, rankStateDir=None, localPush=False, solver="power", canonical=None):
     """
         Returns a sorted list of tuples (probability, url)
         [
@@ -23,7 +647,14 @@ def determineEigenRankings(indexPath: str):
             (p, url)
         ]
 
-        :param indexDir: Path to the directory of the web index
+        :param indexPath: Path to the web index json or linkgraph directory
+        :param damping: Probability of following a link rather than jumping to a random page
+        :param epsilon: Relative change (L1) at which the iteration is considered converged
+        :param maxIter: Cap on the number of iterations
+        :param rankStateDir: Directory to warm start from (if a previous run saved one) and save this run to
+        :param localPush: Push the residual of the pages whose links changed since the saved ranking before solving (see pushSeeds)
+        :param solver: One of SOLVERS ("power", "extrapolated", "gauss-seidel", "sor", "gmres", "bicgstab")
+        :param canonical: Dict of duplicate url -> canonical url, duplicates are merged into their canonical page
     """
     
     eigenRankings = []
@@ -34,112 +665,194 @@ def determineEigenRankings(indexPath: str):
     print("Reading The Index...")
 
     # Load up the index and check that its non-empty
-    if os.path.exists(indexPath):
-        index = {}
-        with open(indexPath, mode='r') as fp:
-            index = json_loads(fp.read())
-        if 0 < len(index.keys()):
+    matSparse, dangling, urls = loadLinkMatrix(indexPath)
 
-            # ===============================
-            # Step 2) Populate spares matrix
-            # ===============================
-            print("Populating Sparse Matrix...")
-            
-            urls = index.keys()
+    if matSparse is not None:
+
+        if canonical:
             numPages = len(urls)
+            matSparse, dangling, urls = collapseDuplicates(matSparse, dangling, urls, canonical)
+            print(f"Merged {numPages - len(urls)} duplicate pages.")
+
+        # ===============================
+        # Step 2) Show stats on the links
+        # ===============================
+        outDegree = np.diff(matSparse.tocsc().indptr)
+        print("Stats on links in the mini-web:")
+        print(f"\tmin: {outDegree.min()}")
+        print(f"\tmax: {outDegree.max()}")
+        print(f"\tavg: {outDegree.mean()}")
+        print(f"\tdangling: {dangling.sum()}\n")
+
+        # ==============================
+        # Step 3) Determine Eigenvector
+        # ==============================
+        print("Determining eigenvector...")
+
+        t0 = time()
+        v0 = None
+        prevState = loadRankState(rankStateDir) if rankStateDir else None
+        if prevState is not None:
+            print("Warm starting from the previous ranking...")
+            prevLinks = loadRankStateLinks(rankStateDir, len(prevState[0])) if localPush else None
+            if prevLinks is not None:
+                cscMat = matSparse.tocsc()
+                x, r = pushSeeds(cscMat, urls, *prevState, *prevLinks, damping)
+                v0, numPushes, pushResidual = forwardPush(cscMat, dangling, x, r, damping, epsilon)
+                print(f"\tPushes: {numPushes}. Residual after push: {pushResidual}")
+            else:
+                if localPush: print("\tWarning! No links saved with the previous ranking, warm starting without a push.")
+                v0 = warmStartVector(urls, *prevState)
 
-            ## DEV STUFF
-            # Show stats on the links
-            l_min = 2**32 - 1
-            l_max = 0
-            l_avg = 0
-            for url in urls:
-                l = len(index[url])
-                l_min = min(l_min, l)
-                l_max = max(l_max, l)
-                l_avg += l
-            
-            print("Stats on links in the mini-web:")
-            print(f"\tmin: {l_min}")
-            print(f"\tmax: {l_max}")
-            print(f"\tavg: {l_avg / numPages}\n")
-
-            # Create maps to manage the index to url relationship
-            enumLookup = {url: i for i, url in enumerate(urls)}
-            urlLookup =  {i: url for i, url in enumerate(urls)}
-
-            # Populate the sparse matrix with a uniform probability of going to each page
-            matSparse = dok_matrix((numPages, numPages), dtype=np.float64)
-            for url, links in index.items():
-                i = enumLookup[url]
-                n = len(links)
-                p = 1.0 / n if 0 < n else 0.0
-                for link in links:
-                    j = enumLookup[link]
-                    matSparse[j, i] = p
-
-            # ==============================
-            # Step 3) Determine Eigenvector
-            # ==============================
-            print("Determining eigenvector...")
-
-            # Initialize a uniform probability vector
-            p = 1.0 / numPages
-            v = np.ones((numPages, 1), dtype=np.float64) * p
-            
-            # Run the vector through enough cycles until convergence on eigenvector
-            epsilon = 1.0
-            n = 0
-            t0 = time()
-            while 1e-6 < epsilon and n < 100000:
-                if n%1000 == 0: print(f"n={n}, epsilon={round(epsilon, 7)}")
-                vnew = matSparse * v
-
-                # check difference between vectors for convergence
-                epsilon = 0
-                for i in range(numPages):
-                    epsilon += abs(v[i][0] - vnew[i][0])
-                    
-                v = vnew
-                n+=1
-
-            t1 = time()
-            print(f"Time elapsed: {t1-t0}")
-
-            ## DEV STUFF
-            # Check that v is an eigenvector that sums to 1
-            s = 0
-            for p in v:
-                s += p[0]   # NOTE: Nx1 matrix
-            print(f"\tEpsilon: {epsilon}. Eigenvector sums to {s}")
-
-            # ==================
-            # Step 4) Rank Urls
-            # ==================
-            print("Ranking Pages...")
-
-            # Tuple the probabilties with the urls
-            eigenRankings = [(p[0], urlLookup[i]) for i, p in enumerate(vnew)]
-            eigenRankings.sort(key=lambda x: x[0], reverse=True)
+        with timer("rank_solve_seconds"):
+            v, n, residual = SOLVERS[solver](matSparse, dangling, damping, epsilon, maxIter, v0)
+        setGauge("rank_residual", residual)
+        setGauge("rank_solve_iterations", n)
+        t1 = time()
+        print(f"Time elapsed: {t1-t0}")
+        print(f"\tSolver: {solver}. Iterations: {n}. Residual: {residual}. Eigenvector sums to {v.sum()}")
+
+        # ==================
+        # Step 4) Rank Urls
+        # ==================
+        eigenRankings = finishEigenRankings(urls, v, rankStateDir, matSparse)
 
     return eigenRankings
 
+def finishEigenRankings(urls: list, v: np.ndarray, rankStateDir=None, matSparse=None):
+    """
+        The last steps of every eigenranking stage (this one and shardedrank.py): saves the rank state,
+        bumps the generation and returns the sorted list of (probability, url).
+
+        :param matSparse: Link matrix v was ranked on, saved with the rank state for --push (see saveRankState)
+    """
+    if rankStateDir: saveRankState(rankStateDir, urls, v, matSparse)
+
+    print("Ranking Pages...")
+
+    # Tuple the probabilties with the urls
+    order = np.argsort(-v, kind='stable')
+    eigenRankings = [(float(v[i]), urls[i]) for i in order]
+    bumpGeneration()
+
+    return eigenRankings
+
+def writeEigenRankings(eigenRankPath: str, eigenRankings: list):
+    """
+        Writes the sorted (probability, url) list in the eigenranking format.
+    """
+    with open(eigenRankPath, mode="w") as fp:
+        fp.write("\n".join(f"{p}\t{url}" for p, url in eigenRankings))
+
+def determinePersonalizedRankings(indexPath: str, seedSets=None, byHost=False, damping=0.85, epsilon=1e-6, maxIter=100000, canonical=None):
+    """
+        Solves a personalized ranking for every seed set at once (see blockPowerIteration).
+        Returns (names, urls, V), V[:, j] the ranking of seed set names[j] over urls.
+
+        :param seedSets: Dict of name -> seed urls (or seed url -> weight)
+        :param byHost: Also rank for one seed set per host (see hostSeedSets)
+        :param canonical: Dict of duplicate url -> canonical url, duplicates are merged into their canonical page
+    """
+
+    matSparse, dangling, urls = loadLinkMatrix(indexPath)
+    if matSparse is None:
+        return [], [], np.zeros((0, 0), dtype=np.float64)
+    if canonical:
+        matSparse, dangling, urls = collapseDuplicates(matSparse, dangling, urls, canonical)
+
+    # Seeds that are duplicates count for their canonical page
+    seedSets = {name: ({canonical.get(url, url): w for url, w in seeds.items()} if isinstance(seeds, dict) else [canonical.get(url, url) for url in seeds])
+                for name, seeds in (seedSets or {}).items()} if canonical else dict(seedSets or {})
+    if byHost:
+        seedSets = {**hostSeedSets(urls), **seedSets}
+    names, P = personalizationMatrix(urls, seedSets)
+    if not names:
+        return [], urls, P
+
+    print(f"Determining {len(names)} personalized rankings...")
+    t0 = time()
+    with timer("rank_personalized_seconds"):
+        V, n, residuals = blockPowerIteration(matSparse, dangling, P, damping, epsilon, maxIter)
+    print(f"Time elapsed: {time()-t0}")
+    print(f"\tIterations: {n}. Max residual: {residuals.max()}")
+    bumpGeneration()
+
+    return names, urls, V
+
+def savePersonalizedRankings(outDir: str, names: list, urls: list, V: np.ndarray):
+    """
+        Stores personalized rankings compactly: ranks.npy is float32[k, n], row j the ranking
+        named on line j of names.txt, column i the page on line i of urls.txt.
+    """
+    if not os.path.exists(outDir): os.makedirs(outDir)
+    np.save(f"{outDir}/ranks.npy", np.ascontiguousarray(V.T, dtype=np.float32))
+    with open(f"{outDir}/names.txt", mode='w', encoding='utf-8') as fp:
+        fp.write("".join(f"{name}\n" for name in names))
+    with open(f"{outDir}/urls.txt", mode='w', encoding='utf-8') as fp:
+        fp.write("".join(f"{url}\n" for url in urls))
+
+def loadPersonalizedRankings(outDir: str):
+    """
+        Returns (names, urls, ranks) saved by savePersonalizedRankings, ranks memory mapped, or None if there are none.
+    """
+    ranksPath = f"{outDir}/ranks.npy"
+    if not os.path.exists(ranksPath):
+        return None
+    with open(f"{outDir}/names.txt", mode='r', encoding='utf-8') as fp:
+        names = fp.read().splitlines()
+    with open(f"{outDir}/urls.txt", mode='r', encoding='utf-8') as fp:
+        urls = fp.read().splitlines()
+    return names, urls, np.load(ranksPath, mmap_mode='r')
+
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--incremental", help="Warm start from the last run's ranks (index/rankstate/)", action="store_true")
+    parser.add_argument("-p", "--push", help="With --incremental, push the residual of the pages whose links changed before iterating", action="store_true")
+    parser.add_argument("-s", "--solver", help="Eigenvector solver", type=str, choices=list(SOLVERS.keys()), default="power")
+    parser.add_argument("-e", "--epsilon", help="Relative tolerance to stop at", type=float, default=1e-6)
+    parser.add_argument("-c", "--compare", help="Time every solver on the index instead of ranking", action="store_true")
+    parser.add_argument("--hosts", help="Also rank personalized to each host (WP, SOF, MW), into index/personalized/", action="store_true")
+    parser.add_argument("--topics", help="Also rank personalized to each seed set of this json (name -> list of seed urls), into index/personalized/", type=str, default=None)
+    addMetricsArguments(parser)
+    args = parser.parse_args()
+    applyMetricsArguments(args)
+
     indexPath = "index/index.json"
+    graphDir = "index/graph"
+    rankStateDir = "index/rankstate"
+    dedupPath = "index/dedup.db"
     eigenRankPath = "index/eigenranking.txt"
+    personalizedDir = "index/personalized"
+
+    # Prefer the compact link graph when the indexer has written one
+    if os.path.isdir(graphDir): indexPath = graphDir
     
     # Get the eigenrankings
-    if os.path.exists(indexPath):
-        eRanks = determineEigenRankings(indexPath)
+    if os.path.exists(indexPath) and args.compare:
+        matSparse, dangling, urls = loadLinkMatrix(indexPath)
+        if matSparse is not None:
+            print("solver\titerations\tseconds\tresidual")
+            for name, n, seconds, residual in compareSolvers(matSparse, dangling, epsilon=args.epsilon):
+                print(f"{name}\t{n}\t{seconds:.4f}\t{residual:.3g}")
+
+    elif os.path.exists(indexPath):
+        eRanks = determineEigenRankings(indexPath, epsilon=args.epsilon, rankStateDir=rankStateDir if args.incremental else None, localPush=args.push, solver=args.solver, canonical=loadCanonicalMap(dedupPath))
 
         # Print out to file
-        sOut = ""
-        for p, url in eRanks:
-            sOut += f"{p}\t{url}\n"
-        sOut = sOut[:-1]
-        with open(eigenRankPath, mode="w") as fp:
-            fp.write(sOut)
+        writeEigenRankings(eigenRankPath, eRanks)
+
+        # Every personalized ranking is solved in one block
+        if args.hosts or args.topics:
+            seedSets = {}
+            if args.topics:
+                with open(args.topics, mode='r') as fp:
+                    seedSets = json_loads(fp.read())
+            names, urls, V = determinePersonalizedRankings(indexPath, seedSets, args.hosts, epsilon=args.epsilon, canonical=loadCanonicalMap(dedupPath))
+            if names:
+                savePersonalizedRankings(personalizedDir, names, urls, V)
+                print(f"Saved {len(names)} personalized rankings to \"{personalizedDir}\".")
+        flushMetrics()
 
     else:
         print(f"\tERROR! Cannot see local index path: \"{indexPath}\".")
@@ -0,0 +1,230 @@
+# ====================================================================
+# HTTP fetch layer for the spider
+#
+# - One keep-alive connection per host per thread, so each page after the
+#   first skips the TCP and TLS handshakes
+# - Asks for compressed transfers (gzip, deflate, and br if the brotli
+#   package is installed) and decodes them
+# - Remembers each page's ETag / Last-Modified in a SQLite file, and
+#   revalidates with If-None-Match / If-Modified-Since when refreshing a page,
+#   so a page that hasn't changed costs a 304 with no body
+#
+import gzip
+import zlib
+import sqlite3
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from threading import Lock, local
+from time import time
+from urllib.parse import urlsplit, urljoin
+
+from metrics import timer, incr, logPage
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+USER_AGENT = 'Mozilla/5.0 (Windows; U; Windows NT 5.1; en-US; rv:1.9.0.7) Gecko/2009021910 Firefox/3.0.7'
+ACCEPT_ENCODING = "gzip, deflate, br" if brotli is not None else "gzip, deflate"
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+
+class FetchResult:
+    """
+        Outcome of a fetch.
+        status      - HTTP status of the final response
+        body        - Decoded response bytes, None on a 304 or failure
+        url         - Url the body came from, after redirects
+    """
+
+    def __init__(self, status: int, body=None, url=None):
+        self.status = status
+        self.body = body
+        self.url = url
+
+    @property
+    def notModified(self):
+        return self.status == 304
+
+    @property
+    def ok(self):
+        return self.body is not None and 200 <= self.status < 300
+
+class ResponseMetadata:
+    """
+        Validators (ETag, Last-Modified) of every page fetched, kept in a SQLite file.
+        Safe to share between threads.
+    """
+
+    def __init__(self, dbPath: str):
+        self.lock = Lock()
+        self.db = sqlite3.connect(dbPath, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, etag TEXT, lastModified TEXT, fetched REAL NOT NULL)")
+        self.db.commit()
+
+    def get(self, url: str):
+        """
+            Returns (etag, lastModified) of a page, None if it was never fetched.
+        """
+        with self.lock:
+            return self.db.execute("SELECT etag, lastModified FROM responses WHERE url = ?", (url,)).fetchone()
+
+    def put(self, url: str, etag, lastModified):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO responses (url, etag, lastModified, fetched) VALUES (?, ?, ?, ?)", (url, etag, lastModified, time()))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+def decodeBody(body: bytes, contentEncoding):
+    """
+        Undoes the Content-Encoding of a response body.
+    """
+    contentEncoding = (contentEncoding or "identity").strip().lower()
+    if contentEncoding in ("gzip", "x-gzip"):
+        return gzip.decompress(body)
+    if contentEncoding == "deflate":
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            return zlib.decompress(body, -zlib.MAX_WBITS)   # Raw deflate, no zlib header
+    if contentEncoding == "br" and brotli is not None:
+        return brotli.decompress(body)
+    return body
+
+class Fetcher:
+    """
+        Thread safe page fetcher with persistent connections and conditional requests.
+        Each thread gets its own connections, http.client connections can't be shared.
+    """
+
+    def __init__(self, metadataPath=None, timeout=30.0):
+        """
+            metadataPath - SQLite file to keep ETag / Last-Modified in (None to not revalidate)
+            timeout      - Socket timeout in seconds
+        """
+        self.metadata = ResponseMetadata(metadataPath) if metadataPath else None
+        self.timeout = timeout
+        self.local = local()
+        self.openConnections = set()
+        self.statsLock = Lock()
+        self.stats = {"requests": 0, "notModified": 0, "connections": 0, "bytesReceived": 0, "bytesDecoded": 0}
+
+    def _count(self, **counts):
+        with self.statsLock:
+            for key, n in counts.items():
+                self.stats[key] += n
+
+    def _connection(self, scheme: str, netloc: str):
+        connections = self.local.__dict__.setdefault("connections", {})
+        conn = connections.get((scheme, netloc))
+        if conn is None:
+            conn = (HTTPSConnection if scheme == "https" else HTTPConnection)(netloc, timeout=self.timeout)
+            connections[(scheme, netloc)] = conn
+            with self.statsLock:
+                self.openConnections.add(conn)
+                self.stats["connections"] += 1
+        return conn
+
+    def _dropConnection(self, scheme: str, netloc: str):
+        conn = self.local.__dict__.get("connections", {}).pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+            with self.statsLock:
+                self.openConnections.discard(conn)
+
+    def _request(self, url: str, headers: dict):
+        """
+            One GET on the pooled connection, retried once on a fresh connection
+            if the server closed the idle one. Returns (status, headers, body bytes).
+        """
+        parts = urlsplit(url)
+        path = parts.path or "/"
+        if parts.query: path += "?" + parts.query
+
+        for attempt in range(2):
+            conn = self._connection(parts.scheme, parts.netloc)
+            try:
+                with timer("fetch_seconds"):
+                    conn.request("GET", path, headers=headers)
+                    response = conn.getresponse()
+                    body = response.read()
+            except (HTTPException, ConnectionError, OSError):
+                incr("fetch_errors")
+                self._dropConnection(parts.scheme, parts.netloc)
+                if attempt == 1: raise
+                continue
+
+            if response.will_close:
+                self._dropConnection(parts.scheme, parts.netloc)
+            self._count(requests=1, bytesReceived=len(body))
+            incr("fetch_requests")
+            incr("fetch_bytes", len(body))
+            return response.status, response.headers, body
+
+    def fetch(self, url: str, revalidate=False):
+        """
+            GETs a page, following redirects.
+
+            :param revalidate: Send the stored validators so an unchanged page comes back as a 304
+                               (only pass True if the caller still has the page's last body)
+        """
+
+        headers = {"User-Agent": USER_AGENT, "Accept-Encoding": ACCEPT_ENCODING}
+        if revalidate and self.metadata is not None:
+            validators = self.metadata.get(url)
+            if validators is not None:
+                etag, lastModified = validators
+                if etag: headers["If-None-Match"] = etag
+                if lastModified: headers["If-Modified-Since"] = lastModified
+
+        requestURL = url
+        for _ in range(MAX_REDIRECTS + 1):
+            status, responseHeaders, body = self._request(requestURL, headers)
+            if status in REDIRECT_CODES and responseHeaders.get("Location"):
+                requestURL = urljoin(requestURL, responseHeaders["Location"])
+                headers.pop("If-None-Match", None)
+                headers.pop("If-Modified-Since", None)
+                continue
+            break
+
+        if status == 304:
+            self._count(notModified=1)
+            incr("fetch_not_modified")
+            return FetchResult(status, None, requestURL)
+        if not 200 <= status < 300:
+            return FetchResult(status, None, requestURL)
+
+        body = decodeBody(body, responseHeaders.get("Content-Encoding"))
+        self._count(bytesDecoded=len(body))
+        if self.metadata is not None:
+            self.metadata.put(url, responseHeaders.get("ETag"), responseHeaders.get("Last-Modified"))
+        return FetchResult(status, body, requestURL)
+
+    def fetchBytes(self, url: str):
+        """
+            Fetch-only path, the page's bytes without parsing. None on failure.
+        """
+        logPage(f"Making request from \"{url}\".")
+        try:
+            result = self.fetch(url)
+        except Exception as e:
+            print(f"Unknown Error in accessing '{url}': {e}")
+            return None
+        if not result.ok:
+            print(f"HTTP connection was denied to '{url}' ({result.status}).")
+            return None
+        return result.body
+
+    def close(self):
+        """
+            Closes every thread's connections, only call once no thread is fetching.
+        """
+        with self.statsLock:
+            for conn in self.openConnections:
+                conn.close()
+            self.openConnections = set()
+        if self.metadata is not None:
+            self.metadata.close()
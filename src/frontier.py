@@ -0,0 +1,251 @@
+# ====================================================================
+# Crawl frontiers for the spider
+#
+# CrawlFrontier      - In memory, lost when the crawler stops
+# PersistentFrontier - Kept in a SQLite file, so the crawl resumes where it stopped
+#
+# Both hand out urls one host at a time, each host rate limited by its own token bucket
+#
+import sqlite3
+from collections import deque
+from threading import Condition, Lock
+from time import monotonic
+
+from htmlparse import Host
+
+class TokenBucket:
+    """
+        Rate limiter that allows bursts of up to capacity requests,
+        refilled at rate tokens per second.
+    """
+
+    def __init__(self, rate: float, capacity=1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.tLast = monotonic()
+
+    def _refill(self):
+        t = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (t - self.tLast) * self.rate)
+        self.tLast = t
+
+    def timeUntilToken(self):
+        """
+            Seconds until a token is available, 0 if one is available now.
+        """
+        self._refill()
+        if 1.0 <= self.tokens:
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+    def consume(self):
+        self._refill()
+        self.tokens -= 1.0
+
+class CrawlFrontier:
+    """
+        Bounded, thread safe BFS frontier with one queue per host.
+        get() hands out the next url from whichever host is allowed to be requested soonest,
+        so a slow host never holds up the others.
+    """
+
+    def __init__(self, rates: dict, maxQueue=100000):
+        """
+            rates    - Dict of Host -> max requests per second
+            maxQueue - Max urls waiting across all hosts, extra urls are dropped
+        """
+        self.buckets = {host: TokenBucket(rate) for host, rate in rates.items()}
+        self.queues = {host: deque() for host in rates.keys()}
+        self.seen = set()
+        self.maxQueue = maxQueue
+        self.size = 0
+        self.numDropped = 0
+        self.inFlight = 0
+        self.stopped = False
+        self.cond = Condition(Lock())
+
+    ## Storage, always called with the lock held ##
+
+    def _push(self, url: str, host: Host):
+        if url in self.seen:
+            return False
+        self.seen.add(url)
+        self.queues[host].append(url)
+        return True
+
+    def _seenAgain(self, url: str, host: Host):
+        return url in self.seen
+
+    def _pop(self, host: Host):
+        return self.queues[host].popleft()
+
+    def _hasQueued(self, host: Host):
+        return 0 < len(self.queues[host])
+
+    def _finish(self, url: str, success: bool):
+        pass
+
+    def _flush(self):
+        pass
+
+    ## Public ##
+
+    def put(self, url: str, host: Host):
+        """
+            Queues a url if it has not been seen before.
+            Returns True if the url was queued.
+        """
+        return 0 < self.putMany([url], host)
+
+    def putMany(self, urls, host: Host):
+        """
+            Queues every url that has not been seen before.
+            Returns the number of urls queued. New urls refused by a full queue count as dropped.
+        """
+        numQueued = 0
+        with self.cond:
+            if host not in self.buckets:
+                return 0
+            for url in urls:
+                if self.maxQueue <= self.size:
+                    if not self._seenAgain(url, host):
+                        self.numDropped += 1
+                    continue
+                if self._push(url, host):
+                    self.size += 1
+                    numQueued += 1
+            self._flush()
+            if 0 < numQueued:
+                self.cond.notify_all()
+        return numQueued
+
+    def get(self):
+        """
+            Blocks until a url may be requested.
+            Returns (url, host), or None once the crawl is finished.
+        """
+        with self.cond:
+            while not self.stopped:
+                if self.size == 0:
+                    if self.inFlight == 0:
+                        self.stopped = True
+                        break
+                    self.cond.wait()
+                    continue
+
+                # Pick the host that can be requested soonest
+                waits = {h: bucket.timeUntilToken() for h, bucket in self.buckets.items() if self._hasQueued(h)}
+                host = min(waits.keys(), key=waits.get)
+                wait = waits[host]
+                if wait == 0.0:
+                    self.buckets[host].consume()
+                    self.size -= 1
+                    self.inFlight += 1
+                    return self._pop(host), host
+                self.cond.wait(wait)
+
+            self.cond.notify_all()
+            return None
+
+    def taskDone(self, url=None, success=True):
+        with self.cond:
+            self.inFlight -= 1
+            self._finish(url, success)
+            self.cond.notify_all()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+    def close(self):
+        pass
+
+## ============ ##
+## Persistent   ##
+## ============ ##
+
+QUEUED = 0
+IN_FLIGHT = 1
+DONE = 2
+FAILED = 3
+
+class PersistentFrontier(CrawlFrontier):
+    """
+        CrawlFrontier kept in a SQLite database.
+        The table doubles as the seen-set, so links are checked with an index lookup rather than a file stat.
+        Pages that were in flight when the crawler died are queued again on open.
+    """
+
+    def __init__(self, dbPath: str, rates: dict, maxQueue=100000, prioritize=False):
+        """
+            dbPath     - SQLite file, created if missing
+            rates      - Dict of Host -> max requests per second
+            maxQueue   - Max urls waiting across all hosts, extra urls are dropped
+            prioritize - Hand out the queued urls with the most in-links first, instead of in BFS order
+        """
+        super().__init__(rates, maxQueue)
+        self.prioritize = prioritize
+
+        self.db = sqlite3.connect(dbPath, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS frontier (url TEXT PRIMARY KEY, host INTEGER NOT NULL, state INTEGER NOT NULL, inlinks INTEGER NOT NULL DEFAULT 1)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS frontier_bfs ON frontier (host, state)")
+        if prioritize:
+            self.db.execute("CREATE INDEX IF NOT EXISTS frontier_inlinks ON frontier (host, state, inlinks DESC)")
+
+        # Resume: anything in flight last run never finished
+        self.db.execute("UPDATE frontier SET state = ? WHERE state = ?", (QUEUED, IN_FLIGHT))
+        self.db.commit()
+
+        self.numQueued = {host: 0 for host in rates.keys()}
+        for hostValue, count in self.db.execute("SELECT host, COUNT(*) FROM frontier WHERE state = ? GROUP BY host", (QUEUED,)):
+            host = Host(hostValue)
+            if host in self.numQueued:
+                self.numQueued[host] = count
+        self.size = sum(self.numQueued.values())
+
+        order = "inlinks DESC, rowid" if prioritize else "rowid"
+        self.sqlPop = f"SELECT rowid, url FROM frontier WHERE host = ? AND state = ? ORDER BY {order} LIMIT 1"
+
+    def _push(self, url: str, host: Host):
+        if self.prioritize:
+            cur = self.db.execute("UPDATE frontier SET inlinks = inlinks + 1 WHERE url = ? AND state = ?", (url, QUEUED))
+            if 0 < cur.rowcount:
+                return False
+        cur = self.db.execute("INSERT OR IGNORE INTO frontier (url, host, state) VALUES (?, ?, ?)", (url, host.value, QUEUED))
+        if cur.rowcount == 0:
+            return False
+        self.numQueued[host] += 1
+        return True
+
+    def _seenAgain(self, url: str, host: Host):
+        if self.prioritize:
+            cur = self.db.execute("UPDATE frontier SET inlinks = inlinks + 1 WHERE url = ? AND state = ?", (url, QUEUED))
+            if 0 < cur.rowcount:
+                return True
+        return self.db.execute("SELECT 1 FROM frontier WHERE url = ?", (url,)).fetchone() is not None
+
+    def _pop(self, host: Host):
+        rowid, url = self.db.execute(self.sqlPop, (host.value, QUEUED)).fetchone()
+        self.db.execute("UPDATE frontier SET state = ? WHERE rowid = ?", (IN_FLIGHT, rowid))
+        self.numQueued[host] -= 1
+        return url
+
+    def _hasQueued(self, host: Host):
+        return 0 < self.numQueued[host]
+
+    def _finish(self, url: str, success: bool):
+        if url is not None:
+            self.db.execute("UPDATE frontier SET state = ? WHERE url = ?", (DONE if success else FAILED, url))
+            self.db.commit()
+
+    def _flush(self):
+        self.db.commit()
+
+    def close(self):
+        with self.cond:
+            self.db.commit()
+            self.db.close()
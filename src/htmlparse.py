@@ -1,16 +1,48 @@
 from bs4 import BeautifulSoup
-from urllib.request import urlopen, urlretrieve, Request
-from urllib.error import HTTPError
+from html.parser import HTMLParser
+from html import unescape as html_unescape
 from time import sleep
 from enum import Enum
 import re
 
-USER_AGENT = 'Mozilla/5.0 (Windows; U; Windows NT 5.1; en-US; rv:1.9.0.7) Gecko/2009021910 Firefox/3.0.7'
+from pagestore import openPage, readPage, iterPageChunks
+from fetcher import Fetcher
+from metrics import timer, incr
 
 WIKI_HOST_URL = "https://en.wikipedia.org"
 SOF_HOST_URL = "https://stackoverflow.com"
 MEWE_HOST_URL = "https://www.merriam-webster.com"
 
+# Parser backend used by default when extracting page content
+#   "stream"      - HTMLParser subclass that never builds a tree (fastest)
+#   "html.parser" - BeautifulSoup with the builtin parser
+#   "lxml"        - BeautifulSoup with lxml (needs lxml installed)
+DEFAULT_PARSER = "html.parser"
+
+HEADER_TAGS = ('h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+
+# Everything in a url before any ?arguments or #links
+_URL_BASE = re.compile(r"[^?#]*")
+
+# Attributes of a start tag, the same way HTMLParser tokenizes them (html.parser's tolerant patterns)
+_TAG_ATTRS = r"""(?:[\s/]*(?:(?<=['"\s/])[^\s/>][^\s/=>]*(?:\s*=+\s*(?:'[^']*'|"[^"]*"|(?!['"])[^>\s]*)\s*)?(?:\s|/(?!>))*)*)?\s*"""
+_ATTRS_START = re.compile(r"(?:\s|/(?!>))*")
+_ATTR = re.compile(r"""((?<=['"\s/])[^\s/>][^\s/=>]*)(\s*=+\s*('[^']*'|"[^"]*"|(?!['"])[^>\s]*))?(?:\s|/(?!>))*""")
+
+# One pass over the markup the way HTMLParser tokenizes it, so <a ...> is only found where it is a tag
+#   comments, declarations, processing instructions and end tags  - skipped
+#   start tags, group 1 the tag name (an <a ...> inside an attribute value is skipped along with its tag)
+#   anything left unfinished, skipped to the next > (or the next < if there is none), as HTMLParser.close() does
+# <script> and <style> bodies are raw text, getHrefsFromHTML jumps to their end tag (_RAW_TEXT_END)
+_LINK_SCAN = re.compile(r"""
+      <!--.*?--\s*>
+    | <[!?][^>]*>
+    | </[^>]*>
+    | <([a-zA-Z][^\t\n\r\f />\x00]*)""" + _TAG_ATTRS + r"""/?>
+    | <[a-zA-Z!?/](?:[^>]*>|[^<]*)
+""", re.DOTALL | re.VERBOSE)
+_RAW_TEXT_END = {tag: re.compile(r"</\s*%s\s*>" % tag, re.IGNORECASE) for tag in ('script', 'style')}
+
 class Host(Enum):
     UNK = 0
     WP = 1
@@ -19,96 +51,121 @@ class Host(Enum):
     SOF = 4
     MW = 5
 
-## ========= ##
-## Wikipedia ##
-## ========= ##
+## ===== ##
+## Hosts ##
+## ===== ##
 
-def getPageNameFromURL(url: str, host: Host):
-    if host == Host.WP:
-        return url.split("/")[-1]
-    elif host == Host.ADB:
-        return url.split("/")[-1]
-    elif host == Host.IMDB:
-        return url.split("/")[-2]
-    elif host == Host.SOF:
-        dirs = url.split("/")
-        return f"{dirs[-2]}-{dirs[-1]}"
-    elif host == Host.MW:
-        return url.split("/")[-1]
-    else:
+class HostInfo:
+    """
+        Everything host specific: how urls map to local file names and back,
+        and which links on a page are worth following.
+        Adding a host means adding one entry to HOSTS.
+    """
+
+    def __init__(self, host: Host, hostURL: str, filePrefix: str, fPageName, fURL=None, linkPattern=None):
+        """
+            host        - Host enum
+            hostURL     - Scheme and domain, prepended to relative links
+            filePrefix  - Local file names are f"{filePrefix}-{pageName}.html"
+            fPageName   - url -> page name
+            fURL        - page name -> url (None if pages from this host can't be indexed)
+            linkPattern - Regex a link must match (from its start) to be followed (None if the host can't be crawled)
+        """
+        self.host = host
+        self.hostURL = hostURL
+        self.filePrefix = filePrefix
+        self.fPageName = fPageName
+        self.fURL = fURL
+        self.linkPattern = re.compile(linkPattern) if linkPattern else None
+
+def _sofPageNameFromURL(url: str):
+    dirs = url.split("/")
+    return f"{dirs[-2]}-{dirs[-1]}"
+
+def _sofURLFromPageName(name: str):
+    # 12345123-title-of-question-asdw
+    pageid, _, pagetitle = name.partition('-')
+    return f"{SOF_HOST_URL}/questions/{pageid}/{pagetitle}"
+
+HOSTS = {
+    Host.WP: HostInfo(Host.WP, WIKI_HOST_URL, "wikipedia",
+        lambda url: url.split("/")[-1],
+        lambda name: f"{WIKI_HOST_URL}/wiki/{name}",
+        # only wiki articles, ':' denotes special articles, skip identifier and disambiguation pages
+        r"/wiki/[^:]*\Z(?<!\(identifier\))(?<!\(disambiguation\))"),
+    Host.ADB: HostInfo(Host.ADB, "", "anidb",
+        lambda url: url.split("/")[-1]),
+    Host.IMDB: HostInfo(Host.IMDB, "", "imdb",
+        lambda url: url.split("/")[-2]),
+    Host.SOF: HostInfo(Host.SOF, SOF_HOST_URL, "stackoverflow",
+        _sofPageNameFromURL,
+        _sofURLFromPageName,
+        r"(?:https://stackoverflow\.com)?/questions/\d+/[\w-]+"),
+    Host.MW: HostInfo(Host.MW, MEWE_HOST_URL, "merriamwebster",
+        lambda url: url.split("/")[-1],
+        lambda name: f"{MEWE_HOST_URL}/dictionary/{name}",
+        r"(?:https://www\.merriam-webster\.com)?/dictionary/[\w %]+"),
+}
+HOSTS_BY_FILE_PREFIX = {info.filePrefix: info for info in HOSTS.values()}
+
+def getHostInfo(host: Host):
+    info = HOSTS.get(host)
+    if info is None:
         raise NotImplementedError
+    return info
+
+def getPageNameFromURL(url: str, host: Host):
+    return getHostInfo(host).fPageName(url)
 
 def getFileNameFromPageName(name: str, host: Host):
-    if host == Host.WP:
-        return f"wikipedia-{name}.html"
-    elif host == Host.ADB:
-        return f"anidb-{name}.html"
-    elif host == Host.IMDB:
-        return f"imdb-{name}.html"
-    elif host == Host.SOF:
-        return f"stackoverflow-{name}.html"
-    elif host == Host.MW:
-        return f"merriamwebster-{name}.html"
-    else:
-        raise NotImplementedError
+    return f"{getHostInfo(host).filePrefix}-{name}.html"
 
 def getURLAndHostFromFileName(pagename: str):
     
-    # Determine the weburl from the name
-    webUrl = ""
-    host = Host.UNK
-    if pagename.startswith("wiki"): # wikipedia-title_of_article
-        webUrl = f"{WIKI_HOST_URL}/wiki/{pagename[len('wikipedia-'):]}"
-        host = Host.WP
-    elif pagename.startswith("stackover"):  # stackoverflow-12345123-title-of-question-asdw
-        pageidntitle = pagename[len('stackoverflow-'):]
-        ii = pageidntitle.find('-')
-        pageid = pageidntitle[:ii]
-        pagetitle = pageidntitle[ii+1:]
-        webUrl = f"{SOF_HOST_URL}/questions/{pageid}/{pagetitle}"
-        host = Host.SOF
-    elif pagename.startswith("merriam"):  # merriamwebster-title-of-page-asdw
-        webUrl = f"{MEWE_HOST_URL}/dictionary/{pagename[len('merriamwebster-'):]}"
-        host = Host.MW
-    else:
+    # Determine the weburl from the name (e.g. wikipedia-title_of_article)
+    filePrefix, _, name = pagename.partition('-')
+    info = HOSTS_BY_FILE_PREFIX.get(filePrefix)
+    if info is None or info.fURL is None:
         print(f"\tERROR! No way to determine url for page: \"{pagename}\".")
         raise NotImplementedError
 
-    return webUrl, host
+    return info.fURL(name), info.host
 
 def isValidWikiLink(linkPath: str):
-    #          only wiki articles            : denotes special articles        skip these pages
-    return linkPath.startswith("/wiki/") and ':' not in linkPath and not linkPath.endswith("(identifier)") and not linkPath.endswith("(disambiguation)")
+    return HOSTS[Host.WP].linkPattern.match(linkPath) is not None
 
 def isValidSOFLink(linkPath: str):
-    return re.match(r"https:\/\/stackoverflow\.com\/questions\/\d+\/[\w\d-]+", linkPath) or re.match(r"\/questions\/\d+\/[\w\d-]+", linkPath)
+    return HOSTS[Host.SOF].linkPattern.match(linkPath) is not None
 
 def isValidMeWeLink(linkPath: str):
-    return re.match(r"https:\/\/www\.merriam\-webster\.com\/dictionary\/[\d\w \%]+", linkPath) or re.match(r"\/dictionary\/[\d \w%]+", linkPath)
+    return HOSTS[Host.MW].linkPattern.match(linkPath) is not None
 
 ## ============== ##
 ## Beautiful Soup ##
 ## ============== ##
 
+_fetcher = None
+
+def fetchHTML(url: str, delay=0.0):
+    """
+        Downloads a webpage without parsing it, over a kept-alive connection to its host.
+        Returns the page bytes, None on failure.
+    """
+    global _fetcher
+    if _fetcher is None: _fetcher = Fetcher()
+
+    sleep(delay)    # Force a delay between downloads
+    return _fetcher.fetchBytes(url)
+
 def getSoup(url: str, delay=3.0):
     """
         Gets a accessable datastructure for the given webpage. 
         Returns None on failure.
     """
-    print(f"Making request from \"{url}\".")
-    sleep(delay)    # Force a delay between downloads
-
-    try:
-        req = Request(url, headers={'User-Agent':USER_AGENT})
-        html = urlopen(req).read()
-        soup = BeautifulSoup(html, 'html.parser')
-        return soup, html
-    except HTTPError:
-        print(f"HTTP connection was denied to '{url}'.")
-    except:
-        print(f"Unknown Error in accessing '{url}'.")
-
-    return None, None
+    html = fetchHTML(url, delay)
+    if html is None:
+        return None, None
+    return BeautifulSoup(html, 'html.parser'), html
 
 def getSoupLocal(addr: str):
     """
@@ -117,47 +174,234 @@ def getSoupLocal(addr: str):
         Returns None on failure.
     """
 
-    fp = open(addr, mode='r', encoding='utf-8')
-    soup = BeautifulSoup(fp.read(), 'html.parser')
-    fp.close()
+    with openPage(addr) as fp:
+        soup = BeautifulSoup(fp, 'html.parser')
 
     return soup
 
 def getLinksFromSoup(soup, host: Host):
+    return getLinksFromHrefs((link.get("href") for link in soup.find_all('a')), host)
+
+def getLinksFromHrefs(hrefs, host: Host):
 
     # Determine information based on host
-    hostURL = ""
-    if host == Host.WP:
-        hostURL = WIKI_HOST_URL
-        fLinkValid = isValidWikiLink
-    elif host == Host.SOF:
-        hostURL = SOF_HOST_URL
-        fLinkValid = isValidSOFLink
-    elif host == Host.MW:
-        hostURL = MEWE_HOST_URL
-        fLinkValid = isValidMeWeLink
-    else: 
+    info = getHostInfo(host)
+    if info.linkPattern is None:
         raise NotImplementedError
+    hostURL = info.hostURL
+    fMatch = info.linkPattern.match
 
-    # Read the links from the soup
     # Build a set from the valid links
-    links = soup.find_all('a')
     linkSet = set()
-    for link in links:
+    for linkPath in hrefs:
 
         # Check for valid link
-        linkPath = link.get("href")
-        if linkPath and fLinkValid(linkPath):
-
-            # Trim any ?arguments and #links and prepend the host
-            linkPath = linkPath.split("?")[0]
-            linkPath = linkPath.split("#")[0]
-            linkPath = linkPath.replace(" ", "%20")
+        if linkPath and fMatch(linkPath):
 
-            # Preppend the hostURl if the link does not have it
+            # Trim any ?arguments and #links, encode spaces, and prepend the host if missing
+            linkPath = _URL_BASE.match(linkPath).group().replace(" ", "%20")
             if not linkPath.startswith(hostURL): linkPath = hostURL + linkPath
 
             linkSet.add(linkPath)
 
     return linkSet
-    
\ No newline at end of file
+
+def getHrefsFromHTML(html: str):
+    """
+        Pulls the href of every <a> tag out of the html with one regex scan (see _LINK_SCAN),
+        tokenized like HTMLParser so comments, <script> and <style> bodies and other attributes
+        are skipped the same as by BeautifulSoup (HrefExtractor is the plain HTMLParser version).
+    """
+    hrefs = []
+    pos = 0
+    while True:
+        match = _LINK_SCAN.search(html, pos)
+        if match is None:
+            break
+        pos = match.end()
+        tagName = match.group(1)
+        if tagName is None:
+            continue
+        tagName = tagName.lower()
+        if tagName != 'a' and tagName not in _RAW_TEXT_END:
+            continue
+        tag = match.group()
+        if tagName == 'a' and 'href' not in tag.lower():
+            continue
+
+        # Read the attributes as HTMLParser.parse_starttag does, the last href wins (see _anchorHref).
+        # _ATTR's lookbehind needs the tag name in front of the attributes
+        href = None
+        k = _ATTRS_START.match(tag, 1 + len(tagName)).end()
+        while k < len(tag):
+            m = _ATTR.match(tag, k)
+            if not m:
+                break
+            if tagName == 'a' and m.group(1).lower() == 'href':
+                value = m.group(3)
+                if not m.group(2):
+                    value = None
+                elif value[:1] == "'" == value[-1:] or value[:1] == '"' == value[-1:]:
+                    value = value[1:-1]
+                href = html_unescape(value) if value and '&' in value else value
+            k = m.end()
+
+        # Attributes HTMLParser can't read make the whole tag text, and <script/> has no body
+        end = tag[k:].strip()
+        if end not in (">", "/>"):
+            continue
+        if tagName == 'a':
+            if href is not None:
+                hrefs.append(href)
+        elif end == ">":
+            bodyEnd = _RAW_TEXT_END[tagName].search(html, pos)
+            pos = bodyEnd.end() if bodyEnd else len(html)
+    return hrefs
+
+def getLinksFromHTML(html: str, host: Host):
+    """
+        Same links as getLinksFromSoup, read from the raw html.
+    """
+    with timer("link_extract_seconds"):
+        return getLinksFromHrefs(getHrefsFromHTML(html), host)
+
+## ============ ##
+## Page Content ##
+## ============ ##
+
+class PageContent:
+    """
+        Everything the spider, indexer and nlp need out of a page, from a single parse.
+    """
+
+    def __init__(self):
+        self.title = ""
+        self.headers = []   # Text of each <h1>..<h6>
+        self.texts = []     # Text of each <p>
+        self.hrefs = []     # href of each <a>
+        self.hasHead = False
+
+def _anchorHref(attrs: list):
+    """
+        href of a tag from its HTMLParser attributes, the last one if repeated (as BeautifulSoup keeps), else None.
+    """
+    href = None
+    for name, value in attrs:
+        if name == 'href':
+            href = value
+    return href
+
+class HrefExtractor(HTMLParser):
+    """
+        Streaming parser that only collects the href of each <a>.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.hrefs = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            href = _anchorHref(attrs)
+            if href is not None:
+                self.hrefs.append(href)
+
+class PageExtractor(HTMLParser):
+    """
+        Streaming parser that fills a PageContent without building a tree.
+        Text inside nested captured tags counts toward each of them, the same as soup.find_all(...).text
+    """
+
+    CAPTURE_TAGS = frozenset(('title', 'p') + HEADER_TAGS)
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.content = PageContent()
+        self.openCaptures = []  # [(tag, [text parts])]
+        self.titleDone = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            href = _anchorHref(attrs)
+            if href is not None:
+                self.content.hrefs.append(href)
+        elif tag in self.CAPTURE_TAGS:
+            self.openCaptures.append((tag, []))
+        elif tag == 'head':
+            self.content.hasHead = True
+
+    def handle_data(self, data):
+        for _, parts in self.openCaptures:
+            parts.append(data)
+
+    def handle_endtag(self, tag):
+        if tag not in self.CAPTURE_TAGS:
+            return
+
+        # Close the innermost open tag of this kind (anything opened inside it is closed too)
+        for i in range(len(self.openCaptures) - 1, -1, -1):
+            if self.openCaptures[i][0] == tag:
+                for openTag, parts in self.openCaptures[i:]:
+                    self._emit(openTag, "".join(parts))
+                del self.openCaptures[i:]
+                return
+
+    def _emit(self, tag, text):
+        if tag == 'p':
+            self.content.texts.append(text)
+        elif tag == 'title':
+            if not self.titleDone:
+                self.content.title = text
+                self.titleDone = True
+        else:
+            self.content.headers.append(text)
+
+    def close(self):
+        super().close()
+        for openTag, parts in self.openCaptures:
+            self._emit(openTag, "".join(parts))
+        self.openCaptures = []
+        return self.content
+
+def getPageContentFromSoup(soup):
+    content = PageContent()
+    content.title = (soup.title.string if soup.title else "") or ""
+    content.headers = [header.text for header in soup.find_all(HEADER_TAGS)]
+    content.texts = [text.text for text in soup.find_all('p')]
+    content.hrefs = [link.get("href") for link in soup.find_all('a')]
+    content.hasHead = soup.head != None
+    return content
+
+def getPageContent(html: str, parser=DEFAULT_PARSER):
+    """
+        Parses a page once and returns its PageContent.
+
+        :param html: Page source
+        :param parser: "stream", "html.parser" or "lxml"
+    """
+    if parser == "stream":
+        extractor = PageExtractor()
+        extractor.feed(html)
+        return extractor.close()
+    return getPageContentFromSoup(BeautifulSoup(html, parser))
+
+def readLocalPage(addr: str):
+    """
+        Reads the html of a local webpage (compressed or not, see pagestore.py).
+    """
+    return readPage(addr)
+
+def getPageContentLocal(addr: str, parser=DEFAULT_PARSER):
+    """
+        Gets the PageContent of a local webpage (compressed or not, see pagestore.py).
+        The stream parser is fed as the file is decompressed, the whole page is never in memory.
+    """
+    incr("pages_parsed")
+    with timer("parse_seconds"):
+        if parser == "stream":
+            extractor = PageExtractor()
+            for chunk in iterPageChunks(addr):
+                extractor.feed(chunk)
+            return extractor.close()
+        with openPage(addr) as fp:
+            return getPageContentFromSoup(BeautifulSoup(fp, parser))
@@ -8,15 +8,43 @@
 #     url1: [url1, url3, url22, ...],
 #     ...
 # }
+#
+# NOTE: The indexer now maintains the compact linkgraph format in index/graph/,
+#       appending new pages to it instead of rewriting index.json every tick.
+#       An existing index.json is imported into the graph on first run.
+#
+# NOTE: A manifest of indexed files (index/manifest.db) means only pages that
+#       were added, modified or removed since the last run are processed.
+#
+# NOTE: Pages recorded as duplicates in index/dedup.db (see dedup.py) are left out,
+#       and links to them point at their canonical page instead.
+#
+# NOTE: Links to pages that haven't been indexed yet are kept (index/graph/unresolved.db)
+#       and filled in when the page arrives, see linkgraph.py.
 #  
-from time import time, sleep
 
 import os
-from htmlparse import Host, getSoupLocal, getLinksFromSoup, getURLAndHostFromFileName, WIKI_HOST_URL, SOF_HOST_URL, MEWE_HOST_URL
-from json import dumps as json_dumps
+from htmlparse import readLocalPage, getLinksFromHTML, getURLAndHostFromFileName
 from json import loads as json_loads
-
-def updateWebIndex(htmlPages: list, index: dict):
+from linkgraph import LinkGraph
+from manifest import Manifest, DirectoryWatcher, bumpGeneration
+from dedup import loadCanonicalMap, canonicalizeLinks
+from metrics import logPage, flushMetrics, addMetricsArguments, applyMetricsArguments
+import argparse
+
+def updateWebIndex(htmlPages: list, index, localWebDir="tinyweb/", canonical=None, unresolved=None):
+    """
+        Adds any pages not already in the index.
+
+        :param htmlPages: List of html filenames in the local web directory
+        :param index: Either a dict of url -> list of urls, or a LinkGraph to append to
+        :param localWebDir: Directory the html files are in
+        :param canonical: Dict of duplicate url -> canonical url, duplicates are skipped
+        :param unresolved: linkgraph.UnresolvedLinks for a dict index's links to pages it doesn't have yet (see addPagesToIndex)
+    """
+
+    newPages = {}
+    canonical = canonical or {}
 
     # Fill index for each url
     for htmlPage in htmlPages:
@@ -29,62 +57,169 @@ def updateWebIndex(htmlPages: list, index: dict):
             # Determine the weburl from the name
             url, host = getURLAndHostFromFileName(pagename)
 
-            if url not in index.keys():
-                print(f"[Index] Adding \"{htmlPage}\"") 
+            if url in canonical:
+                logPage(f"[Index] Skipping duplicate \"{htmlPage}\"")
 
-                # Get the links from the page
-                soup = getSoupLocal(htmlPath)
-                links = getLinksFromSoup(soup, host)
-                index[url] = links
+            elif url not in index and url not in newPages:
+                logPage(f"[Index] Adding \"{htmlPage}\"") 
 
-        else:
-            print(f"Skipping non-html file: \"{htmlPage}\"")
+                # Get the links from the page, only the anchors are needed so the page isnt parsed
+                newPages[url] = canonicalizeLinks(getLinksFromHTML(readLocalPage(htmlPath), host), canonical)
 
-    # Remove links that arent in the tiny-web
-    urls = set(index.keys())
-    for url in urls:
-        index[url] = list(set(index[url]).intersection(urls))
+        else:
+            logPage(f"Skipping non-html file: \"{htmlPage}\"")
+
+    addPagesToIndex(index, newPages, unresolved)
+    if newPages: bumpGeneration()
+
+def addPagesToIndex(index, newPages: dict, unresolved=None):
+    """
+        Adds pages to the index. Links to pages not in the index yet are kept aside
+        and filled in when the page arrives, the cost is the links added, not the size of the index.
+
+        :param index: Either a dict of url -> list of urls, or a LinkGraph to append to
+        :param newPages: Dict of url -> links of the pages to add
+        :param unresolved: linkgraph.UnresolvedLinks to keep the dict index's pending links in
+                           (a LinkGraph keeps its own, without one a dict index drops them)
+    """
+
+    # The link graph keeps the links it can't resolve yet as it appends
+    if isinstance(index, LinkGraph):
+        index.addPages(newPages)
+        return
+
+    # Only the new pages' links need checking, every other page's were checked when it was added
+    newPages = {url: links for url, links in newPages.items() if url not in index}
+    index.update((url, []) for url in newPages.keys())
+    pending = []
+    for url, links in newPages.items():
+        links = set(links)
+        index[url] = [link for link in links if link in index]
+        pending.extend((url, link) for link in links if link not in index)
+
+    if unresolved is not None:
+        unresolved.add(pending)
+        for source, target in unresolved.resolve(newPages.keys()):
+            if source in index and target not in index[source]:
+                index[source].append(target)
+
+def reindexWebPages(modifiedPages: list, removedPages: list, index, localWebDir="tinyweb/", canonical=None, unresolved=None):
+    """
+        Re-reads the links of modified pages and drops removed pages (and links to them).
+
+        :param modifiedPages: List of html filenames that changed since they were indexed
+        :param removedPages: List of html filenames that no longer exist
+        :param index: Either a dict of url -> list of urls, or a LinkGraph
+        :param canonical: Dict of duplicate url -> canonical url, duplicates are dropped from the index
+        :param unresolved: linkgraph.UnresolvedLinks of a dict index (see replacePagesInIndex)
+    """
+
+    pages = {}
+    canonical = canonical or {}
+    removeURLs = set()
+    for htmlPage in modifiedPages:
+        if htmlPage.endswith(".html"):
+            url, host = getURLAndHostFromFileName(htmlPage[:-5])
+            if url in canonical:
+                removeURLs.add(url)
+                continue
+            logPage(f"[Index] Updating \"{htmlPage}\"")
+            pages[url] = canonicalizeLinks(getLinksFromHTML(readLocalPage(f"{localWebDir}/{htmlPage}"), host), canonical)
+
+    for htmlPage in removedPages:
+        if htmlPage.endswith(".html"):
+            logPage(f"[Index] Removing \"{htmlPage}\"")
+            removeURLs.add(getURLAndHostFromFileName(htmlPage[:-5])[0])
+
+    replacePagesInIndex(index, pages, removeURLs, unresolved)
+    if pages or removeURLs: bumpGeneration()
+
+def replacePagesInIndex(index, pages: dict, removeURLs: set, unresolved=None):
+    """
+        Replaces the links of pages in the index and removes removeURLs along with links to them.
+        Like the LinkGraph, with unresolved a dict index keeps links to removed pages, so they come back if the page does.
+
+        :param unresolved: linkgraph.UnresolvedLinks of the dict index (see addPagesToIndex)
+    """
+
+    if isinstance(index, LinkGraph):
+        index.replacePages(pages, removeURLs)
+        return
+
+    # Replaced and removed pages' own unresolved links go, new pages pick up the links waiting on them
+    if unresolved is not None:
+        unresolved.removeSources(list(pages.keys()) + list(removeURLs))
+    newURLs = [url for url in pages.keys() if url not in index and url not in removeURLs]
+
+    # Links to removed pages have to be looked for everywhere, replaced pages only need their own checked
+    removeURLs = {url for url in removeURLs if url in index}
+    for url in removeURLs:
+        del index[url]
+    index.update((url, []) for url in pages.keys() if url not in removeURLs)
+    pending = []
+    for url, links in pages.items():
+        if url not in removeURLs:
+            links = set(links)
+            index[url] = [link for link in links if link in index]
+            pending.extend((url, link) for link in links if link not in index)
+    if removeURLs:
+        for url, links in index.items():
+            if not removeURLs.isdisjoint(links):
+                pending.extend((url, link) for link in links if link in removeURLs)
+                index[url] = [link for link in links if link not in removeURLs]
+
+    if unresolved is not None:
+        unresolved.add(pending)
+        for source, target in unresolved.resolve(newURLs):
+            if source in index and target not in index[source]:
+                index[source].append(target)
 
 if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    addMetricsArguments(parser)
+    applyMetricsArguments(parser.parse_args())
     
     localWebDir = "tinyweb/"
     indexDir = "index/"
     indexPath = f"{indexDir}/index.json"
+    graphDir = f"{indexDir}/graph"
+    manifestPath = f"{indexDir}/manifest.db"
+    dedupPath = f"{indexDir}/dedup.db"
     pollingRate = 10
 
-    # Initialize index (read off file is file is there)
-    index = {}
-    if os.path.exists(indexPath):
+    if not os.path.exists(indexDir):
+        print(f"[Index]\tERROR! Cannot reach output index/ directory: \"{indexDir}\".")
+        exit(1)
+    if not os.path.exists(localWebDir):
+        print(f"[Index]\tERROR! Cannot see local web directory: \"{localWebDir}\".")
+        exit(1)
+
+    # Initialize index (import the legacy json index if the graph is new)
+    index = LinkGraph(graphDir)
+    if len(index) == 0 and os.path.exists(indexPath):
         with open(indexPath, mode='r') as fp:
-            index = json_loads(fp.read())
+            index.addPages(json_loads(fp.read()))
 
-    # Run every pollingRate seconds,
-    # check for updates to the tinyweb
-    # If new files present, update the index
-    htmlPagesPrev = set()
+    # Wait for changes to the tinyweb (inotify if available, else every pollingRate seconds)
+    # Only the pages added, modified or removed since they were last indexed are processed
+    manifest = Manifest(manifestPath)
+    watcher = DirectoryWatcher(localWebDir, pollingRate)
     while True:
+        changedPages = watcher.wait()
         print("[Index] Tick.")
-        if os.path.exists(indexDir):
-            if os.path.exists(localWebDir):
-
-                # Check for changes 
-                htmlPages = set(os.listdir(localWebDir))
-                if 0 < len(htmlPages.intersection(htmlPagesPrev)):
-                    print("[Index] Changes to web.")
-                    updateWebIndex(htmlPages, index)
-
-                # Save the index information 
-                with open(indexPath, mode='w') as fp:
-                    fp.write(json_dumps(index))
-
-                htmlPagesPrev = htmlPages
-
-                sleep(pollingRate)
+        if os.path.exists(localWebDir):
+
+            # Check for changes 
+            added, modified, removed = manifest.scan(localWebDir, changedPages)
+            if added or modified or removed:
+                print(f"[Index] Changes to web: {len(added)} added, {len(modified)} modified, {len(removed)} removed.")
+                canonical = loadCanonicalMap(dedupPath)
+                updateWebIndex(added, index, localWebDir, canonical)
+                reindexWebPages(modified, removed, index, localWebDir, canonical)
+                manifest.commit()
+                flushMetrics()
 
-            else:
-                print(f"[Index]\tERROR! Cannot see local web directory: \"{localWebDir}\".")
-                break
         else:
-            print(f"[Index]\tERROR! Cannot reach output index/ directory: \"{localWebDir}\".")
+            print(f"[Index]\tERROR! Cannot see local web directory: \"{localWebDir}\".")
             break
-    
\ No newline at end of file
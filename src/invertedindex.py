@@ -0,0 +1,486 @@
+# ====================================================================
+# Builds an inverted index from the term frequency cache (term-freq/*.json or a tfstore)
+#
+# Stored as a directory of flat files
+#   docs.txt      - One url per line, line i is the url of doc id i
+#   doclens.npy   - int32[numDocs, 3], lemmas in the (title, header, text) of each doc
+#   lexicon.tsv   - term \t docFreq \t offset \t numBytes [\t posOffset \t posNumBytes], one line per term
+#   postings.bin  - Varint encoded postings, each term's block is at [offset, offset+numBytes)
+#   positions.bin - Varint encoded positions, each term's block is at [posOffset, posOffset+posNumBytes)
+#                   (only when every page's term frequencies have positions, see nlp.py --positions)
+#   blocks.bin    - One (lastDocId int64, byteEnd int64, maxTF float64) per BLOCK_SIZE postings of each term, in lexicon order
+#
+# A term's postings are the docs it appears in (any field), in doc id order,
+# each as 4 varints: (doc id gap, title tf, header tf, text tf)
+#
+# Postings are cut into blocks of BLOCK_SIZE docs. A block ends at byteEnd (from the term's offset)
+# and its first gap is from the last doc of the block before, so any block decodes on its own.
+# maxTF is the largest BM25F tf in the block, sum over fields of weight * tf / (1 - b + b*len/avglen),
+# with BLOCK_FIELD_WEIGHTS and BLOCK_B, which lets search.py skip the blocks that can't reach the top k
+#
+# A term's positions follow its postings, for each doc the title, header then text
+# positions, as gaps from the previous position in the same field (the first one as is).
+# How many there are of each is the tf in the postings, so no counts are stored
+#
+import os
+import argparse
+import numpy as np
+from json import loads as json_loads
+
+# Fields in the order they are stored in postings and doclens, the same as the term freq store
+from tfstore import TermFreqStore, FIELDS, FIELD_LENGTHS, FIELD_POSITIONS
+from dedup import loadCanonicalMap
+
+DOCS_FILE = "docs.txt"
+DOCLENS_FILE = "doclens.npy"
+LEXICON_FILE = "lexicon.tsv"
+POSTINGS_FILE = "postings.bin"
+POSITIONS_FILE = "positions.bin"
+BLOCKS_FILE = "blocks.bin"
+BLOCK_SIZE = 128
+BLOCK_DTYPE = np.dtype([("lastDocId", "<i8"), ("byteEnd", "<i8"), ("maxTF", "<f8")])
+BLOCK_FIELD_WEIGHTS = (3.0, 2.0, 1.0)
+BLOCK_B = 0.75
+
+## ======= ##
+## Varints ##
+## ======= ##
+
+def varintLengths(values: np.ndarray):
+    """
+        Returns the bytes encodeVarints takes for each value, as int64.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    numBytes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        numBytes += rest != 0
+        rest >>= np.uint64(7)
+    return numBytes
+
+def encodeVarints(values: np.ndarray):
+    """
+        LEB128 encodes an array of non-negative integers, 7 bits per byte,
+        high bit set on every byte but the last of each value.
+        Returns a uint8 array.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.uint8)
+
+    # Bytes needed per value
+    numBytes = varintLengths(values)
+
+    maxBytes = int(numBytes.max())
+    k = np.arange(maxBytes, dtype=np.uint64)
+    groups = ((values[:, None] >> (np.uint64(7) * k)) & np.uint64(0x7f)).astype(np.uint8)
+    groups[np.arange(maxBytes)[None, :] < (numBytes[:, None] - 1)] |= 0x80
+
+    # Keep only the bytes each value actually uses, in order
+    mask = np.arange(maxBytes)[None, :] < numBytes[:, None]
+    return groups[mask]
+
+def decodeVarints(data: np.ndarray):
+    """
+        Decodes a uint8 array written by encodeVarints.
+        Returns a uint64 array.
+    """
+    data = np.asarray(data, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.uint64)
+
+    # Most values fit in a byte, so only the bytes with the high bit set need more than a mask
+    continued = np.flatnonzero(0x80 <= data)
+    values = (data & 0x7f).astype(np.uint64)
+    if len(continued) == 0:
+        return values
+
+    # Each run of continued bytes and the byte after it is one value, gathered into the run's first byte
+    runStarts = np.ones(len(continued), dtype=bool)
+    runStarts[1:] = continued[1:] != continued[:-1] + 1
+    firsts = continued[runStarts]
+    lengths = np.diff(np.append(np.flatnonzero(runStarts), len(continued)))
+    longer = np.arange(len(firsts))
+    shift = 1
+    while len(longer):
+        values[firsts[longer]] |= values[firsts[longer] + shift] << np.uint64(7 * shift)
+        longer = longer[shift < lengths[longer]]
+        shift += 1
+
+    keep = np.ones(len(data), dtype=bool)
+    keep[continued + 1] = False
+    return values[keep]
+
+## ======== ##
+## Building ##
+## ======== ##
+
+def buildInvertedIndex(termFreqDir: str, invertedDir: str, skipURLs=()):
+    """
+        Merges every term frequency json in termFreqDir into an inverted index in invertedDir.
+        Returns the number of docs indexed.
+
+        :param skipURLs: Urls to leave out of the index (e.g. duplicates, see dedup.py)
+    """
+
+    if not os.path.exists(invertedDir): os.makedirs(invertedDir)
+
+    # Doc ids follow the sorted file names, so postings are built in doc id order
+    jsonFiles = sorted(f for f in os.listdir(termFreqDir) if f.endswith(".json"))
+
+    urls = []
+    docLens = np.zeros((len(jsonFiles), len(FIELDS)), dtype=np.int32)
+    postings = {}   # term -> [docId, titleTF, headerTF, textTF, docId, ...]
+    positions = {}  # term -> [title positions..., header positions..., text positions..., next doc...]
+    for jsonFile in jsonFiles:
+        with open(f"{termFreqDir}/{jsonFile}", mode='r') as fp:
+            pageIndex = json_loads(fp.read())
+        if pageIndex["url"] in skipURLs:
+            continue
+        docId = len(urls)
+        urls.append(pageIndex["url"])
+        docLens[docId] = [pageIndex[field] for field in FIELD_LENGTHS]
+
+        # Per field counts for every term on the page
+        termCounts = {}
+        for f, field in enumerate(FIELDS):
+            for term, count in pageIndex[field].items():
+                if term not in termCounts:
+                    termCounts[term] = [0, 0, 0]
+                termCounts[term][f] = count
+
+        for term, counts in termCounts.items():
+            if term not in postings:
+                postings[term] = []
+            postings[term].append(docId)
+            postings[term].extend(counts)
+
+        # Positions are only indexed if every page has them
+        if positions is not None and FIELD_POSITIONS[0] not in pageIndex:
+            if 0 < docId:
+                print(f"[Inverted]\tWarning! \"{jsonFile}\" has no positions, not writing {POSITIONS_FILE}.")
+            positions = None
+        if positions is not None:
+            for term in termCounts.keys():
+                if term not in positions:
+                    positions[term] = []
+                for posField in FIELD_POSITIONS:
+                    positions[term].extend(pageIndex[posField].get(term, ()))
+
+    writeInvertedIndex(invertedDir, urls, docLens[:len(urls)], postings, positions)
+    return len(urls)
+
+def buildInvertedIndexFromStore(storeDir: str, invertedDir: str, skipURLs=()):
+    """
+        Same as buildInvertedIndex, reading a TermFreqStore with one sequential scan instead of json files.
+        Returns the number of docs indexed.
+    """
+
+    if not os.path.exists(invertedDir): os.makedirs(invertedDir)
+    store = TermFreqStore(storeDir)
+
+    urls = []
+    docLens = np.zeros((len(store), len(FIELDS)), dtype=np.int32)
+    postings = {}   # term id -> [docId, titleTF, headerTF, textTF, docId, ...]
+    positions = {}  # term id -> [title positions array, header positions array, text positions array, next doc...]
+    for url, fields, lengths, fieldPositions in store.scan(positions=True):
+        if url in skipURLs:
+            continue
+        docId = len(urls)
+        urls.append(url)
+        docLens[docId] = lengths
+
+        # Per field counts for every term on the page
+        termIds = np.unique(np.concatenate([ids for ids, _ in fields]))
+        counts = np.zeros((len(termIds), len(FIELDS)), dtype=np.int64)
+        for f, (ids, fieldCounts) in enumerate(fields):
+            counts[np.searchsorted(termIds, ids), f] = fieldCounts
+
+        for termId, termCounts in zip(termIds.tolist(), counts.tolist()):
+            if termId not in postings:
+                postings[termId] = []
+            postings[termId].append(docId)
+            postings[termId].extend(termCounts)
+
+        # Positions are only indexed if every page has them
+        if positions is not None and fieldPositions is None:
+            if 0 < docId:
+                print(f"[Inverted]\tWarning! \"{url}\" has no positions, not writing {POSITIONS_FILE}.")
+            positions = None
+        if positions is not None:
+            # Each field's positions are grouped by term in the order of its ids, sort the groups by term id
+            # and append them in term id order, every term's three fields line up with its tfs
+            groups = [[] for _ in termIds]
+            for (ids, fieldCounts), flat in zip(fields, fieldPositions):
+                rows = np.searchsorted(termIds, ids).tolist()
+                for row, termPositions in zip(rows, np.split(flat, np.cumsum(fieldCounts)[:-1]) if len(ids) else ()):
+                    groups[row].append(termPositions)
+            for termId, termGroups in zip(termIds.tolist(), groups):
+                if termId not in positions:
+                    positions[termId] = []
+                positions[termId].extend(termGroups)
+
+    writeInvertedIndex(invertedDir, urls, docLens[:len(urls)], {store.terms[termId]: p for termId, p in postings.items()},
+                       {store.terms[termId]: np.concatenate(p) for termId, p in positions.items()} if positions is not None else None)
+    return len(urls)
+
+def encodePositions(positions: np.ndarray, groupLengths: np.ndarray):
+    """
+        Varint encodes the positions of one term, as gaps within each (doc, field) group.
+
+        :param positions: Every position, group after group, increasing within a group
+        :param groupLengths: Positions in each group (the term's tfs, flattened)
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    gaps = positions.copy()
+    gaps[1:] -= positions[:-1]
+    firsts = (np.cumsum(groupLengths) - groupLengths)[0 < groupLengths]
+    gaps[firsts] = positions[firsts]
+    return encodeVarints(gaps)
+
+def lengthNorms(docLens: np.ndarray, b: float):
+    """
+        Per doc, per field BM25 length normalization (1 - b + b*len/avglen).
+    """
+    docLens = np.asarray(docLens, dtype=np.float64)
+    avgLens = docLens.mean(axis=0) if 0 < len(docLens) else np.zeros(len(FIELDS))
+    return (1.0 - b) + b * (docLens / np.where(0 < avgLens, avgLens, 1.0))
+
+def blockRows(block: np.ndarray, lengthNorm: np.ndarray):
+    """
+        Returns the blocks.bin rows of one term's postings (n x 4, absolute doc ids),
+        lengthNorm is lengthNorms(docLens, BLOCK_B).
+    """
+    starts = np.arange(0, len(block), BLOCK_SIZE)
+    ends = np.minimum(starts + BLOCK_SIZE, len(block)) - 1
+    docIds = block[:, 0].astype(np.int64)
+    rows = np.empty(len(starts), dtype=BLOCK_DTYPE)
+    rows["lastDocId"] = docIds[ends]
+
+    # Gaps as written, then the bytes each posting takes
+    gaps = docIds.copy()
+    gaps[1:] -= docIds[:-1]
+    postingBytes = varintLengths(gaps) + varintLengths(block[:, 1:].ravel()).reshape(-1, 3).sum(axis=1)
+    rows["byteEnd"] = np.cumsum(postingBytes)[ends]
+
+    tf = (block[:, 1:].astype(np.float64) / lengthNorm[docIds]) @ np.asarray(BLOCK_FIELD_WEIGHTS)
+    rows["maxTF"] = np.maximum.reduceat(tf, starts)
+    return rows
+
+def writeInvertedIndex(invertedDir: str, urls: list, docLens: np.ndarray, postings: dict, positions=None):
+    """
+        Writes an inverted index.
+
+        :param postings: Dict of term -> flat list [docId, titleTF, headerTF, textTF, ...] in doc id order
+        :param positions: Dict of term -> flat list of its positions, per doc the title, header then text ones
+                          (None to not write positions.bin)
+    """
+
+    with open(f"{invertedDir}/{DOCS_FILE}", mode='w', encoding='utf-8') as fp:
+        fp.write("".join(f"{url}\n" for url in urls))
+    np.save(f"{invertedDir}/{DOCLENS_FILE}", docLens)
+
+    positionsPath = f"{invertedDir}/{POSITIONS_FILE}"
+    if positions is None and os.path.exists(positionsPath):
+        os.remove(positionsPath)
+    lengthNorm = lengthNorms(docLens, BLOCK_B)
+
+    offset = 0
+    posOffset = 0
+    lexicon = []
+    with open(f"{invertedDir}/{POSTINGS_FILE}", mode='wb') as fp, open(positionsPath if positions is not None else os.devnull, mode='wb') as posFp, \
+         open(f"{invertedDir}/{BLOCKS_FILE}", mode='wb') as blocksFp:
+        for term in sorted(postings.keys()):
+            block = np.asarray(postings[term], dtype=np.uint64).reshape(-1, 4)
+            if positions is not None:
+                posData = encodePositions(positions[term], block[:, 1:].ravel().astype(np.int64))
+            blockRows(block, lengthNorm).tofile(blocksFp)
+            block[1:, 0] = np.diff(block[:, 0])
+            data = encodeVarints(block.ravel())
+            fp.write(data.tobytes())
+            if positions is None:
+                lexicon.append(f"{term}\t{len(block)}\t{offset}\t{len(data)}\n")
+            else:
+                posFp.write(posData.tobytes())
+                lexicon.append(f"{term}\t{len(block)}\t{offset}\t{len(data)}\t{posOffset}\t{len(posData)}\n")
+                posOffset += len(posData)
+            offset += len(data)
+
+    with open(f"{invertedDir}/{LEXICON_FILE}", mode='w', encoding='utf-8') as fp:
+        fp.write("".join(lexicon))
+
+## ======= ##
+## Reading ##
+## ======= ##
+
+class InvertedIndex:
+    """
+        Read-only handle on an inverted index directory.
+        Postings are memory mapped, so a lookup only touches the bytes of that term.
+    """
+
+    def __init__(self, invertedDir: str):
+        self.invertedDir = invertedDir
+
+        with open(f"{invertedDir}/{DOCS_FILE}", mode='r', encoding='utf-8') as fp:
+            self.urls = fp.read().splitlines()
+        self.docLens = np.load(f"{invertedDir}/{DOCLENS_FILE}", mmap_mode='r')
+        self.numDocs = len(self.urls)
+        self.avgDocLens = self.docLens.mean(axis=0) if 0 < self.numDocs else np.zeros(len(FIELDS))
+
+        self.lexicon = {}
+        self.positionLexicon = {}   # term -> (posOffset, posNumBytes), empty without positions.bin
+        self.blockLexicon = {}      # term -> first row of its blocks in blocks.bin
+        numBlocks = 0
+        with open(f"{invertedDir}/{LEXICON_FILE}", mode='r', encoding='utf-8') as fp:
+            for line in fp:
+                columns = line.rstrip("\n").split("\t")
+                term, docFreq, offset, numBytes = columns[:4]
+                self.lexicon[term] = (int(docFreq), int(offset), int(numBytes))
+                if 6 <= len(columns):
+                    self.positionLexicon[term] = (int(columns[4]), int(columns[5]))
+                self.blockLexicon[term] = numBlocks
+                numBlocks += -(-int(docFreq) // BLOCK_SIZE)
+
+        postingsPath = f"{invertedDir}/{POSTINGS_FILE}"
+        if 0 < os.path.getsize(postingsPath):
+            self.postings = np.memmap(postingsPath, dtype=np.uint8, mode='r')
+        else:
+            self.postings = np.zeros(0, dtype=np.uint8)
+
+        positionsPath = f"{invertedDir}/{POSITIONS_FILE}"
+        self.hasPositions = os.path.exists(positionsPath)
+        if self.hasPositions and 0 < os.path.getsize(positionsPath):
+            self.positions = np.memmap(positionsPath, dtype=np.uint8, mode='r')
+        else:
+            self.positions = np.zeros(0, dtype=np.uint8)
+
+        # Indexes written before blocks.bin are only searched exhaustively
+        blocksPath = f"{invertedDir}/{BLOCKS_FILE}"
+        self.hasBlocks = os.path.exists(blocksPath) and os.path.getsize(blocksPath) == numBlocks * BLOCK_DTYPE.itemsize
+        if self.hasBlocks and 0 < numBlocks:
+            self.blocks = np.memmap(blocksPath, dtype=BLOCK_DTYPE, mode='r')
+        else:
+            self.blocks = np.zeros(0, dtype=BLOCK_DTYPE)
+
+    def docFreq(self, term: str):
+        entry = self.lexicon.get(term)
+        return entry[0] if entry else 0
+
+    def getPostings(self, term: str):
+        """
+            Returns (docIds, tfs) for a term
+            docIds - int64[docFreq], increasing
+            tfs    - int64[docFreq, 3], (title, header, text) term frequency in each doc
+        """
+        entry = self.lexicon.get(term)
+        if entry is None:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, len(FIELDS)), dtype=np.int64)
+
+        _, offset, numBytes = entry
+        block = decodeVarints(self.postings[offset:offset + numBytes]).astype(np.int64).reshape(-1, 4)
+        return np.cumsum(block[:, 0]), block[:, 1:]
+
+    def getBlocks(self, term: str):
+        """
+            Returns the blocks.bin rows of a term, BLOCK_DTYPE[numBlocks] (see the top of this file).
+            Raises ValueError if the index has no blocks.
+        """
+        if not self.hasBlocks:
+            raise ValueError(f"No {BLOCKS_FILE} in \"{self.invertedDir}\", rebuild the inverted index")
+
+        entry = self.lexicon.get(term)
+        if entry is None:
+            return np.zeros(0, dtype=BLOCK_DTYPE)
+        row = self.blockLexicon[term]
+        return np.asarray(self.blocks[row:row - (-entry[0] // BLOCK_SIZE)])
+
+    def getBlockPostings(self, term: str, blocks: np.ndarray, blockIds: np.ndarray):
+        """
+            Returns (docIds, tfs) as getPostings, but only decodes the given blocks of a term.
+
+            :param blocks: The term's getBlocks rows
+            :param blockIds: Increasing indexes into blocks
+        """
+        docFreq, offset, _ = self.lexicon[term]
+        blockIds = np.asarray(blockIds, dtype=np.int64)
+        if len(blockIds) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, len(FIELDS)), dtype=np.int64)
+
+        # Runs of consecutive blocks are consecutive bytes
+        byteEnds = blocks["byteEnd"]
+        runStarts = np.flatnonzero(np.diff(blockIds, prepend=-2) != 1)
+        runEnds = np.append(runStarts[1:], len(blockIds)) - 1
+        byteStarts = offset + np.where(0 < blockIds[runStarts], byteEnds[blockIds[runStarts] - 1], 0)
+        byteLengths = offset + byteEnds[blockIds[runEnds]] - byteStarts
+
+        # Gather the bytes of every run, by slices for a few runs, else by index, then decode them in one go
+        if len(runStarts) <= 16:
+            data = np.concatenate([self.postings[start:start + length] for start, length in zip(byteStarts, byteLengths)])
+        else:
+            firstBytes = np.cumsum(byteLengths) - byteLengths
+            data = self.postings[np.arange(byteLengths.sum()) + np.repeat(byteStarts - firstBytes, byteLengths)]
+        block = decodeVarints(data).astype(np.int64).reshape(-1, 4)
+
+        # Each block's first gap is from the last doc of the block before, make it from the last doc decoded
+        counts = np.minimum(docFreq - blockIds * BLOCK_SIZE, BLOCK_SIZE)
+        firsts = np.cumsum(counts) - counts
+        lastDocIds = blocks["lastDocId"]
+        block[firsts, 0] += np.where(0 < blockIds, lastDocIds[blockIds - 1], 0)
+        block[firsts[1:], 0] -= lastDocIds[blockIds[:-1]]
+        return np.cumsum(block[:, 0]), block[:, 1:]
+
+    def getPositions(self, term: str):
+        """
+            Returns (docIds, tfs, positions, starts) for a term
+            docIds, tfs - As getPostings
+            positions   - int64[sum of tfs], every position of the term
+            starts      - int64[docFreq * 3 + 1], the positions of field f in the i-th doc are
+                          positions[starts[3*i + f]:starts[3*i + f + 1]], increasing
+            Raises ValueError if the index has no positions.
+        """
+        if not self.hasPositions:
+            raise ValueError(f"No {POSITIONS_FILE} in \"{self.invertedDir}\", build the term frequencies with positions (nlp.py --positions)")
+
+        docIds, tfs = self.getPostings(term)
+        lengths = tfs.ravel()
+        starts = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=starts[1:])
+        if len(docIds) == 0:
+            return docIds, tfs, np.zeros(0, dtype=np.int64), starts
+
+        # Undo the gaps, restarting the running sum at the first position of every group
+        posOffset, posNumBytes = self.positionLexicon[term]
+        gaps = decodeVarints(self.positions[posOffset:posOffset + posNumBytes]).astype(np.int64)
+        sums = np.cumsum(gaps)
+        firsts = starts[:-1][0 < lengths]
+        bases = sums[firsts] - gaps[firsts]
+        return docIds, tfs, sums - np.repeat(bases, lengths[0 < lengths]), starts
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--termFreqDir", help="Directory of the term frequency cache", type=str, default="term-freq/")
+    parser.add_argument("-o", "--invertedDir", help="Directory to write the inverted index to", type=str, default="index/inverted/")
+    parser.add_argument("-d", "--dedupPath", help="Leave out the duplicates recorded in this dedup db", type=str, default="index/dedup.db")
+    parser.add_argument("-s", "--store", help="Read the binary term frequency store (termFreqDir/store/) instead of json files", action="store_true")
+    parser.add_argument("-g", "--publish", help="Then publish the index as a new generation of this index directory, for server.py", type=str, default=None)
+    parser.add_argument("-e", "--eigenRankPath", help="Eigenranking file to publish with the index", type=str, default="index/eigenranking.txt")
+    parser.add_argument("-r", "--personalizedDir", help="Personalized rankings to publish with the index (see eigenranking.py --hosts / --topics)", type=str, default="index/personalized")
+    args = parser.parse_args()
+
+    duplicates = loadCanonicalMap(args.dedupPath)
+    if os.path.exists(args.termFreqDir) and args.store:
+        numDocs = buildInvertedIndexFromStore(f"{args.termFreqDir}/store", args.invertedDir, duplicates)
+        print(f"[Inverted] Indexed {numDocs} docs into \"{args.invertedDir}\".")
+    elif os.path.exists(args.termFreqDir):
+        numDocs = buildInvertedIndex(args.termFreqDir, args.invertedDir, duplicates)
+        print(f"[Inverted] Indexed {numDocs} docs into \"{args.invertedDir}\".")
+    else:
+        print(f"[Inverted]\tERROR! Cannot see term frequency directory: \"{args.termFreqDir}\".")
+        exit(1)
+
+    if args.publish:
+        from search import publishGeneration
+        generationDir = publishGeneration(args.publish, args.invertedDir, args.eigenRankPath, personalizedDir=args.personalizedDir)
+        print(f"[Inverted] Published \"{generationDir}\".")
@@ -0,0 +1,369 @@
+# ====================================================================
+# Compact on-disk format for the link map of the tiny-web
+#
+# Stored as a directory of flat files, rows in CSR layout
+#   urls.txt     - One url per line, line i is the url of page id i
+#   offsets.bin  - int64[numPages + 1], row i spans targets[offsets[i]:offsets[i+1]]
+#   targets.bin  - int32[numLinks], page ids linked to from each row
+#   extra.bin    - int32[numExtra, 2], (source, target) links found after the source's row was written
+#   unresolved.db - SQLite, out-links to pages not in the graph yet, keyed by target url
+#
+# All files are append-only so new pages can be added without
+# rewriting the graph, and readers can np.memmap the arrays directly.
+# Writes go targets -> offsets -> urls, so a reader only ever trusts
+# rows that have a url, and anything past that is trimmed on open.
+#
+# A link to a page that hasn't been crawled yet is kept as unresolved. When the
+# page is added, only the links waiting on it are resolved (appended to extra.bin),
+# so adding pages costs the links they add, not the size of the graph. loadLinkGraph
+# folds the extra links into the rows, and they are compacted into the rows once
+# there are more than COMPACT_RATIO of them.
+#
+import os
+import shutil
+import sqlite3
+import numpy as np
+
+from metrics import timer
+
+URLS_FILE = "urls.txt"
+OFFSETS_FILE = "offsets.bin"
+TARGETS_FILE = "targets.bin"
+EXTRA_FILE = "extra.bin"
+UNRESOLVED_FILE = "unresolved.db"
+
+OFFSET_DTYPE = np.int64
+TARGET_DTYPE = np.int32
+
+# Extra links, as a fraction of the links in the rows, that trigger a compaction
+COMPACT_RATIO = 0.25
+
+def _memmapArray(path: str, dtype, count: int):
+    """
+        Memory maps the first count elements of a raw array file.
+        np.memmap refuses empty files, so those get a plain empty array.
+    """
+    if count <= 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(count,))
+
+def _readURLs(graphDir: str):
+    urlsPath = f"{graphDir}/{URLS_FILE}"
+    if not os.path.exists(urlsPath):
+        return []
+    with open(urlsPath, mode='r', encoding='utf-8') as fp:
+        return fp.read().splitlines()
+
+def _readExtra(graphDir: str, numPages: int):
+    """
+        Returns the (source, target) links of extra.bin as an int64[numExtra, 2] array,
+        leaving out any to or from a row that was never committed.
+    """
+    extraPath = f"{graphDir}/{EXTRA_FILE}"
+    if not os.path.exists(extraPath):
+        return np.zeros((0, 2), dtype=np.int64)
+    extra = np.fromfile(extraPath, dtype=TARGET_DTYPE)
+    extra = extra[:len(extra) - len(extra) % 2].reshape(-1, 2).astype(np.int64)
+    return extra[(extra < numPages).all(axis=1)]
+
+def mergeExtraLinks(offsets: np.ndarray, targets: np.ndarray, extra: np.ndarray):
+    """
+        Folds (source, target) links into CSR rows, each after the row's own links.
+        Returns (offsets, targets) as new arrays.
+    """
+    numPages = len(offsets) - 1
+    degree = np.diff(offsets)
+    extraSources = extra[:, 0]
+    newOffsets = np.zeros(numPages + 1, dtype=OFFSET_DTYPE)
+    np.cumsum(degree + np.bincount(extraSources, minlength=numPages), out=newOffsets[1:])
+
+    newTargets = np.empty(int(newOffsets[-1]), dtype=TARGET_DTYPE)
+    rowSources = np.repeat(np.arange(numPages, dtype=np.int64), degree)
+    newTargets[np.arange(len(targets), dtype=np.int64) + (newOffsets[:-1] - offsets[:-1])[rowSources]] = targets
+
+    # Extra links go after the row's own links, in the order they were found
+    order = np.argsort(extraSources, kind='stable')
+    sortedSources = extraSources[order]
+    groupStart = np.searchsorted(sortedSources, sortedSources, side='left')
+    rank = np.arange(len(order), dtype=np.int64) - groupStart
+    newTargets[newOffsets[sortedSources] + degree[sortedSources] + rank] = extra[order, 1]
+
+    return newOffsets, newTargets
+
+def loadLinkGraph(graphDir: str):
+    """
+        Loads a link graph written by LinkGraph without parsing or copying the link arrays.
+        Returns (urls, offsets, targets), offsets and targets are read-only memmaps
+        (or in memory arrays, if there are extra links to fold in).
+
+        :param graphDir: Path to the directory of the link graph
+    """
+
+    urls = _readURLs(graphDir)
+    numPages = len(urls)
+
+    offsets = _memmapArray(f"{graphDir}/{OFFSETS_FILE}", OFFSET_DTYPE, numPages + 1) if 0 < numPages else np.zeros(1, dtype=OFFSET_DTYPE)
+    numLinks = int(offsets[-1])
+    targets = _memmapArray(f"{graphDir}/{TARGETS_FILE}", TARGET_DTYPE, numLinks)
+
+    extra = _readExtra(graphDir, numPages)
+    if 0 < len(extra):
+        offsets, targets = mergeExtraLinks(offsets, targets, extra)
+
+    return urls, offsets, targets
+
+def loadLinkGraphURLs(graphDir: str):
+    """
+        Returns the url of each page id of a link graph, without touching the links.
+    """
+    return _readURLs(graphDir)
+
+def iterLinkChunks(graphDir: str, numPages: int, chunkLinks=1 << 22):
+    """
+        Yields the links of a link graph as (sources, targets) int64 arrays of about chunkLinks links each,
+        the rows a block at a time from the memory mapped files, then the extra links.
+        Unlike loadLinkGraph, only one chunk of links is ever in memory.
+
+        :param numPages: Number of committed pages (see loadLinkGraphURLs), later rows are ignored
+    """
+
+    offsets = _memmapArray(f"{graphDir}/{OFFSETS_FILE}", OFFSET_DTYPE, numPages + 1)
+    targets = _memmapArray(f"{graphDir}/{TARGETS_FILE}", TARGET_DTYPE, int(offsets[-1]) if 0 < numPages else 0)
+    start = 0
+    while start < numPages:
+        end = int(np.searchsorted(offsets, offsets[start] + chunkLinks, side='right')) - 1
+        end = min(max(end, start + 1), numPages)
+        rowOffsets = np.asarray(offsets[start:end + 1])
+        sources = np.repeat(np.arange(start, end, dtype=np.int64), np.diff(rowOffsets))
+        yield sources, np.asarray(targets[rowOffsets[0]:rowOffsets[-1]], dtype=np.int64)
+        start = end
+
+    extraPath = f"{graphDir}/{EXTRA_FILE}"
+    numExtra = os.path.getsize(extraPath) // (2 * np.dtype(TARGET_DTYPE).itemsize) if os.path.exists(extraPath) else 0
+    extra = _memmapArray(extraPath, TARGET_DTYPE, 2 * numExtra).reshape(-1, 2)
+    for i in range(0, numExtra, chunkLinks):
+        links = np.asarray(extra[i:i + chunkLinks], dtype=np.int64)
+        links = links[(links < numPages).all(axis=1)]
+        yield links[:, 0], links[:, 1]
+
+class UnresolvedLinks:
+    """
+        Out-links to pages that aren't in the graph yet, keyed by target url.
+    """
+
+    def __init__(self, dbPath: str):
+        self.db = sqlite3.connect(dbPath)
+        self.db.execute("CREATE TABLE IF NOT EXISTS unresolved (target TEXT NOT NULL, source TEXT NOT NULL, PRIMARY KEY (target, source)) WITHOUT ROWID")
+        self.db.execute("CREATE INDEX IF NOT EXISTS unresolvedSource ON unresolved (source)")
+        self.db.execute("CREATE TEMP TABLE keys (url TEXT PRIMARY KEY) WITHOUT ROWID")
+        self.db.commit()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM unresolved").fetchone()[0]
+
+    def add(self, links):
+        """
+            :param links: Iterable of (source url, target url)
+        """
+        self.db.executemany("INSERT OR IGNORE INTO unresolved (source, target) VALUES (?, ?)", links)
+        self.db.commit()
+
+    def resolve(self, targets):
+        """
+            Removes and returns the (source, target) links waiting on any of these urls.
+        """
+        self.db.executemany("INSERT OR IGNORE INTO keys (url) VALUES (?)", ((url,) for url in targets))
+        links = self.db.execute("SELECT unresolved.source, unresolved.target FROM keys JOIN unresolved ON unresolved.target = keys.url").fetchall()
+        self.db.execute("DELETE FROM unresolved WHERE target IN (SELECT url FROM keys)")
+        self.db.execute("DELETE FROM keys")
+        self.db.commit()
+        return links
+
+    def removeSources(self, sources):
+        """
+            Forgets the unresolved links of these pages (they were replaced or removed).
+        """
+        self.db.executemany("DELETE FROM unresolved WHERE source = ?", ((url,) for url in sources))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+def _appendRows(graphDir: str, enumLookup: dict, numLinks: int, newURLs: list, pages: dict):
+    """
+        Appends the rows of newURLs (which already have ids in enumLookup) to a graph's files.
+        Returns (numLinks, unresolved), unresolved the (source, target) links to pages not in enumLookup.
+    """
+
+    rowTargets = []
+    unresolved = []
+    rowOffsets = np.empty(len(newURLs), dtype=OFFSET_DTYPE)
+    for i, url in enumerate(newURLs):
+        ids = set()
+        for link in pages[url]:
+            j = enumLookup.get(link)
+            if j is None:
+                unresolved.append((url, link))
+            else:
+                ids.add(j)
+        rowTargets.extend(sorted(ids))
+        numLinks += len(ids)
+        rowOffsets[i] = numLinks
+
+    with timer("index_write_seconds"):
+        with open(f"{graphDir}/{TARGETS_FILE}", mode='ab') as fp:
+            np.asarray(rowTargets, dtype=TARGET_DTYPE).tofile(fp)
+        with open(f"{graphDir}/{OFFSETS_FILE}", mode='ab') as fp:
+            rowOffsets.tofile(fp)
+        with open(f"{graphDir}/{URLS_FILE}", mode='a', encoding='utf-8') as fp:
+            fp.write("".join(f"{url}\n" for url in newURLs))
+
+    return numLinks, unresolved
+
+class LinkGraph:
+    """
+        Appendable handle on a link graph directory.
+        Keeps the url -> id table in memory so new rows can be resolved.
+    """
+
+    def __init__(self, graphDir: str):
+        self.graphDir = graphDir
+        if not os.path.exists(graphDir): os.makedirs(graphDir)
+
+        self.urls = _readURLs(graphDir)
+        self.enumLookup = {url: i for i, url in enumerate(self.urls)}
+        self._repair()
+        self.unresolved = UnresolvedLinks(f"{graphDir}/{UNRESOLVED_FILE}")
+
+    def __len__(self):
+        return len(self.urls)
+
+    def __contains__(self, url: str):
+        return url in self.enumLookup
+
+    def _repair(self):
+        """
+            Trims offsets/targets written past the last committed url (interrupted append),
+            and a half written extra link.
+        """
+        numPages = len(self.urls)
+        offsetsPath = f"{self.graphDir}/{OFFSETS_FILE}"
+        targetsPath = f"{self.graphDir}/{TARGETS_FILE}"
+        extraPath = f"{self.graphDir}/{EXTRA_FILE}"
+
+        if not os.path.exists(offsetsPath) or os.path.getsize(offsetsPath) == 0:
+            np.zeros(1, dtype=OFFSET_DTYPE).tofile(offsetsPath)
+        offsetSize = np.dtype(OFFSET_DTYPE).itemsize
+        os.truncate(offsetsPath, (numPages + 1) * offsetSize)
+
+        offsets = np.fromfile(offsetsPath, dtype=OFFSET_DTYPE, count=1, offset=numPages * offsetSize)
+        self.numLinks = int(offsets[0])
+        if not os.path.exists(targetsPath): open(targetsPath, mode='wb').close()
+        os.truncate(targetsPath, self.numLinks * np.dtype(TARGET_DTYPE).itemsize)
+
+        if not os.path.exists(extraPath): open(extraPath, mode='wb').close()
+        linkSize = 2 * np.dtype(TARGET_DTYPE).itemsize
+        self.numExtra = os.path.getsize(extraPath) // linkSize
+        os.truncate(extraPath, self.numExtra * linkSize)
+
+    def addPages(self, pages: dict):
+        """
+            Appends new rows to the graph, pages that are already in the graph are skipped.
+            Links to pages not in the graph yet are kept as unresolved, and links
+            already waiting on one of the new pages are resolved.
+
+            :param pages: Dict of url -> iterable of urls on that page
+        """
+
+        newURLs = [url for url in pages.keys() if url not in self.enumLookup]
+        if len(newURLs) == 0:
+            return
+
+        # Give the whole batch ids first so pages in the batch can link to each other
+        for url in newURLs:
+            self.enumLookup[url] = len(self.urls)
+            self.urls.append(url)
+
+        numLinks, unresolved = _appendRows(self.graphDir, self.enumLookup, self.numLinks, newURLs, pages)
+        self.numLinks = numLinks
+        self.unresolved.add(unresolved)
+
+        # Only the links waiting on the new pages are touched
+        extra = [(self.enumLookup[source], self.enumLookup[target]) for source, target in self.unresolved.resolve(newURLs) if source in self.enumLookup]
+        if extra:
+            with timer("index_write_seconds"):
+                with open(f"{self.graphDir}/{EXTRA_FILE}", mode='ab') as fp:
+                    np.asarray(extra, dtype=TARGET_DTYPE).tofile(fp)
+            self.numExtra += len(extra)
+
+        if COMPACT_RATIO * max(self.numLinks, 1024) < self.numExtra:
+            self.compact()
+
+    def removePages(self, urls):
+        """
+            Removes pages and every link to them. Rewrites the graph, so page ids change.
+        """
+        self.replacePages({}, urls)
+
+    def replacePages(self, pages: dict, removeURLs=()):
+        """
+            Replaces the rows of pages already in the graph (links to them are kept),
+            appends any new pages and removes removeURLs. Rewrites the graph, so page ids change.
+            Links to removed pages become unresolved, so they come back if the page does.
+
+            :param pages: Dict of url -> iterable of urls on that page
+            :param removeURLs: Urls to remove along with every link to them
+        """
+
+        removeURLs = set(removeURLs)
+        if len(pages) == 0 and len(removeURLs.intersection(self.enumLookup.keys())) == 0:
+            return
+        self._rewrite(pages, removeURLs)
+
+    def compact(self):
+        """
+            Rewrites the graph with the extra links folded into their rows.
+        """
+        if 0 < self.numExtra:
+            self._rewrite({}, set())
+
+    def _rewrite(self, pages: dict, removeURLs: set):
+
+        # Replaced and removed pages' own unresolved links go, new pages pick up the links waiting on them
+        self.unresolved.removeSources(list(pages.keys()) + list(removeURLs))
+        waiting = self.unresolved.resolve([url for url in pages.keys() if url not in self.enumLookup and url not in removeURLs])
+
+        oldURLs, offsets, targets = loadLinkGraph(self.graphDir)
+        rows = {}
+        for i, url in enumerate(oldURLs):
+            if url not in removeURLs:
+                rows[url] = [oldURLs[j] for j in targets[offsets[i]:offsets[i+1]]]
+        for source, target in waiting:
+            if source in rows and source not in pages:
+                rows[source].append(target)
+        for url, links in pages.items():
+            if url not in removeURLs:
+                rows[url] = links
+
+        # Write the new graph next to the old one and swap the directories
+        del offsets, targets
+        tmpDir = f"{self.graphDir}.tmp"
+        oldDir = f"{self.graphDir}.old"
+        for dirPath in (tmpDir, oldDir):
+            if os.path.exists(dirPath): shutil.rmtree(dirPath)
+        os.makedirs(tmpDir)
+        with timer("index_rewrite_seconds"):
+            newURLs = list(rows.keys())
+            np.zeros(1, dtype=OFFSET_DTYPE).tofile(f"{tmpDir}/{OFFSETS_FILE}")
+            _, unresolved = _appendRows(tmpDir, {url: i for i, url in enumerate(newURLs)}, 0, newURLs, rows)
+
+            # The unresolved links move over with the graph, along with links to the removed pages
+            self.unresolved.add(unresolved)
+            self.unresolved.close()
+            os.rename(f"{self.graphDir}/{UNRESOLVED_FILE}", f"{tmpDir}/{UNRESOLVED_FILE}")
+
+            os.rename(self.graphDir, oldDir)
+            os.rename(tmpDir, self.graphDir)
+            shutil.rmtree(oldDir)
+
+        self.__init__(self.graphDir)
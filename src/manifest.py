@@ -0,0 +1,210 @@
+# ====================================================================
+# Tracks which files of the tiny-web have already been processed
+#
+# Each stage keeps its own manifest (name, mtime, size) in a SQLite file,
+# so after a restart it only processes pages added or modified since,
+# and can drop the outputs of pages that were removed
+#
+# DirectoryWatcher uses inotify (pip install inotify_simple) when it is
+# available to avoid listing the whole directory every tick
+#
+# The stages that change the index or ranking also bump a generation number
+# (index/generation), so anything caching their output (see querycache.py)
+# knows when to throw it away
+#
+import os
+import sqlite3
+from time import sleep
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_generationPath = "index/generation"
+
+class Manifest:
+    """
+        Persistent record of the files a stage has processed.
+        scan() finds what changed, commit() records it once it has been processed.
+    """
+
+    def __init__(self, dbPath: str):
+        self.db = sqlite3.connect(dbPath)
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, mtime INTEGER NOT NULL, size INTEGER NOT NULL)")
+        self.db.commit()
+        self.pendingUpserts = {}
+        self.pendingDeletes = set()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def _stat(self, dirPath: str, name: str):
+        try:
+            st = os.stat(f"{dirPath}/{name}")
+            return st.st_mtime_ns, st.st_size
+        except FileNotFoundError:
+            return None
+
+    def scan(self, dirPath: str, names=None):
+        """
+            Compares the directory against the manifest.
+            Returns (added, modified, removed) lists of file names.
+
+            :param names: Only check these names (e.g. from a watcher), None checks the whole directory
+        """
+
+        if names is None:
+            current = {}
+            with os.scandir(dirPath) as it:
+                for entry in it:
+                    if entry.is_file():
+                        st = entry.stat()
+                        current[entry.name] = (st.st_mtime_ns, st.st_size)
+            known = {name: (mtime, size) for name, mtime, size in self.db.execute("SELECT name, mtime, size FROM files")}
+            removed = [name for name in known.keys() if name not in current]
+        else:
+            current = {}
+            known = {}
+            removed = []
+            for name in names:
+                row = self.db.execute("SELECT mtime, size FROM files WHERE name = ?", (name,)).fetchone()
+                stat = self._stat(dirPath, name)
+                if stat is not None:
+                    current[name] = stat
+                if row is not None:
+                    known[name] = row
+                    if stat is None:
+                        removed.append(name)
+
+        added = []
+        modified = []
+        for name, stat in current.items():
+            prev = known.get(name)
+            if prev is None:
+                added.append(name)
+            elif tuple(prev) != stat:
+                modified.append(name)
+            else:
+                continue
+            self.pendingUpserts[name] = stat
+        self.pendingDeletes.update(removed)
+
+        return added, modified, removed
+
+    def discard(self, names):
+        """
+            Leaves names found by scan() out of the next commit, e.g. pages that failed to process,
+            so the next scan finds them again.
+        """
+        for name in names:
+            self.pendingUpserts.pop(name, None)
+
+    def restat(self, changes):
+        """
+            Moves processed files to a new (mtime, size) when only their encoding changed (see pagestore.compressDirectory),
+            so the next scan doesn't see them as modified. Files recorded with any other stat are left alone.
+            Returns the number of files updated.
+
+            :param changes: Iterable of (name, (oldMtime, oldSize), (newMtime, newSize))
+        """
+        numUpdated = 0
+        for name, (oldMtime, oldSize), (newMtime, newSize) in changes:
+            numUpdated += self.db.execute("UPDATE files SET mtime = ?, size = ? WHERE name = ? AND mtime = ? AND size = ?", (newMtime, newSize, name, oldMtime, oldSize)).rowcount
+        self.db.commit()
+        return numUpdated
+
+    def commit(self):
+        """
+            Records everything found by scan() since the last commit as processed.
+        """
+        self.db.executemany("INSERT OR REPLACE INTO files (name, mtime, size) VALUES (?, ?, ?)", ((name, mtime, size) for name, (mtime, size) in self.pendingUpserts.items()))
+        self.db.executemany("DELETE FROM files WHERE name = ?", ((name,) for name in self.pendingDeletes))
+        self.db.commit()
+        self.pendingUpserts = {}
+        self.pendingDeletes = set()
+
+    def close(self):
+        self.db.close()
+
+class DirectoryWatcher:
+    """
+        Waits for changes to a directory.
+        With inotify, wait() returns the names that changed, otherwise it sleeps
+        and returns None (meaning: scan the whole directory).
+    """
+
+    def __init__(self, dirPath: str, pollingRate=10.0, useInotify=True):
+        self.dirPath = dirPath
+        self.pollingRate = pollingRate
+        self.inotify = None
+        self.first = True
+        if useInotify and INotify is not None:
+            self.inotify = INotify()
+            watchFlags = inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO | inotify_flags.MOVED_FROM | inotify_flags.DELETE
+            self.inotify.add_watch(dirPath, watchFlags)
+
+    def wait(self):
+        # Always start with a full scan to catch up on changes made while not running
+        if self.first:
+            self.first = False
+            return None
+
+        if self.inotify is None:
+            sleep(self.pollingRate)
+            return None
+
+        # Block until something changes, then batch up whatever else arrives in the next second
+        names = {event.name for event in self.inotify.read(read_delay=1000)}
+        names.discard("")
+        return names
+
+## ========== ##
+## Generation ##
+## ========== ##
+
+def setGenerationPath(path):
+    """
+        Sets the generation file bumped by the stages, None to stop bumping it.
+    """
+    global _generationPath
+    _generationPath = path
+
+def getGenerationPath():
+    return _generationPath
+
+def readGeneration(path=None):
+    """
+        Returns the generation number, 0 if it was never bumped.
+    """
+    path = path or _generationPath
+    try:
+        with open(path, mode='r') as fp:
+            if fcntl is not None: fcntl.flock(fp, fcntl.LOCK_SH)
+            text = fp.read().strip()
+    except FileNotFoundError:
+        return 0
+    return int(text) if text else 0
+
+def bumpGeneration(path=None):
+    """
+        Increments the generation number, safe across processes.
+        Skipped (returns None) when there's no generation file set or its directory doesn't exist.
+    """
+    path = path or _generationPath
+    if path is None or not os.path.isdir(os.path.dirname(path) or "."):
+        return None
+    with open(path, mode='a+') as fp:
+        if fcntl is not None: fcntl.flock(fp, fcntl.LOCK_EX)
+        fp.seek(0)
+        text = fp.read().strip()
+        generation = int(text) + 1 if text else 1
+        fp.seek(0)
+        fp.truncate()
+        fp.write(f"{generation}\n")
+    return generation
@@ -0,0 +1,339 @@
+# ====================================================================
+# Lightweight metrics for every stage of the pipeline
+#
+#   Counters   - incr("pages_parsed")
+#   Gauges     - setGauge("rank_residual", r)
+#   Histograms - observe("fetch_seconds", dt), or time a block with  with timer("parse_seconds"): ...
+#   Rates      - RateMeter("crawl_pages_per_second").mark(), a gauge of events per second since it started
+#
+# Metrics are kept in process and written out by flushMetrics() to each sink
+#   LogSink        - One json line per flush (a file, or stderr)
+#   PrometheusSink - Prometheus text format file, rewritten each flush (node_exporter textfile collector)
+#
+# Any timer can also be cProfiled (profileStages), the stats are dumped to a .prof per stage
+#
+# Per-page progress lines go through logPage(), setPageLogging(False) turns them off
+#
+import os
+import sys
+import cProfile
+import pstats
+from bisect import bisect_left
+from threading import Lock, local
+from time import time, perf_counter
+from json import dumps as json_dumps
+
+# Upper bounds (seconds) of the histogram buckets, the last bucket is everything above
+DEFAULT_BUCKETS = (1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+class Histogram:
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value < self.min: self.min = value
+        if self.max < value: self.max = value
+
+    def snapshot(self):
+        return {"count": self.count, "sum": self.sum, "min": self.min, "max": self.max,
+                "buckets": [[le, n] for le, n in zip(list(self.buckets) + ["+Inf"], self.counts)]}
+
+    def merge(self, snapshot: dict):
+        self.count += snapshot["count"]
+        self.sum += snapshot["sum"]
+        self.min = min(self.min, snapshot["min"])
+        self.max = max(self.max, snapshot["max"])
+        for i, (_, n) in enumerate(snapshot["buckets"]):
+            self.counts[i] += n
+
+class MetricsRegistry:
+    """
+        Thread safe store of every counter, gauge and histogram in the process.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.tStart = time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def incr(self, name: str, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def setGauge(self, name: str, value: float):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name: str, value: float):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "time": time(),
+                "uptime": time() - self.tStart,
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "histograms": {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+            }
+
+    def drain(self):
+        """
+            Returns a snapshot and resets every metric, for worker processes to hand their metrics to the parent.
+        """
+        snapshot = self.snapshot()
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+        return snapshot
+
+    def merge(self, snapshot: dict):
+        """
+            Adds a snapshot (e.g. drained from a worker process) into this registry.
+        """
+        with self.lock:
+            for name, n in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            self.gauges.update(snapshot["gauges"])
+            for name, histogramSnapshot in snapshot["histograms"].items():
+                histogram = self.histograms.get(name)
+                if histogram is None:
+                    histogram = self.histograms[name] = Histogram()
+                histogram.merge(histogramSnapshot)
+
+_registry = MetricsRegistry()
+_sinks = []
+_profiledStages = set()
+_profiles = {}      # stage -> [cProfile.Profile, one per thread]
+_profileLock = Lock()
+_profileDir = "profiles/"
+_threadState = local()
+_pageLogging = True
+
+def incr(name: str, n=1):
+    _registry.incr(name, n)
+
+def setGauge(name: str, value: float):
+    _registry.setGauge(name, value)
+
+def observe(name: str, value: float):
+    _registry.observe(name, value)
+
+def getMetrics():
+    return _registry.snapshot()
+
+def drainMetrics():
+    return _registry.drain()
+
+def mergeMetrics(snapshot: dict):
+    _registry.merge(snapshot)
+
+## ====== ##
+## Timers ##
+## ====== ##
+
+class timer:
+    """
+        Times a block into a histogram, and cProfiles it if its stage is being profiled
+            with timer("parse_seconds"):
+                ...
+    """
+
+    __slots__ = ("name", "t0", "profile")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.profile = None
+
+    def __enter__(self):
+        if _profiledStages and self.name in _profiledStages and not getattr(_threadState, "profiling", False):
+            self.profile = _stageProfile(self.name)
+            _threadState.profiling = True
+            self.profile.enable()
+        self.t0 = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _registry.observe(self.name, perf_counter() - self.t0)
+        if self.profile is not None:
+            self.profile.disable()
+            _threadState.profiling = False
+        return False
+
+class RateMeter:
+    """
+        Counts events and keeps their rate per second since the meter started in a gauge
+            pagesPerSecond = RateMeter("crawl_pages_per_second")
+            pagesPerSecond.mark()
+    """
+
+    __slots__ = ("name", "t0", "count", "lock")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.t0 = perf_counter()
+        self.count = 0
+        self.lock = Lock()
+
+    def mark(self, n=1):
+        with self.lock:
+            self.count += n
+            rate = self.count / max(perf_counter() - self.t0, 1e-9)
+        _registry.setGauge(self.name, rate)
+        return rate
+
+    @property
+    def seconds(self):
+        return perf_counter() - self.t0
+
+    @property
+    def rate(self):
+        return self.count / max(self.seconds, 1e-9)
+
+def _stageProfile(stage: str):
+    profiles = getattr(_threadState, "profiles", None)
+    if profiles is None:
+        profiles = _threadState.profiles = {}
+    profile = profiles.get(stage)
+    if profile is None:
+        profile = profiles[stage] = cProfile.Profile()
+        with _profileLock:
+            _profiles.setdefault(stage, []).append(profile)
+    return profile
+
+def profileStages(stages, profileDir="profiles/"):
+    """
+        cProfiles every timer with one of these names, flushMetrics() dumps them to profileDir/<stage>.prof
+        (only one stage is profiled at a time in a thread, nested timers are included in the outer one).
+    """
+    global _profileDir
+    _profiledStages.update(stages)
+    _profileDir = profileDir
+
+def dumpProfiles():
+    with _profileLock:
+        stages = {stage: list(profiles) for stage, profiles in _profiles.items()}
+    if not stages:
+        return
+    if not os.path.exists(_profileDir): os.makedirs(_profileDir)
+    for stage, profiles in stages.items():
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(f"{_profileDir}/{stage}.prof")
+
+## ===== ##
+## Sinks ##
+## ===== ##
+
+class LogSink:
+    """
+        Appends one json line per flush to a file, or writes it to stderr.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+
+    def write(self, snapshot: dict):
+        line = json_dumps(snapshot) + "\n"
+        if self.path is None:
+            sys.stderr.write(line)
+            sys.stderr.flush()
+        else:
+            with open(self.path, mode='a') as fp:
+                fp.write(line)
+
+class PrometheusSink:
+    """
+        Rewrites a Prometheus text format file each flush. Names are prefixed, e.g. tinyweb_pages_parsed.
+    """
+
+    def __init__(self, path: str, prefix="tinyweb_"):
+        self.path = path
+        self.prefix = prefix
+
+    def write(self, snapshot: dict):
+        lines = []
+        for name, n in sorted(snapshot["counters"].items()):
+            lines += [f"# TYPE {self.prefix}{name} counter", f"{self.prefix}{name} {n}"]
+        for name, value in sorted(snapshot["gauges"].items()):
+            lines += [f"# TYPE {self.prefix}{name} gauge", f"{self.prefix}{name} {value}"]
+        for name, histogram in sorted(snapshot["histograms"].items()):
+            lines.append(f"# TYPE {self.prefix}{name} histogram")
+            cumulative = 0
+            for le, n in histogram["buckets"]:
+                cumulative += n
+                lines.append(f"{self.prefix}{name}_bucket{{le=\"{le}\"}} {cumulative}")
+            lines += [f"{self.prefix}{name}_sum {histogram['sum']}", f"{self.prefix}{name}_count {histogram['count']}"]
+
+        # Swap in whole, so a scraper never reads half a file
+        with open(f"{self.path}.tmp", mode='w') as fp:
+            fp.write("\n".join(lines) + "\n")
+        os.replace(f"{self.path}.tmp", self.path)
+
+def addSink(sink):
+    _sinks.append(sink)
+
+def flushMetrics():
+    """
+        Writes the current metrics to every sink, and dumps any stage profiles.
+    """
+    if _sinks:
+        snapshot = _registry.snapshot()
+        for sink in _sinks:
+            sink.write(snapshot)
+    dumpProfiles()
+
+## ======== ##
+## Page Log ##
+## ======== ##
+
+def setPageLogging(enabled: bool):
+    global _pageLogging
+    _pageLogging = enabled
+
+def logPage(message: str):
+    """
+        Prints a per-page progress line, unless page logging is off.
+    """
+    if _pageLogging:
+        print(message)
+
+## === ##
+## CLI ##
+## === ##
+
+def addMetricsArguments(parser):
+    """
+        Adds the shared --quiet / metrics / profiling flags to a stage's argparse parser.
+    """
+    parser.add_argument("--quiet", help="Don't print a line per page", action="store_true")
+    parser.add_argument("--metricsLog", help="Append a json line of metrics to this file each tick ('-' for stderr)", type=str, default=None)
+    parser.add_argument("--metricsProm", help="Prometheus text file to rewrite with the metrics each tick", type=str, default=None)
+    parser.add_argument("--profile", help="Timer names (e.g. parse_seconds) to cProfile", type=str, nargs='+', default=[])
+    parser.add_argument("--profileDir", help="Directory for the .prof files of --profile", type=str, default="profiles/")
+
+def applyMetricsArguments(args):
+    setPageLogging(not args.quiet)
+    if args.metricsLog:
+        addSink(LogSink(None if args.metricsLog == "-" else args.metricsLog))
+    if args.metricsProm:
+        addSink(PrometheusSink(args.metricsProm))
+    if args.profile:
+        profileStages(args.profile, args.profileDir)
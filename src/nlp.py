@@ -2,39 +2,215 @@
 # Computes and stores term frequency information for each page
 #
 # NOTE: All terms stored will be lemmatized
+#
+# NOTE: A manifest of processed files (term-freq/manifest.db) means only pages
+#       added, modified or removed since the last run are processed
+#
+# NOTE: With positions on (--positions), each field also gets the lemma positions, e.g.
+#       "text-pos": {"matrix": [4, 17]}, for phrase and proximity queries (see invertedindex.py).
+#       Positions run on across a field's headers / texts with a gap of one between them,
+#       so a phrase never matches across two of them
+#
+# NOTE: nltk is only imported, and the wordnet data only loaded, the first time a
+#       word has to be lemmatized (see getLemmatizer), so importing this module is cheap.
+#       Nothing is downloaded unless asked for, the __main__ stages ask for it.
 # 
-from nltk import download as nltk_download
-from nltk import RegexpTokenizer
-from nltk.stem import WordNetLemmatizer
-from nltk.data import load
-from nltk.tokenize.destructive import NLTKWordTokenizer
-from time import time, sleep
+from time import time, perf_counter
+from multiprocessing import Pool, cpu_count
+from threading import Lock
 
 import os
-from htmlparse import Host, getSoupLocal, getLinksFromSoup, getURLAndHostFromFileName, WIKI_HOST_URL, SOF_HOST_URL, MEWE_HOST_URL
+import re
+import argparse
+from manifest import Manifest, DirectoryWatcher, bumpGeneration
+from tfstore import TermFreqStore
+from htmlparse import Host, PageContent, getPageContentLocal, getURLAndHostFromFileName, DEFAULT_PARSER
+from metrics import timer, incr, observe, logPage, drainMetrics, mergeMetrics, flushMetrics, addMetricsArguments, applyMetricsArguments
 from json import dumps as json_dumps
+from json import loads as json_loads
+from collections import OrderedDict
 
 ## === ##
 #  NLP  #
 ## === ##
 
-# Language models needed
-nltk_download('wordnet')
-_lemmatizer = WordNetLemmatizer()
-_tokenizer = RegexpTokenizer(r"\w+|\d+")
+# Same tokens as nltk's RegexpTokenizer(r"\w+|\d+"), without importing nltk
+_tokenPattern = re.compile(r"\w+|\d+", re.UNICODE | re.MULTILINE | re.DOTALL)
+
+# Language models needed, loaded on first use
+_lemmatizer = None
+_lemmatizerLock = Lock()
+
+def getLemmatizer(download=False):
+    """
+        Returns the WordNet lemmatizer, importing nltk and loading the wordnet data the first time.
+        Thread safe, concurrent first callers wait for the one load.
+
+        :param download: Download wordnet if it isn't installed, else a missing wordnet raises LookupError
+    """
+    global _lemmatizer
+    if _lemmatizer is None:
+        with _lemmatizerLock:
+            if _lemmatizer is None:
+                from nltk.stem import WordNetLemmatizer
+
+                lemmatizer = WordNetLemmatizer()
+                try:
+                    lemmatizer.lemmatize("warmup")      # wordnet is read lazily, force it now
+                except LookupError:
+                    if not download:
+                        raise
+                    from nltk import download as nltk_download
+                    nltk_download('wordnet')
+                    lemmatizer.lemmatize("warmup")
+                _lemmatizer = lemmatizer
+    return _lemmatizer
+
+def isLemmatizerLoaded():
+    return _lemmatizer is not None
+
+class LemmaCache:
+    """
+        Bounded LRU of token -> lemma in front of the WordNet lemmatizer.
+        A precomputed table (see loadLemmaTable) is checked first and never evicted.
+        Thread safe, the search server's request threads share one cache.
+
+        Worker processes set learned to a dict to also record every word they lemmatize,
+        drain() hands those and the hit counts to the parent, which merge()s them into its own cache.
+    """
+
+    def __init__(self, maxSize=100000):
+        self.maxSize = maxSize
+        self.table = {}
+        self.lru = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.learned = None
+        self.lock = Lock()
+
+    def get(self, word: str):
+        with self.lock:
+            lemma = self.table.get(word)
+            if lemma is None:
+                lemma = self.lru.get(word)
+                if lemma is not None:
+                    self.lru.move_to_end(word)
+            if lemma is not None:
+                self.hits += 1
+                return lemma
+            self.misses += 1
+
+        # Lemmatized outside the lock, two threads missing the same word just both look it up
+        lemma = (_lemmatizer or getLemmatizer()).lemmatize(word)
+        with self.lock:
+            self.lru[word] = lemma
+            self.lru.move_to_end(word)
+            self._evict()
+            if self.learned is not None:
+                self.learned[word] = lemma
+        return lemma
+
+    def resize(self, maxSize: int):
+        with self.lock:
+            self.maxSize = maxSize
+            self._evict()
+
+    def drain(self):
+        """
+            Returns the hits, misses and learned lemmas since the last drain, and resets them.
+        """
+        with self.lock:
+            snapshot = {"hits": self.hits, "misses": self.misses, "learned": self.learned or {}}
+            self.hits = 0
+            self.misses = 0
+            if self.learned is not None:
+                self.learned = {}
+        return snapshot
+
+    def merge(self, snapshot: dict):
+        """
+            Adds a drained snapshot (e.g. from a worker process) into this cache.
+        """
+        with self.lock:
+            self.hits += snapshot["hits"]
+            self.misses += snapshot["misses"]
+            for word, lemma in snapshot["learned"].items():
+                if word not in self.table:
+                    self.lru[word] = lemma
+                    self.lru.move_to_end(word)
+            self._evict()
+
+    def _evict(self):
+        while self.maxSize < len(self.lru):
+            self.lru.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / lookups if 0 < lookups else 0.0,
+                "cached": len(self.lru),
+                "table": len(self.table),
+            }
+
+_lemmaCache = LemmaCache()
 
 def tokenize(text: str):
-    return _tokenizer.tokenize(text)
+    return _tokenPattern.findall(text)
 
 def lemmatize(word: str):
-    return _lemmatizer.lemmatize(word)
+    return _lemmaCache.get(word)
+
+def setLemmaCacheSize(maxSize: int):
+    _lemmaCache.resize(maxSize)
+
+def getLemmaCacheStats():
+    return _lemmaCache.stats()
+
+def drainLemmaCache():
+    return _lemmaCache.drain()
+
+def mergeLemmaCache(snapshot: dict):
+    _lemmaCache.merge(snapshot)
+
+def loadLemmaTable(path: str):
+    """
+        Loads a precomputed token -> lemma json table into the lemma cache.
+        Load it before starting a worker pool and the workers share it.
+    """
+    with open(path, mode='r') as fp:
+        table = json_loads(fp.read())
+    with _lemmaCache.lock:
+        _lemmaCache.table.update(table)
+
+def saveLemmaTable(path: str):
+    """
+        Saves every token -> lemma known to this process (table and cache) as json.
+    """
+    with _lemmaCache.lock:
+        table = dict(_lemmaCache.table)
+        table.update(_lemmaCache.lru)
+    with open(path, mode='w') as fp:
+        fp.write(json_dumps(table))
 
 def getLemmas(text: str):
     return [lemmatize(word) for word in tokenize(text)]
 
-def getTermFreq(text: str, tfExt=None):
+def getTimedLemmas(text: str):
+    """
+        getLemmas, recording the time spent tokenizing and lemmatizing.
+    """
+    t0 = perf_counter()
+    words = tokenize(text)
+    t1 = perf_counter()
+    lemmas = [lemmatize(word) for word in words]
+    observe("tokenize_seconds", t1 - t0)
+    observe("lemmatize_seconds", perf_counter() - t1)
+    return lemmas
 
-    lemmas = getLemmas(text)
+def countLemmas(lemmas: list, tfExt=None):
 
     tf = tfExt if tfExt else {}
     for lemma in lemmas:
@@ -45,39 +221,64 @@ def getTermFreq(text: str, tfExt=None):
 
     return tf
 
+def addLemmaPositions(lemmas: list, positions: dict, start=0):
+    """
+        Appends the position of each lemma, counting from start, to positions (lemma -> [position, ...]).
+        Returns the start for the next text of the field, one past a gap.
+    """
+    for position, lemma in enumerate(lemmas, start):
+        if lemma in positions:
+            positions[lemma].append(position)
+        else:
+            positions[lemma] = [position]
+    return start + len(lemmas) + 1
+
+def getTermFreq(text: str, tfExt=None):
+    return countLemmas(getTimedLemmas(text), tfExt)
+
 ## ==== ##
 #  Misc  #
 ## ==== ##
 
-def generateTermFreqFromPage(htmlPath: str, webUrl: str, host: Host):
-
-    soup = getSoupLocal(htmlPath)
-
-    # Title term freq
-    title = soup.title.string if soup.title else ""
-    titleTF = getTermFreq(title)
-
-    headers = soup.find_all(['h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
-    headerTF = {}
-    for header in headers:
-        if header.text:
-            headerTF = getTermFreq(header.text, headerTF)
-
-    texts = soup.find_all('p')
-    textTF = {}
-    for text in texts:
-        if text.text:
-            textTF = getTermFreq(text.text, textTF)
-
-    numTitleLemmas = 0
-    for count in titleTF.values():
-        numTitleLemmas += count
-    numHeaderLemmas = 0
-    for count in headerTF.values():
-        numHeaderLemmas += count
-    numTextLemmas = 0
-    for count in textTF.values():
-        numTextLemmas += count
+def generateTermFreqFromPage(htmlPath: str, webUrl: str, host: Host, parser=DEFAULT_PARSER, positions=False):
+
+    content = getPageContentLocal(htmlPath, parser)
+    return generateTermFreqFromContent(content, webUrl, positions)
+
+def generateTermFreqFromContent(content: PageContent, webUrl: str, positions=False):
+    """
+        :param positions: Also record the lemma positions of each field ("title-pos", "header-pos", "text-pos")
+    """
+
+    incr("pages_termfreq")
+    with timer("termfreq_seconds"):
+
+        # Title term freq
+        titleLemmas = getTimedLemmas(content.title)
+        titleTF = countLemmas(titleLemmas)
+        titlePos = {}
+        if positions:
+            addLemmaPositions(titleLemmas, titlePos)
+
+        headerTF = {}
+        headerPos = {}
+        start = 0
+        for header in content.headers:
+            if header:
+                lemmas = getTimedLemmas(header)
+                headerTF = countLemmas(lemmas, headerTF)
+                if positions:
+                    start = addLemmaPositions(lemmas, headerPos, start)
+
+        textTF = {}
+        textPos = {}
+        start = 0
+        for text in content.texts:
+            if text:
+                lemmas = getTimedLemmas(text)
+                textTF = countLemmas(lemmas, textTF)
+                if positions:
+                    start = addLemmaPositions(lemmas, textPos, start)
 
     # Compile  and return the index JSON
     index = {
@@ -85,69 +286,225 @@ def generateTermFreqFromPage(htmlPath: str, webUrl: str, host: Host):
         "title-tf": titleTF,
         "header-tf": headerTF,
         "text-tf": textTF,
-        "numTitleLemmas": numTitleLemmas,
-        "numHeaderLemmas": numHeaderLemmas,
-        "numTextLemmas": numTextLemmas,
+        "numTitleLemmas": sum(titleTF.values()),
+        "numHeaderLemmas": sum(headerTF.values()),
+        "numTextLemmas": sum(textTF.values()),
     }
+    if positions:
+        index["title-pos"] = titlePos
+        index["header-pos"] = headerPos
+        index["text-pos"] = textPos
 
     return index
 
-def updateTermFreqCache(htmlPages: list, localWebDir: str, termFreqDir: str):
-
-    if 0 < len(htmlPages):
-        for htmlPage in htmlPages:
+def _initTermFreqWorker(lemmaTablePath=None):
+    """
+        Runs once in each worker process: loads the wordnet data up front
+        so it isn't paid for on the first page of every chunk.
+    """
+    if lemmaTablePath and not _lemmaCache.table:
+        loadLemmaTable(lemmaTablePath)
+    getLemmatizer()
+
+    # Forget the metrics and lemma counts copied from the parent, the worker only reports its own
+    drainMetrics()
+    drainLemmaCache()
+    _lemmaCache.learned = {}
+
+def _termFreqWorker(task: tuple):
+    """
+        Generates and saves the term frequencies of one page.
+        With no jsonPath the term frequencies are returned for the parent to store instead.
+        Returns (htmlPage, error, pageIndex, metrics, lemmas), error is None on success,
+        metrics and lemmas are the worker's metrics and lemma cache snapshot since its last task, for the parent to merge.
+    """
+    htmlPage, htmlPath, jsonPath, webUrl, host, parser, positions = task
+    try:
+        pageIndex = generateTermFreqFromPage(htmlPath, webUrl, host, parser, positions)
+        if jsonPath is not None:
+            with timer("termfreq_write_seconds"):
+                with open(jsonPath, mode='w') as fp:
+                    fp.write(json_dumps(pageIndex))
+            pageIndex = None
+        return htmlPage, None, pageIndex, drainMetrics(), drainLemmaCache()
+    except Exception as e:
+        return htmlPage, f"{type(e).__name__}: {e}", None, drainMetrics(), drainLemmaCache()
+
+def _termFreqFailed(failures: list, htmlPage: str, error: str):
+    failures.append((htmlPage, error))
+    incr("termfreq_failures")
+    print(f"[NLP]\tERROR! Failed on \"{htmlPage}\": {error}")
+
+def newTermFreqPool(numWorkers: int, lemmaTablePath=None):
+    """
+        Worker pool for updateTermFreqCache, kept across calls so the workers keep their lemma caches warm.
+    """
+    return Pool(numWorkers, initializer=_initTermFreqWorker, initargs=(lemmaTablePath,))
+
+def updateTermFreqCache(htmlPages: list, localWebDir: str, termFreqDir: str, parser=DEFAULT_PARSER, numWorkers=1, chunkSize=32, lemmaTablePath=None, store=None, positions=False, pool=None):
+    """
+        Generates the term frequency json for every page missing one.
+
+        :param store: TermFreqStore to add the pages to instead of writing json files to termFreqDir
+        :param numWorkers: Processes to spread the pages over, 1 runs in this process
+        :param chunkSize: Pages handed to a worker at a time
+        :param lemmaTablePath: Precomputed lemma table for workers that don't already share this process's
+        :param positions: Also record lemma positions, for phrase queries (see generateTermFreqFromContent)
+        :param pool: Pool from newTermFreqPool to use instead of starting numWorkers workers for this call
+        Returns a list of (htmlPage, error) for pages that failed, they are left without term frequencies.
+    """
+
+    if 0 == len(htmlPages):
+        print(f"\tWarning! Local web directory: \"{localWebDir}\" is empty.")
+        return []
 
-            # Filename will be the same in the index, only .json 
-            if htmlPage.endswith(".html"):
-                pagename = htmlPage[:-5]
-                htmlPath = f"{localWebDir}/{htmlPage}"
-                jsonPath = f"{termFreqDir}/{pagename}.json"
+    # Collect the pages that need a term freq file
+    tasks = []
+    for htmlPage in htmlPages:
 
-                # Determine the weburl from the name
-                webUrl, host = getURLAndHostFromFileName(pagename)
+        # Filename will be the same in the index, only .json 
+        if htmlPage.endswith(".html"):
+            pagename = htmlPage[:-5]
+            htmlPath = f"{localWebDir}/{htmlPage}"
+            jsonPath = f"{termFreqDir}/{pagename}.json"
 
-                # If the index file is missing or is empty generate one
-                if not os.path.exists(jsonPath):
-                    print(f"[NLP] Adding \"{htmlPage}\"")
-                    pageIndex = generateTermFreqFromPage(htmlPath, webUrl, host)
+            # Determine the weburl from the name
+            webUrl, host = getURLAndHostFromFileName(pagename)
 
-                    # Save the index information 
-                    with open(jsonPath, mode='w') as fp:
-                        fp.write(json_dumps(pageIndex))
-                
-            else:
-                print(f"Skipping non-html file: \"{htmlPage}\"")
+            # If the index file is missing or is empty generate one
+            if store is not None:
+                if webUrl not in store:
+                    tasks.append((htmlPage, htmlPath, None, webUrl, host, parser, positions))
+            elif not os.path.exists(jsonPath):
+                tasks.append((htmlPage, htmlPath, jsonPath, webUrl, host, parser, positions))
 
-    else:
-        print(f"\tWarning! Local web directory: \"{localWebDir}\" is empty.")
-    
+        else:
+            logPage(f"Skipping non-html file: \"{htmlPage}\"")
+
+    # A bad page is reported and skipped rather than stopping the batch
+    failures = []
+    if pool is None and numWorkers <= 1:
+        for htmlPage, htmlPath, jsonPath, webUrl, host, parser, positions in tasks:
+            logPage(f"[NLP] Adding \"{htmlPage}\"")
+            try:
+                pageIndex = generateTermFreqFromPage(htmlPath, webUrl, host, parser, positions)
+
+                # Save the index information 
+                with timer("termfreq_write_seconds"):
+                    if store is not None:
+                        store.add(pageIndex)
+                    else:
+                        with open(jsonPath, mode='w') as fp:
+                            fp.write(json_dumps(pageIndex))
+            except Exception as e:
+                _termFreqFailed(failures, htmlPage, f"{type(e).__name__}: {e}")
+        if store is not None: store.flush()
+        if tasks: bumpGeneration()
+        return failures
+
+    numTasks = len(tasks)
+    progressStep = max(1, numTasks // 100)
+    t0 = time()
+    ownPool = pool is None
+    if ownPool:
+        pool = newTermFreqPool(numWorkers, lemmaTablePath)
+    try:
+        for n, (htmlPage, error, pageIndex, workerMetrics, workerLemmas) in enumerate(pool.imap_unordered(_termFreqWorker, tasks, chunksize=chunkSize), start=1):
+            mergeMetrics(workerMetrics)
+            mergeLemmaCache(workerLemmas)
+            if error:
+                _termFreqFailed(failures, htmlPage, error)
+            elif pageIndex is not None:
+                with timer("termfreq_write_seconds"):
+                    store.add(pageIndex)
+            if n % progressStep == 0 or n == numTasks:
+                rate = n / max(time() - t0, 1e-9)
+                print(f"[NLP] {n}/{numTasks} pages ({len(failures)} failed, {rate:.1f} pages/s)")
+                if store is not None: store.flush()
+    finally:
+        if ownPool:
+            pool.terminate()
+            pool.join()
+
+    if tasks: bumpGeneration()
+    return failures
+
+def removeTermFreqs(htmlPages: list, termFreqDir: str, store=None):
+    """
+        Deletes the term frequencies of each page (json file, or entry in the store), if there are any.
+    """
+    for htmlPage in htmlPages:
+        if htmlPage.endswith(".html"):
+            if store is not None:
+                store.remove(getURLAndHostFromFileName(htmlPage[:-5])[0])
+                continue
+            jsonPath = f"{termFreqDir}/{htmlPage[:-5]}.json"
+            if os.path.exists(jsonPath):
+                os.remove(jsonPath)
+    if store is not None: store.flush()
+    if htmlPages: bumpGeneration()
 
 if __name__ == "__main__":
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-w", "--workers", help="Processes to build term frequencies with", type=int, default=cpu_count())
+    argparser.add_argument("-p", "--parser", help="Html parser backend", type=str, choices=["stream", "html.parser", "lxml"], default=DEFAULT_PARSER)
+    argparser.add_argument("-l", "--lemmaTable", help="Precomputed token -> lemma json, loaded at startup and updated each tick", type=str, default=None)
+    argparser.add_argument("-c", "--lemmaCacheSize", help="Max tokens kept in the lemma LRU", type=int, default=100000)
+    argparser.add_argument("-s", "--store", help="Keep term frequencies in a binary store (term-freq/store/) instead of json files", action="store_true")
+    argparser.add_argument("--positions", help="Also keep lemma positions, for phrase and proximity queries (invertedindex.py then writes positions.bin)", action="store_true")
+    addMetricsArguments(argparser)
+    args = argparser.parse_args()
+    applyMetricsArguments(args)
+
+    # Load (and if needed download) wordnet once here, forked workers inherit it
+    getLemmatizer(download=True)
+    setLemmaCacheSize(args.lemmaCacheSize)
+    if args.lemmaTable and os.path.exists(args.lemmaTable):
+        loadLemmaTable(args.lemmaTable)
     
     localWebDir = "tinyweb/"
     termFreqDir = "term-freq/"
+    manifestPath = f"{termFreqDir}/manifest.db"
     pollingRate = 10
-
-    htmlPagesPrev = set()
+    store = TermFreqStore(f"{termFreqDir}/store") if args.store else None
+
+    if not os.path.exists(termFreqDir):
+        print(f"[NLP]\tERROR! Cannot reach output termFreq directory: \"{termFreqDir}\".")
+        exit(1)
+    if not os.path.exists(localWebDir):
+        print(f"[NLP]\tERROR! Cannot see local web directory: \"{localWebDir}\".")
+        exit(1)
+
+    # Wait for changes to the tinyweb (inotify if available, else every pollingRate seconds)
+    # Only the pages added, modified or removed since they were last processed are touched
+    manifest = Manifest(manifestPath)
+    watcher = DirectoryWatcher(localWebDir, pollingRate)
+    pool = newTermFreqPool(args.workers, args.lemmaTable) if 1 < args.workers else None
     while True:
+        changedPages = watcher.wait()
         print("[NLP] Tick.")
-        if os.path.exists(termFreqDir):
-            if os.path.exists(localWebDir):
-
-                # Check for changes 
-                htmlPages = set(os.listdir(localWebDir))
-                if 0 < len(htmlPages.intersection(htmlPagesPrev)):
-                    print("[NLP] Changes to web.")
-                    updateTermFreqCache(htmlPages, localWebDir, termFreqDir)
+        if os.path.exists(localWebDir):
+
+            # Check for changes 
+            added, modified, removed = manifest.scan(localWebDir, changedPages)
+            if added or modified or removed:
+                print(f"[NLP] Changes to web: {len(added)} added, {len(modified)} modified, {len(removed)} removed.")
+                removeTermFreqs(modified + removed, termFreqDir, store)
+                if added or modified:
+                    failures = updateTermFreqCache(added + modified, localWebDir, termFreqDir, args.parser, args.workers, lemmaTablePath=args.lemmaTable, store=store, positions=args.positions, pool=pool)
+
+                    # Failed pages stay out of the manifest, so they are retried next tick
+                    manifest.discard(htmlPage for htmlPage, _ in failures)
+                    print(f"[NLP] Lemma cache: {getLemmaCacheStats()}")
+                    if args.lemmaTable: saveLemmaTable(args.lemmaTable)
+                manifest.commit()
+                flushMetrics()
 
-                htmlPagesPrev = htmlPages
-
-                sleep(pollingRate)
-
-            else:
-                print(f"[NLP]\tERROR! Cannot see local web directory: \"{localWebDir}\".")
-                break
         else:
-            print(f"[NLP]\tERROR! Cannot reach output termFreq directory: \"{localWebDir}\".")
+            print(f"[NLP]\tERROR! Cannot see local web directory: \"{localWebDir}\".")
             break
-    
\ No newline at end of file
+
+    if pool is not None:
+        pool.close()
+        pool.join()
@@ -0,0 +1,154 @@
+# ====================================================================
+# Compressed storage for the raw pages of the tiny-web
+#
+# Pages keep their tinyweb/<name>.html file names, so nothing that lists or
+# tracks the directory changes, but the bytes can be plain html, gzip or
+# zstd (pip install zstandard). Readers tell them apart by the first bytes
+# and decompress as they read, so the parser is fed straight from the file.
+#
+# Wikipedia pages shrink about 5-8x either way, zstd decompresses faster.
+#
+# Recompressing keeps each page's mtime and updates the stages' manifests
+# (see manifest.py) with the new size, so the stages don't redo every page.
+#
+import os
+import io
+import gzip
+import argparse
+
+from manifest import Manifest
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+COMPRESSIONS = ("none", "gzip", "zstd")
+READ_CHUNK = 64 * 2**10
+
+# The manifests of the stages that read tinyweb/
+STAGE_MANIFESTS = ("index/manifest.db", "term-freq/manifest.db", "index/pipeline-manifest.db")
+
+def _checkZstd():
+    if zstandard is None:
+        raise ImportError("zstd compressed pages need the zstandard package (pip install zstandard)")
+
+def getCompression(path: str):
+    """
+        Returns how a page is stored on disk, one of COMPRESSIONS.
+    """
+    with open(path, mode='rb') as fp:
+        magic = fp.read(len(ZSTD_MAGIC))
+    if magic.startswith(GZIP_MAGIC):
+        return "gzip"
+    if magic == ZSTD_MAGIC:
+        return "zstd"
+    return "none"
+
+def compressPage(html: bytes, compression="none", level=None):
+    """
+        Returns the bytes to store for a page.
+
+        :param compression: One of COMPRESSIONS
+        :param level: Compression level, None for the library default
+    """
+    if compression == "gzip":
+        return gzip.compress(html, compresslevel=9 if level is None else level, mtime=0)
+    if compression == "zstd":
+        _checkZstd()
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(html)
+    return html
+
+def writePage(path: str, html: bytes, compression="none", level=None):
+    with open(path, mode='wb') as fp:
+        fp.write(compressPage(html, compression, level))
+
+def openPage(path: str):
+    """
+        Opens a local page for reading as text, decompressing on the fly if it is compressed.
+    """
+    fp = open(path, mode='rb')
+    magic = fp.read(len(ZSTD_MAGIC))
+    fp.seek(0)
+
+    if magic.startswith(GZIP_MAGIC):
+        stream = gzip.GzipFile(fileobj=fp, mode='rb')
+    elif magic == ZSTD_MAGIC:
+        _checkZstd()
+        stream = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(fp, closefd=True))
+    else:
+        stream = fp
+    return io.TextIOWrapper(stream, encoding='utf-8')
+
+def readPage(path: str):
+    """
+        Reads the whole html of a local page.
+    """
+    with openPage(path) as fp:
+        return fp.read()
+
+def iterPageChunks(path: str, chunkSize=READ_CHUNK):
+    """
+        Yields the html of a local page a chunk at a time.
+    """
+    with openPage(path) as fp:
+        while True:
+            chunk = fp.read(chunkSize)
+            if not chunk:
+                return
+            yield chunk
+
+def compressDirectory(localWebDir: str, compression="zstd", level=None, manifestPaths=()):
+    """
+        Rewrites every page in the directory with the given compression (or uncompressed with "none").
+        Each page keeps its mtime, and the manifests that had processed it are moved to its new size.
+        Returns (numPages, bytesBefore, bytesAfter).
+
+        :param manifestPaths: Manifest dbs of the stages reading the directory, ones that don't exist are skipped
+    """
+
+    numPages = 0
+    bytesBefore = 0
+    bytesAfter = 0
+    changes = []
+    for htmlPage in sorted(os.listdir(localWebDir)):
+        if htmlPage.endswith(".html"):
+            path = f"{localWebDir}/{htmlPage}"
+            st = os.stat(path)
+            bytesBefore += st.st_size
+            if getCompression(path) != compression:
+                html = readPage(path).encode('utf-8')
+
+                # Write next to the page and swap it in, so an interrupted run never leaves half a page
+                writePage(f"{path}.tmp", html, compression, level)
+                os.utime(f"{path}.tmp", ns=(st.st_atime_ns, st.st_mtime_ns))
+                os.replace(f"{path}.tmp", path)
+                changes.append((htmlPage, (st.st_mtime_ns, st.st_size), (st.st_mtime_ns, os.path.getsize(path))))
+            bytesAfter += os.path.getsize(path)
+            numPages += 1
+
+    for manifestPath in manifestPaths:
+        if os.path.exists(manifestPath):
+            manifest = Manifest(manifestPath)
+            manifest.restat(changes)
+            manifest.close()
+
+    return numPages, bytesBefore, bytesAfter
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--localWebDir", help="Directory of html files", type=str, default="tinyweb/")
+    parser.add_argument("-z", "--compression", help="How to store the pages", type=str, choices=COMPRESSIONS, default="zstd")
+    parser.add_argument("-l", "--level", help="Compression level", type=int, default=None)
+    parser.add_argument("-m", "--manifests", help="Manifests of the stages to keep up to date", type=str, nargs='*', default=list(STAGE_MANIFESTS))
+    args = parser.parse_args()
+
+    if not os.path.exists(args.localWebDir):
+        print(f"\tERROR! Cannot see local web directory: \"{args.localWebDir}\".")
+        exit(1)
+
+    numPages, bytesBefore, bytesAfter = compressDirectory(args.localWebDir, args.compression, args.level, args.manifests)
+    print(f"Stored {numPages} pages as {args.compression}: {bytesBefore / 2**20:.1f} MB -> {bytesAfter / 2**20:.1f} MB")
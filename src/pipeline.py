@@ -0,0 +1,138 @@
+# ====================================================================
+# Single pass over the tiny-web that updates both the link index and
+# the term frequency cache, parsing each page only once
+#
+# Each page becomes one record:
+# {
+#     "url": ...,
+#     "links": [url1, url14, ...],
+#     "title-tf": {...}, "header-tf": {...}, "text-tf": {...},
+#     "numTitleLemmas": ..., "numHeaderLemmas": ..., "numTextLemmas": ...
+# }
+#
+import os
+import argparse
+from json import dumps as json_dumps
+from json import loads as json_loads
+
+from htmlparse import Host, getPageContentLocal, getLinksFromHrefs, getURLAndHostFromFileName
+from nlp import generateTermFreqFromContent, removeTermFreqs, getLemmatizer
+from index import addPagesToIndex, replacePagesInIndex
+from linkgraph import LinkGraph
+from manifest import Manifest, DirectoryWatcher, bumpGeneration
+from metrics import logPage, flushMetrics, addMetricsArguments, applyMetricsArguments
+
+def processPage(htmlPath: str, webUrl: str, host: Host, parser="stream", positions=False):
+    """
+        Parses a page once and returns its record with both links and term frequencies.
+    """
+
+    content = getPageContentLocal(htmlPath, parser)
+    record = generateTermFreqFromContent(content, webUrl, positions)
+    record["links"] = sorted(getLinksFromHrefs(content.hrefs, host))
+
+    return record
+
+def updatePageCaches(htmlPages: list, localWebDir: str, termFreqDir: str, index, parser="stream", modifiedPages=(), removedPages=(), positions=False, unresolved=None):
+    """
+        Brings the index and term frequency cache up to date with the local web.
+        Pages missing from either are parsed once and fill in both.
+
+        :param htmlPages: List of html filenames in the local web directory
+        :param localWebDir: Directory the html files are in
+        :param termFreqDir: Directory of the term frequency json files
+        :param index: Either a dict of url -> list of urls, or a LinkGraph to append to
+        :param parser: Parser backend, see htmlparse.getPageContent
+        :param modifiedPages: Html filenames that changed since they were processed, these are redone
+        :param removedPages: Html filenames that no longer exist, these are dropped from both
+        :param positions: Also record lemma positions in the term frequencies, for phrase queries
+        :param unresolved: linkgraph.UnresolvedLinks for a dict index's links to pages it doesn't have yet (see index.addPagesToIndex)
+    """
+
+    # Changed pages are redone from scratch
+    removeTermFreqs(list(modifiedPages) + list(removedPages), termFreqDir)
+    modifiedPages = set(modifiedPages)
+    removeURLs = {getURLAndHostFromFileName(htmlPage[:-5])[0] for htmlPage in removedPages if htmlPage.endswith(".html")}
+
+    newPages = {}
+    replacedPages = {}
+    numTermFreqs = 0
+    for htmlPage in list(htmlPages) + [htmlPage for htmlPage in modifiedPages if htmlPage not in htmlPages]:
+
+        if htmlPage.endswith(".html"):
+            pagename = htmlPage[:-5]
+            htmlPath = f"{localWebDir}/{htmlPage}"
+            jsonPath = f"{termFreqDir}/{pagename}.json"
+
+            # Determine the weburl from the name
+            webUrl, host = getURLAndHostFromFileName(pagename)
+
+            isModified = htmlPage in modifiedPages
+            needsLinks = isModified or (webUrl not in index and webUrl not in newPages)
+            needsTF = not os.path.exists(jsonPath)
+            if needsLinks or needsTF:
+                logPage(f"[Pipeline] Adding \"{htmlPage}\"")
+                record = processPage(htmlPath, webUrl, host, parser, positions)
+
+                if isModified:
+                    replacedPages[webUrl] = record["links"]
+                elif needsLinks:
+                    newPages[webUrl] = record["links"]
+                if needsTF:
+                    del record["links"]
+                    with open(jsonPath, mode='w') as fp:
+                        fp.write(json_dumps(record))
+                    numTermFreqs += 1
+
+        else:
+            logPage(f"Skipping non-html file: \"{htmlPage}\"")
+
+    addPagesToIndex(index, newPages, unresolved)
+    if replacedPages or removeURLs:
+        replacePagesInIndex(index, replacedPages, removeURLs, unresolved)
+    if newPages or replacedPages or removeURLs or 0 < numTermFreqs:
+        bumpGeneration()
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--localWebDir", help="Directory of html files", type=str, default="tinyweb/")
+    parser.add_argument("-x", "--indexDir", help="Directory of the link index", type=str, default="index/")
+    parser.add_argument("-t", "--termFreqDir", help="Directory of the term frequency cache", type=str, default="term-freq/")
+    parser.add_argument("-p", "--parser", help="Html parser backend", type=str, choices=["stream", "html.parser", "lxml"], default="stream")
+    parser.add_argument("-r", "--pollingRate", help="Seconds between checks for new pages", type=float, default=10)
+    parser.add_argument("--positions", help="Also keep lemma positions, for phrase and proximity queries", action="store_true")
+    addMetricsArguments(parser)
+    args = parser.parse_args()
+    applyMetricsArguments(args)
+    getLemmatizer(download=True)
+
+    localWebDir = args.localWebDir
+    indexPath = f"{args.indexDir}/index.json"
+
+    # Initialize index (import the legacy json index if the graph is new)
+    index = LinkGraph(f"{args.indexDir}/graph")
+    if len(index) == 0 and os.path.exists(indexPath):
+        with open(indexPath, mode='r') as fp:
+            index.addPages(json_loads(fp.read()))
+
+    if not os.path.exists(args.termFreqDir):
+        print(f"[Pipeline]\tERROR! Cannot reach output termFreq directory: \"{args.termFreqDir}\".")
+        exit(1)
+
+    # Only the pages added, modified or removed since they were last processed are touched
+    manifest = Manifest(f"{args.indexDir}/pipeline-manifest.db")
+    watcher = DirectoryWatcher(localWebDir, args.pollingRate)
+    while True:
+        changedPages = watcher.wait()
+        print("[Pipeline] Tick.")
+        if not os.path.exists(localWebDir):
+            print(f"[Pipeline]\tERROR! Cannot see local web directory: \"{localWebDir}\".")
+            break
+
+        added, modified, removed = manifest.scan(localWebDir, changedPages)
+        if added or modified or removed:
+            print(f"[Pipeline] Changes to web: {len(added)} added, {len(modified)} modified, {len(removed)} removed.")
+            updatePageCaches(added, localWebDir, args.termFreqDir, index, args.parser, modified, removed, args.positions)
+            manifest.commit()
+            flushMetrics()
@@ -0,0 +1,126 @@
+# ====================================================================
+# Cache of search results for the head queries
+#
+# Keyed on the query's normalized lemmas (and topK), so "matrices" and
+# "matrix" share an entry, and bounded with LRU eviction and a per-entry TTL
+#
+# Every entry is dropped when the generation number changes
+# (updateWebIndex, updateTermFreqCache and determineEigenRankings bump it,
+# see manifest.py), the file is checked at most once every checkInterval seconds.
+# Results worked out before a clear are never put back: put takes the epoch
+# read when the query missed, and drops the results if the cache was cleared since
+#
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+from manifest import readGeneration, getGenerationPath
+from metrics import incr
+
+class QueryCache:
+    """
+        Thread safe LRU of (lemmas, topK) -> results with a TTL, cleared on a new generation.
+    """
+
+    def __init__(self, maxSize=10000, ttl=300.0, generationPath=None, checkInterval=1.0):
+        """
+            maxSize        - Max entries kept
+            ttl            - Seconds an entry is good for (None to only expire on a new generation)
+            generationPath - Generation file to watch (None for the one the stages bump)
+            checkInterval  - Seconds between reads of the generation file
+        """
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.generationPath = generationPath or getGenerationPath()
+        self.checkInterval = checkInterval
+        self.lock = Lock()
+        self.entries = OrderedDict()        # key -> (expires, results)
+        self.generation = readGeneration(self.generationPath) if self.generationPath else 0
+        self.epoch = 0                      # Number of clears, see put
+        self.nextCheck = monotonic() + checkInterval
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale = 0
+
+    def _checkGeneration(self, now: float):
+        self.nextCheck = now + self.checkInterval
+        if self.generationPath is None:
+            return
+        generation = readGeneration(self.generationPath)
+        if generation != self.generation:
+            self.generation = generation
+            self._clear()
+
+    def _clear(self):
+        self.epoch += 1
+        if self.entries:
+            self.invalidations += 1
+            incr("query_cache_invalidations")
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        """
+            Returns the cached results for a key, None on a miss.
+        """
+        now = monotonic()
+        with self.lock:
+            if self.nextCheck <= now:
+                self._checkGeneration(now)
+
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires, results = entry
+                if expires is None or now < expires:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    incr("query_cache_hits")
+                    return results
+                del self.entries[key]
+                self.expired += 1
+
+            self.misses += 1
+            incr("query_cache_misses")
+            return None
+
+    def put(self, key, results, epoch=None):
+        """
+            Caches the results for a key.
+
+            :param epoch: self.epoch when the results were looked up, they are dropped if the cache
+                          has been cleared since (a new generation came in while they were worked out)
+        """
+        with self.lock:
+            if epoch is not None and epoch != self.epoch:
+                self.stale += 1
+                incr("query_cache_stale_puts")
+                return
+            self.entries[key] = (None if self.ttl is None else monotonic() + self.ttl, results)
+            self.entries.move_to_end(key)
+            while self.maxSize < len(self.entries):
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """
+            Drops every entry, e.g. when the index being served is swapped.
+        """
+        with self.lock:
+            self._clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / lookups if 0 < lookups else 0.0,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "stalePuts": self.stale,
+                "generation": self.generation,
+                "cached": len(self.entries),
+            }
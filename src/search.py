@@ -0,0 +1,518 @@
+# ====================================================================
+# Answers queries against the inverted index
+#
+# Scores docs with BM25F over the title, header and text fields,
+# blended with the page's eigenranking, and returns the top k
+#
+# Queries are normalized with the same getLemmas used to build the term freqs
+#
+# Top k - Every term's postings are in blocks of 128 docs with their largest BM25F tf
+#         (blocks.bin, see invertedindex.py), so each block has an upper bound on its score.
+#         Blocks are decoded best bound first, and once the k-th best score beats every bound left
+#         the rest of the postings are never read. Phrase and window queries, and engines with other
+#         field weights or b than the blocks were written for, score every posting.
+#
+# Phrases - Quoted parts of a query ("linear algebra") only match docs with those lemmas
+#           next to each other, in order, in one field. With a window, every term of the query
+#           has to be within that many lemmas of the others in one field instead.
+#           Both are answered from positions.bin (see invertedindex.py), never the html
+#
+# A query can instead be blended with one of the personalized rankings (per host
+# or topic, see eigenranking.determinePersonalizedRankings) by its name
+#
+# Generations: publishGeneration copies an inverted index (and its eigenranking,
+# as docranks.npy aligned to the doc ids, and any personalized rankings, as
+# topicranks.npy) into indexDir/generations/gen-<n>/
+# and then swaps indexDir/CURRENT to name it, so a long-running reader
+# (see server.py) only ever sees a whole index
+#
+import os
+import re
+import shutil
+import argparse
+import numpy as np
+from time import time
+
+from nlp import getLemmas
+from invertedindex import InvertedIndex, lengthNorms, DOCS_FILE, DOCLENS_FILE, LEXICON_FILE, POSTINGS_FILE, POSITIONS_FILE, BLOCKS_FILE, BLOCK_B, BLOCK_FIELD_WEIGHTS
+
+DOCRANKS_FILE = "docranks.npy"
+TOPICRANKS_FILE = "topicranks.npy"
+TOPICS_FILE = "topics.txt"
+CURRENT_FILE = "CURRENT"
+GENERATIONS_DIR = "generations"
+
+_phrasePattern = re.compile(r'"([^"]*)"')
+
+def loadEigenRankings(eigenRankPath: str):
+    """
+        Reads an eigenranking file (probability \t url per line) into a dict of url -> probability.
+    """
+    eigenRanks = {}
+    with open(eigenRankPath, mode='r', encoding='utf-8') as fp:
+        for line in fp:
+            if line.strip():
+                p, url = line.rstrip("\n").split("\t", 1)
+                eigenRanks[url] = float(p)
+    return eigenRanks
+
+def writeDocRanks(invertedDir: str, eigenRankPath: str):
+    """
+        Writes the eigenranking aligned to the doc ids of an inverted index and scaled to [0, 1],
+        as invertedDir/docranks.npy, which SearchEngine memory maps instead of parsing the eigenranking file.
+    """
+    with open(f"{invertedDir}/{DOCS_FILE}", mode='r', encoding='utf-8') as fp:
+        urls = fp.read().splitlines()
+    eigenRanks = loadEigenRankings(eigenRankPath)
+    docRanks = np.fromiter((eigenRanks.get(url, 0.0) for url in urls), dtype=np.float64, count=len(urls))
+    if 0 < len(docRanks) and 0 < docRanks.max():
+        docRanks /= docRanks.max()
+    np.save(f"{invertedDir}/{DOCRANKS_FILE}", docRanks)
+
+def writeTopicRanks(invertedDir: str, personalizedDir: str):
+    """
+        Writes the personalized rankings aligned to the doc ids of an inverted index, each scaled to [0, 1],
+        as invertedDir/topicranks.npy (float32[k, numDocs]) and their names as invertedDir/topics.txt.
+        Returns the number of rankings written.
+    """
+    from eigenranking import loadPersonalizedRankings
+
+    personalized = loadPersonalizedRankings(personalizedDir)
+    if personalized is None:
+        return 0
+    names, urls, ranks = personalized
+    with open(f"{invertedDir}/{DOCS_FILE}", mode='r', encoding='utf-8') as fp:
+        docURLs = fp.read().splitlines()
+
+    enumLookup = {url: i for i, url in enumerate(urls)}
+    columns = np.fromiter((enumLookup.get(url, -1) for url in docURLs), dtype=np.int64, count=len(docURLs))
+    topicRanks = np.where(0 <= columns, ranks[:, np.maximum(columns, 0)], 0.0).astype(np.float32)
+    maxRanks = topicRanks.max(axis=1, keepdims=True) if 0 < len(docURLs) else np.ones((len(names), 1), dtype=np.float32)
+    topicRanks /= np.where(0 < maxRanks, maxRanks, 1.0)
+
+    np.save(f"{invertedDir}/{TOPICRANKS_FILE}", topicRanks)
+    with open(f"{invertedDir}/{TOPICS_FILE}", mode='w', encoding='utf-8') as fp:
+        fp.write("".join(f"{name}\n" for name in names))
+    return len(names)
+
+class SearchEngine:
+    """
+        Field weighted BM25 (BM25F) over an InvertedIndex, blended with eigenranking.
+    """
+
+    def __init__(self, invertedDir: str, eigenRankPath=None, fieldWeights=(3.0, 2.0, 1.0), k1=1.2, b=0.75, rankWeight=0.5, cache=None):
+        """
+            invertedDir   - Directory of the inverted index
+            eigenRankPath - Eigenranking file to blend in (None to use invertedDir/docranks.npy if there is one, else rank by text alone)
+            fieldWeights  - Weight of a term in the (title, header, text)
+            k1, b         - BM25 term frequency saturation and length normalization
+            rankWeight    - Weight of the eigenranking, which is scaled to [0, 1] before blending
+            cache         - QueryCache of results, keyed on invertedDir and the normalized query (None to not cache)
+        """
+        self.invertedDir = invertedDir
+        self.index = InvertedIndex(invertedDir)
+        self.fieldWeights = np.asarray(fieldWeights, dtype=np.float64)
+        self.k1 = k1
+        self.b = b
+        self.rankWeight = rankWeight
+        self.cache = cache
+
+        self.lengthNorm = lengthNorms(self.index.docLens, b)
+
+        # Eigenranking aligned to doc ids
+        self.docRanks = np.zeros(self.index.numDocs, dtype=np.float64)
+        docRanksPath = f"{invertedDir}/{DOCRANKS_FILE}"
+        if eigenRankPath is None and os.path.exists(docRanksPath) and 0 < self.index.numDocs:
+            self.docRanks = np.load(docRanksPath, mmap_mode='r')
+        elif eigenRankPath and os.path.exists(eigenRankPath):
+            eigenRanks = loadEigenRankings(eigenRankPath)
+            self.docRanks = np.fromiter((eigenRanks.get(url, 0.0) for url in self.index.urls), dtype=np.float64, count=self.index.numDocs)
+            if 0 < len(self.docRanks) and 0 < self.docRanks.max():
+                self.docRanks /= self.docRanks.max()
+
+        # Personalized rankings, one row per topic, picked per query
+        self.topics = {}
+        self.topicRanks = None
+        topicRanksPath = f"{invertedDir}/{TOPICRANKS_FILE}"
+        if os.path.exists(topicRanksPath) and 0 < self.index.numDocs:
+            with open(f"{invertedDir}/{TOPICS_FILE}", mode='r', encoding='utf-8') as fp:
+                self.topics = {name: j for j, name in enumerate(fp.read().splitlines())}
+            self.topicRanks = np.load(topicRanksPath, mmap_mode='r')
+
+    def normalizeQuery(self, query: str):
+        """
+            Returns the distinct lemmas of a query, in order.
+        """
+        return list(dict.fromkeys(getLemmas(query)))
+
+    def normalizePhrases(self, query: str):
+        """
+            Returns the lemmas of each quoted phrase of a query, as tuples.
+        """
+        phrases = (tuple(getLemmas(phrase)) for phrase in _phrasePattern.findall(query))
+        return [phrase for phrase in phrases if phrase]
+
+    def idf(self, docFreq: int):
+        N = self.index.numDocs
+        return np.log(1.0 + (N - docFreq + 0.5) / (docFreq + 0.5))
+
+    def termScores(self, docIds: np.ndarray, tfs: np.ndarray, docFreq: int):
+        """
+            BM25F score of one term in each of the given docs.
+        """
+        # Weighted, length normalized tf summed over the fields, then saturated
+        tf = (tfs / np.take(self.lengthNorm, docIds, axis=0)) @ self.fieldWeights
+        return self.idf(docFreq) * tf / (self.k1 + tf)
+
+    def scoreTerms(self, terms: list):
+        """
+            Term at a time BM25F accumulation, only touches the postings of the query terms.
+            Returns (docIds, scores) of every doc matching at least one term.
+        """
+        allDocIds = []
+        allScores = []
+        for term in terms:
+            docIds, tfs = self.index.getPostings(term)
+            if len(docIds) == 0:
+                continue
+            allDocIds.append(docIds)
+            allScores.append(self.termScores(docIds, tfs, len(docIds)))
+        return sumTermScores(allDocIds, allScores)
+
+    def canSkipBlocks(self, topK: int):
+        """
+            Whether the maxTF of blocks.bin bounds this engine's scores, it was written for one set of field weights and b.
+        """
+        return (self.index.hasBlocks and 0 < topK and 0 < self.k1 and self.b == BLOCK_B
+                and tuple(self.fieldWeights) == BLOCK_FIELD_WEIGHTS)
+
+    def scoreTopTerms(self, terms: list, topK: int, ranks: np.ndarray):
+        """
+            Term at a time MaxScore over postings blocks, only decodes the blocks that can still reach the top k.
+            Returns (docIds, scores) of the docs that can be in the top k, with the ranking blended in.
+
+            Terms go best bound first. A block of a term is decoded if it has a doc already matched that
+            can still make it, or if a new doc in it could, by the block's bound plus the best bound of
+            every term after it and the best rank in the block. The k-th best score so far (of the terms
+            seen, a lower bound) rises as blocks are decoded, so head terms usually stop after a few blocks.
+        """
+        termBlocks = []
+        for term in terms:
+            docFreq = self.index.docFreq(term)
+            if docFreq == 0:
+                continue
+            blocks = self.index.getBlocks(term)
+            maxTF = blocks["maxTF"]
+            termBlocks.append((term, docFreq, blocks, self.idf(docFreq) * maxTF / (self.k1 + maxTF)))
+        if len(termBlocks) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        termOrder = sorted(range(len(termBlocks)), key=lambda t: -termBlocks[t][3].max())
+        rests = np.append(np.cumsum([termBlocks[t][3].max() for t in termOrder][::-1])[::-1][1:], 0.0)
+
+        weightedRanks = self.rankWeight * ranks
+        partial = np.zeros(self.index.numDocs, dtype=np.float64)   # Score of the terms so far, of every matched doc
+        decodedScores = [[] for _ in termBlocks]    # Per term, the (docIds, scores) of each decoded batch
+        matched = np.zeros(self.index.numDocs, dtype=bool)
+        best = np.zeros(0, dtype=np.int64)     # The docs with the k best scores so far
+        inBatch = np.zeros(self.index.numDocs, dtype=bool)
+        threshold = -np.inf
+        for t, rest in zip(termOrder, rests):
+            term, docFreq, blocks, blockBounds = termBlocks[t]
+            lastDocIds = blocks["lastDocId"]
+            blockStarts = np.concatenate(([0], lastDocIds[:-1] + 1))
+
+            # Matched docs that can still make it, with this term's block
+            docIds = np.flatnonzero(matched)
+            blockIds = np.searchsorted(lastDocIds, docIds)
+            inside = blockIds < len(blocks)
+            bounds = partial[docIds] + weightedRanks[docIds] + rest
+            bounds[inside] += blockBounds[blockIds[inside]]
+            needed = np.zeros(len(blocks), dtype=bool)
+            needed[blockIds[inside & (threshold <= bounds + _slack(bounds))]] = True
+
+            # Best bound of a doc the block would add
+            newBounds = blockBounds + rest + np.maximum.reduceat(weightedRanks[:lastDocIds[-1] + 1], blockStarts)
+            newBounds += _slack(newBounds)
+            blockOrder = np.argsort(-newBounds, kind='stable')
+            decoded = np.zeros(len(blocks), dtype=bool)
+            done = 0
+            batchSize = 8
+            while True:
+                batch = blockOrder[done:done + batchSize]
+                batch = batch[threshold <= newBounds[batch]]
+                if done == 0:
+                    batch = np.union1d(batch, np.flatnonzero(needed))
+                batch = np.sort(batch[~decoded[batch]])
+                done += batchSize
+                batchSize *= 2
+                if 0 < len(batch):
+                    decoded[batch] = True
+                    docIds, tfs = self.index.getBlockPostings(term, blocks, batch)
+                    scores = self.termScores(docIds, tfs, docFreq)
+                    decodedScores[t].append((docIds, scores))
+                    partial[docIds] += scores
+                    matched[docIds] = True
+
+                    # The k-th best of the scores so far is a lower bound on the k-th best score,
+                    # only the docs of this batch could have passed the k best before it
+                    inBatch[docIds] = True
+                    docIds = np.concatenate((best[~inBatch[best]], docIds))
+                    inBatch[docIds] = False
+                    scores = partial[docIds] + weightedRanks[docIds]
+                    if topK <= len(docIds):
+                        top = np.argpartition(scores, len(scores) - topK)[len(scores) - topK:]
+                        best = docIds[top]
+                        threshold = max(threshold, scores[top].min())
+                    else:
+                        best = docIds
+                if len(blockOrder) <= done or newBounds[blockOrder[done]] < threshold:
+                    break
+
+        # A doc left out of a block it's in could never have reached the threshold, so its score here is
+        # short, but the docs at or over it have every one of their terms, added up in the same order as scoreTerms
+        docIds = np.flatnonzero(matched)
+        docIds = docIds[threshold - _slack(threshold) <= partial[docIds] + weightedRanks[docIds]]
+        scores = np.zeros(len(docIds), dtype=np.float64)
+        termScores = np.zeros(self.index.numDocs, dtype=np.float64)
+        for batches in decodedScores:
+            for batchIds, batchScores in batches:
+                termScores[batchIds] = batchScores
+            scores += termScores[docIds]
+            for batchIds, _ in batches:
+                termScores[batchIds] = 0.0
+        return docIds, scores + self.rankWeight * ranks[docIds]
+
+    def _gatherPositions(self, terms: list, docIds: np.ndarray):
+        """
+            Returns, for each term, the positions it has in docIds as (groups, positions), in group order.
+            The group of a position is 3 * (index in docIds) + field, docIds must all contain every term.
+        """
+        gathered = []
+        for term in terms:
+            termDocIds, tfs, positions, starts = self.index.getPositions(term)
+            rows = np.searchsorted(termDocIds, docIds)
+            lengths = tfs[rows].ravel()
+            firsts = starts[:-1].reshape(-1, 3)[rows].ravel()
+            ends = np.cumsum(lengths)
+            indices = np.repeat(firsts - (ends - lengths), lengths) + np.arange(ends[-1] if len(ends) else 0)
+            gathered.append((np.repeat(np.arange(len(lengths)), lengths), positions[indices]))
+        return gathered
+
+    def matchPhrase(self, lemmas: tuple, window=None):
+        """
+            Finds the docs where the lemmas appear in one field as an exact phrase, or with a window,
+            all within a span of window lemmas in any order.
+            Returns (docIds, counts), counts is int64[n, 3], the matches in the (title, header, text) of each doc.
+            Raises ValueError if the index has no positions.
+        """
+        if not self.index.hasPositions:
+            raise ValueError(f"Phrase and window queries need {POSITIONS_FILE}, build the term frequencies with positions (nlp.py --positions)")
+        distinct = list(dict.fromkeys(lemmas))
+        empty = np.zeros(0, dtype=np.int64), np.zeros((0, 3), dtype=np.int64)
+        if not distinct:
+            return empty
+
+        # Only docs with every lemma can match, start from the rarest
+        docIds = None
+        for term in sorted(distinct, key=self.index.docFreq):
+            termDocIds = self.index.getPostings(term)[0]
+            docIds = termDocIds if docIds is None else np.intersect1d(docIds, termDocIds, assume_unique=True)
+            if len(docIds) == 0:
+                return empty
+        gathered = dict(zip(distinct, self._gatherPositions(distinct, docIds)))
+
+        # Each occurrence as one sortable key, group in the high bits, position in the low ones
+        def keys(groups, positions):
+            return (groups << 32) | positions
+
+        if window is None:
+            # A phrase starts at p if its i-th lemma is at p + i, so shift each back by i and intersect
+            matched = None
+            for i, lemma in enumerate(lemmas):
+                groups, positions = gathered[lemma]
+                shifted = keys(groups, positions - i + len(lemmas))
+                matched = shifted if matched is None else np.intersect1d(matched, shifted, assume_unique=True)
+            matchedGroups = matched >> 32
+        else:
+            # A window starts at an occurrence p if the next occurrence of every lemma at or after p,
+            # in the same field, is less than window lemmas on
+            starts = np.concatenate([keys(*gathered[lemma]) for lemma in distinct])
+            covered = np.ones(len(starts), dtype=bool)
+            for lemma in distinct:
+                lemmaKeys = keys(*gathered[lemma])
+                nexts = np.searchsorted(lemmaKeys, starts)
+                found = nexts < len(lemmaKeys)
+                nextKeys = lemmaKeys[np.minimum(nexts, len(lemmaKeys) - 1)]
+                covered &= found & (nextKeys >> 32 == starts >> 32) & (nextKeys - starts < window)
+            matchedGroups = starts[covered] >> 32
+
+        counts = np.bincount(matchedGroups, minlength=3 * len(docIds)).reshape(-1, 3)
+        matches = 0 < counts.sum(axis=1)
+        return docIds[matches], counts[matches]
+
+    def getRanks(self, topic=None):
+        """
+            Returns the ranking to blend in, the global eigenranking or the personalized ranking of a topic.
+        """
+        if topic is None:
+            return self.docRanks
+        j = self.topics.get(topic)
+        if j is None:
+            raise ValueError(f"No personalized ranking named \"{topic}\", have {sorted(self.topics.keys())}")
+        return self.topicRanks[j]
+
+    def search(self, query: str, topK=10, topic=None, window=None):
+        """
+            Returns up to topK (score, url) tuples, best first.
+            With a cache, the list may be shared with other callers, so don't modify it.
+
+            :param topic: Name of a personalized ranking to blend in instead of the global one
+            :param window: Only match docs with every query term within a span of this many lemmas, in one field
+        """
+        terms = self.normalizeQuery(query)
+        phrases = self.normalizePhrases(query)
+        if self.cache is None:
+            return self.searchTerms(terms, topK, topic, phrases, window)
+
+        # The cache may be shared by the engines of several generations
+        key = (self.invertedDir, tuple(terms), topK, topic, tuple(phrases), window)
+        results = self.cache.get(key)
+        if results is None:
+            epoch = self.cache.epoch
+            results = self.searchTerms(terms, topK, topic, phrases, window)
+            self.cache.put(key, results, epoch)
+        return results
+
+    def searchTerms(self, terms: list, topK=10, topic=None, phrases=(), window=None):
+        """
+            search() for an already normalized query, never cached.
+
+            :param phrases: Lemma tuples that must each appear as a phrase (see matchPhrase)
+        """
+        ranks = self.getRanks(topic)
+        if window is not None and window < 1:
+            raise ValueError(f"The window must be at least 1 lemma, got {window}")
+        constraints = [(phrase, None) for phrase in phrases]
+        if window is not None and 1 < len(terms):
+            constraints.append((tuple(terms), window))
+
+        if len(constraints) == 0 and self.canSkipBlocks(topK):
+            docIds, scores = self.scoreTopTerms(terms, topK, ranks)
+            if len(docIds) == 0:
+                return []
+        else:
+            docIds, scores = self.scoreTerms(terms)
+            if len(docIds) == 0:
+                return []
+
+            # Phrase and window matches are filters on the BM25F matches
+            for lemmas, span in constraints:
+                matchedIds, _ = self.matchPhrase(lemmas, span)
+                keep = np.isin(docIds, matchedIds, assume_unique=True)
+                docIds, scores = docIds[keep], scores[keep]
+                if len(docIds) == 0:
+                    return []
+
+            scores = scores + self.rankWeight * ranks[docIds]
+
+        # Select the top k without sorting every match, ties go to the lower doc id
+        if 0 < topK < len(scores):
+            top = np.flatnonzero(np.partition(scores, len(scores) - topK)[len(scores) - topK] <= scores)
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind='stable')][:topK]
+
+        return [(float(scores[i]), self.index.urls[docIds[i]]) for i in top]
+
+def _slack(bounds: np.ndarray):
+    """
+        Rounding slack for upper bounds, which are summed in another order than the scores.
+    """
+    return 1e-9 * np.abs(bounds)
+
+def sumTermScores(allDocIds: list, allScores: list):
+    """
+        Adds up per term (docIds, scores) into one score per doc, in doc id order.
+    """
+    if len(allDocIds) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+
+    docIds, inverse = np.unique(np.concatenate(allDocIds), return_inverse=True)
+    scores = np.bincount(inverse, weights=np.concatenate(allScores), minlength=len(docIds))
+    return docIds, scores
+
+## =========== ##
+## Generations ##
+## =========== ##
+
+def getCurrentGeneration(indexDir: str):
+    """
+        Returns the directory of the published generation, None if nothing has been published.
+    """
+    try:
+        with open(f"{indexDir}/{CURRENT_FILE}", mode='r', encoding='utf-8') as fp:
+            name = fp.read().strip()
+    except FileNotFoundError:
+        return None
+    return f"{indexDir}/{GENERATIONS_DIR}/{name}" if name else None
+
+def publishGeneration(indexDir: str, invertedDir: str, eigenRankPath=None, keep=3, personalizedDir=None):
+    """
+        Copies an inverted index (and its eigenranking and personalized rankings) into a new generation and makes it the current one.
+        The index files are copied rather than linked, so rebuilding invertedDir in place never
+        touches files a reader has mapped. Only the newest keep generations are kept.
+        Returns the directory of the new generation.
+    """
+    generationsDir = f"{indexDir}/{GENERATIONS_DIR}"
+    if not os.path.exists(generationsDir): os.makedirs(generationsDir)
+    numbers = sorted(int(name[4:]) for name in os.listdir(generationsDir) if name.startswith("gen-") and name[4:].isdigit())
+    name = f"gen-{numbers[-1] + 1 if numbers else 1}"
+
+    # Build it under a temporary name, so a crash never leaves a half generation that looks whole
+    tmpDir = f"{generationsDir}/.{name}.tmp"
+    if os.path.exists(tmpDir): shutil.rmtree(tmpDir)
+    os.makedirs(tmpDir)
+    for fileName in (DOCS_FILE, DOCLENS_FILE, LEXICON_FILE, POSTINGS_FILE):
+        shutil.copyfile(f"{invertedDir}/{fileName}", f"{tmpDir}/{fileName}")
+    for fileName in (POSITIONS_FILE, BLOCKS_FILE):
+        if os.path.exists(f"{invertedDir}/{fileName}"):
+            shutil.copyfile(f"{invertedDir}/{fileName}", f"{tmpDir}/{fileName}")
+    if eigenRankPath and os.path.exists(eigenRankPath):
+        writeDocRanks(tmpDir, eigenRankPath)
+    if personalizedDir and os.path.exists(personalizedDir):
+        writeTopicRanks(tmpDir, personalizedDir)
+    os.rename(tmpDir, f"{generationsDir}/{name}")
+
+    with open(f"{indexDir}/{CURRENT_FILE}.tmp", mode='w', encoding='utf-8') as fp:
+        fp.write(name + "\n")
+    os.replace(f"{indexDir}/{CURRENT_FILE}.tmp", f"{indexDir}/{CURRENT_FILE}")
+
+    # Readers still on an old generation keep their mapped files after the delete
+    for number in numbers[:max(0, len(numbers) + 1 - keep)]:
+        shutil.rmtree(f"{generationsDir}/gen-{number}", ignore_errors=True)
+    return f"{generationsDir}/{name}"
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("query", help="Search query, quote a phrase to only match it exactly (needs positions.bin)", type=str)
+    parser.add_argument("-k", "--topK", help="Number of results", type=int, default=10)
+    parser.add_argument("-i", "--invertedDir", help="Directory of the inverted index", type=str, default="index/inverted/")
+    parser.add_argument("-e", "--eigenRankPath", help="Eigenranking file to blend in", type=str, default="index/eigenranking.txt")
+    parser.add_argument("-w", "--rankWeight", help="Weight of the eigenranking in the score", type=float, default=0.5)
+    parser.add_argument("-t", "--topic", help="Blend in this personalized ranking instead (needs invertedDir/topicranks.npy, see publishGeneration)", type=str, default=None)
+    parser.add_argument("-n", "--window", help="Only match docs with every term within this many lemmas of each other (needs positions.bin)", type=int, default=None)
+    args = parser.parse_args()
+
+    if os.path.exists(args.invertedDir):
+        engine = SearchEngine(args.invertedDir, args.eigenRankPath, rankWeight=args.rankWeight)
+
+        t0 = time()
+        results = engine.search(args.query, args.topK, args.topic, args.window)
+        t1 = time()
+
+        for score, url in results:
+            print(f"{score:.4f}\t{url}")
+        print(f"{len(results)} results in {1000 * (t1 - t0):.2f} ms")
+    else:
+        print(f"\tERROR! Cannot see inverted index directory: \"{args.invertedDir}\".")
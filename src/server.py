@@ -0,0 +1,252 @@
+# ====================================================================
+# Resident query server
+#
+# Loads the published index generation (see search.publishGeneration) once,
+# memory mapped, and answers queries over HTTP
+#   GET /search?q=<query>&k=<topK>   - {"query", "generation", "results": [[score, url], ...], "ms"}
+#              &topic=<name>         - Blend in a personalized ranking (e.g. topic=SOF) instead of the global one
+#              &window=<n>           - Only match pages with every term within n lemmas of the others
+#                                      (quoted phrases in q match exactly, both need positions.bin)
+#   GET /health                      - Generation, whether the lemmatizer is loaded, cache stats, uptime
+#   GET /metrics                     - This worker's metrics (see metrics.py)
+#
+# Concurrency - The parent binds the socket and forks worker processes that all
+#               accept on it (one core each), each worker serves with a thread per connection
+# Hot swap    - Each worker polls indexDir/CURRENT, loads a new generation next to the old one
+#               and swaps the reference, queries already running finish on the generation they started on
+# Lemmatizer  - Loaded in the background as a worker starts, never downloaded (run nlp.py once for that).
+#               A lemma table (nlp.py --lemmaTable) answers the common words without it
+# Cache       - Each worker keeps a QueryCache of results (see querycache.py), keyed on the generation and cleared on a swap
+#               and when the stages bump indexDir/generation
+#
+#   python server.py -x index/ -p 8080 -w 4
+#
+import os
+import sys
+import signal
+import socket
+import argparse
+import multiprocessing
+from threading import Thread, Event
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from json import dumps as json_dumps
+from time import time, perf_counter
+
+from nlp import getLemmatizer, isLemmatizerLoaded, loadLemmaTable
+from search import SearchEngine, getCurrentGeneration
+from querycache import QueryCache
+from metrics import timer, incr, getMetrics
+
+MAX_TOP_K = 1000
+
+class Generation:
+    """
+        A loaded index generation, swapped whole so a query sees one consistent index.
+    """
+
+    def __init__(self, generationDir: str, rankWeight=0.5, cache=None):
+        self.name = os.path.basename(generationDir)
+        self.engine = SearchEngine(generationDir, rankWeight=rankWeight, cache=cache)
+
+class QueryService:
+    """
+        State shared by the request threads of one worker process.
+    """
+
+    def __init__(self, indexDir: str, rankWeight=0.5, reloadInterval=1.0, cacheSize=10000, cacheTTL=300.0):
+        self.indexDir = indexDir
+        self.rankWeight = rankWeight
+        self.reloadInterval = reloadInterval
+        self.cache = QueryCache(cacheSize, cacheTTL, f"{indexDir}/generation") if 0 < cacheSize else None
+        self.tStart = time()
+        self.stopped = Event()
+        self.generation = None
+        self.reload()
+
+    def reload(self):
+        """
+            Loads the current generation if it isn't the one being served.
+            The swap is one reference assignment, so in-flight queries are never dropped.
+            Returns True if the generation changed.
+        """
+        generationDir = getCurrentGeneration(self.indexDir)
+        if generationDir is None:
+            return False
+        if self.generation is not None and self.generation.name == os.path.basename(generationDir):
+            return False
+
+        t0 = perf_counter()
+        generation = Generation(generationDir, self.rankWeight, self.cache)
+        self.generation = generation
+        if self.cache is not None: self.cache.clear()
+        incr("server_reloads")
+        print(f"[Server {os.getpid()}] Serving \"{generation.name}\" ({generation.engine.index.numDocs} docs, loaded in {1000 * (perf_counter() - t0):.1f} ms).")
+        return True
+
+    def _watchGenerations(self):
+        while not self.stopped.wait(self.reloadInterval):
+            try:
+                self.reload()
+            except Exception as e:
+                # A generation deleted or half copied by hand, keep serving the old one
+                print(f"[Server {os.getpid()}]\tERROR! Failed to load a new generation: {type(e).__name__}: {e}")
+
+    def _warmupLemmatizer(self):
+        t0 = perf_counter()
+        try:
+            getLemmatizer()
+        except LookupError:
+            print(f"[Server {os.getpid()}]\tERROR! wordnet isn't installed, run nlp.py once to download it.")
+            return
+        print(f"[Server {os.getpid()}] Lemmatizer loaded in {1000 * (perf_counter() - t0):.1f} ms.")
+
+    def start(self):
+        Thread(target=self._warmupLemmatizer, daemon=True).start()
+        Thread(target=self._watchGenerations, daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def search(self, query: str, topK: int, topic=None, window=None):
+        generation = self.generation
+        if generation is None:
+            return None, []
+        incr("queries")
+        with timer("query_seconds"):
+            return generation.name, generation.engine.search(query, topK, topic, window)
+
+    def health(self):
+        generation = self.generation
+        return {
+            "pid": os.getpid(),
+            "generation": generation.name if generation else None,
+            "numDocs": generation.engine.index.numDocs if generation else 0,
+            "topics": sorted(generation.engine.topics.keys()) if generation else [],
+            "lemmatizer": isLemmatizerLoaded(),
+            "cache": self.cache.stats() if self.cache is not None else None,
+            "uptime": time() - self.tStart,
+        }
+
+class QueryHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    service = None
+
+    def _send(self, status: int, body: dict):
+        data = json_dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        params = parse_qs(parts.query)
+
+        if parts.path == "/search":
+            query = params.get("q", [""])[0]
+            topic = params.get("topic", [None])[0]
+            try:
+                topK = min(MAX_TOP_K, max(1, int(params.get("k", ["10"])[0])))
+                window = int(params["window"][0]) if "window" in params else None
+            except ValueError:
+                self._send(400, {"error": "k and window must be integers"})
+                return
+
+            t0 = perf_counter()
+            try:
+                generation, results = self.service.search(query, topK, topic, window)
+            except ValueError as e:
+                self._send(400, {"error": str(e)})
+                return
+            except Exception as e:
+                incr("query_errors")
+                self._send(500, {"error": f"{type(e).__name__}: {e}"})
+                return
+            if generation is None:
+                self._send(503, {"error": "no index generation has been published"})
+                return
+            self._send(200, {"query": query, "generation": generation, "results": results, "ms": 1000 * (perf_counter() - t0)})
+
+        elif parts.path == "/health":
+            self._send(200, self.service.health())
+        elif parts.path == "/metrics":
+            self._send(200, getMetrics())
+        else:
+            self._send(404, {"error": f"no such endpoint \"{parts.path}\""})
+
+    def log_message(self, format, *args):
+        pass
+
+## ======= ##
+## Workers ##
+## ======= ##
+
+def _serveWorker(sock: socket.socket, indexDir: str, lemmaTablePath, rankWeight: float, reloadInterval: float, cacheSize: int, cacheTTL: float):
+    """
+        Runs in each worker process: loads the index and serves on the socket shared by every worker.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)        # The parent stops the workers
+    if lemmaTablePath and os.path.exists(lemmaTablePath):
+        loadLemmaTable(lemmaTablePath)
+
+    service = QueryService(indexDir, rankWeight, reloadInterval, cacheSize, cacheTTL)
+    service.start()
+    handler = type("BoundQueryHandler", (QueryHandler,), {"service": service})
+
+    server = ThreadingHTTPServer(sock.getsockname()[:2], handler, bind_and_activate=False)
+    server.daemon_threads = True
+    server.socket.close()
+    server.socket = sock
+    signal.signal(signal.SIGTERM, lambda *_: Thread(target=server.shutdown).start())
+    try:
+        server.serve_forever()
+    finally:
+        service.stop()
+
+def serve(indexDir: str, host="127.0.0.1", port=8080, numWorkers=1, lemmaTablePath=None, rankWeight=0.5, reloadInterval=1.0, cacheSize=10000, cacheTTL=300.0):
+    """
+        Binds the socket, forks numWorkers worker processes onto it and waits for them.
+    """
+
+    sock = socket.create_server((host, port), backlog=1024)
+    print(f"[Server] Listening on http://{host}:{sock.getsockname()[1]} with {numWorkers} workers.")
+
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=_serveWorker, args=(sock, indexDir, lemmaTablePath, rankWeight, reloadInterval, cacheSize, cacheTTL), daemon=True) for _ in range(numWorkers)]
+    for worker in workers:
+        worker.start()
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("[Server] Stopping.")
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+        sock.close()
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-x", "--indexDir", help="Index directory with the published generations (see invertedindex.py --publish)", type=str, default="index/")
+    parser.add_argument("-a", "--host", help="Address to listen on", type=str, default="127.0.0.1")
+    parser.add_argument("-p", "--port", help="Port to listen on", type=int, default=8080)
+    parser.add_argument("-w", "--workers", help="Worker processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("-l", "--lemmaTable", help="Precomputed token -> lemma json (see nlp.py)", type=str, default=None)
+    parser.add_argument("-r", "--rankWeight", help="Weight of the eigenranking in the score", type=float, default=0.5)
+    parser.add_argument("--reloadInterval", help="Seconds between checks for a new generation", type=float, default=1.0)
+    parser.add_argument("--cacheSize", help="Query results cached per worker (0 to not cache)", type=int, default=10000)
+    parser.add_argument("--cacheTTL", help="Seconds a cached result is good for", type=float, default=300.0)
+    args = parser.parse_args()
+
+    if getCurrentGeneration(args.indexDir) is None:
+        print(f"[Server]\tWarning! Nothing published in \"{args.indexDir}\" yet, waiting for a generation.")
+    serve(args.indexDir, args.host, args.port, args.workers, args.lemmaTable, args.rankWeight, args.reloadInterval, args.cacheSize, args.cacheTTL)
@@ -0,0 +1,366 @@
+# ====================================================================
+# Eigenranking for graphs too big for one core (or one process's RAM)
+#
+# The link matrix is split into row blocks ("shards") saved as CSR arrays
+#   shardDir/meta.npz          - numPages, row start of each shard, dangling pages
+#   shardDir/urls.txt          - Url of each page id
+#   shardDir/shard-<k>/*.npy   - indptr, indices, data of rows [start_k, start_k+1)
+#
+# A linkgraph directory is sharded straight from its memory mapped files
+# (writeShardsFromLinkGraph), the whole link matrix is never built.
+#
+# Each iteration, a pool of worker processes computes its blocks of M @ v.
+# The shards are memory mapped, so a worker only needs the pages of the
+# shard it is on in RAM, and v / M @ v are shared memory, not pickled.
+#
+# Like eigenranking.py, duplicate pages (index/dedup.db) are merged into their
+# canonical page, and the rank state (--incremental) and generation are
+# updated the same way (see eigenranking.finishEigenRankings). The rank state
+# is saved without its links, so a later eigenranking.py --push warm starts without pushing.
+#
+# Also has BlockRank: per-host local ranks combined with a host-level rank,
+# used as a starting vector for the global iteration
+#
+import os
+import argparse
+import numpy as np
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+from multiprocessing.shared_memory import SharedMemory
+from urllib.parse import urlsplit
+from scipy.sparse import csr_matrix, vstack
+from time import time
+
+from eigenranking import (loadLinkMatrix, buildLinkMatrixFromEdges, powerIteration, collapseDuplicates, canonicalPageIds,
+                          loadRankState, warmStartVector, finishEigenRankings, writeEigenRankings)
+from linkgraph import loadLinkGraphURLs, iterLinkChunks
+from dedup import loadCanonicalMap
+from metrics import timer, incr, setGauge, flushMetrics, addMetricsArguments, applyMetricsArguments
+
+META_FILE = "meta.npz"
+URLS_FILE = "urls.txt"
+EDGES_FILE = "edges.bin"
+
+# Shards a worker keeps open, the least recently used is closed past this
+MAX_OPEN_SHARDS = 4
+
+## ====== ##
+## Shards ##
+## ====== ##
+
+def _balancedRowStarts(indptr: np.ndarray, numShards: int):
+    """
+        First row of each of numShards row blocks with about the same number of links each, and the end.
+    """
+    numPages = len(indptr) - 1
+
+    # Balance on links rather than rows, so no shard is much more work than the others
+    targetLinks = np.linspace(0, indptr[-1], numShards + 1)
+    rowStarts = np.searchsorted(indptr, targetLinks, side='left').clip(0, numPages)
+    rowStarts[0], rowStarts[-1] = 0, numPages
+    return np.maximum.accumulate(rowStarts)
+
+def _saveShard(shardDir: str, k: int, indptr: np.ndarray, indices: np.ndarray, data: np.ndarray):
+    blockDir = f"{shardDir}/shard-{k}"
+    if not os.path.exists(blockDir): os.makedirs(blockDir)
+    np.save(f"{blockDir}/indptr.npy", indptr)
+    np.save(f"{blockDir}/indices.npy", indices)
+    np.save(f"{blockDir}/data.npy", data)
+
+def _saveMeta(shardDir: str, rowStarts: np.ndarray, dangling: np.ndarray, urls=None):
+    np.savez(f"{shardDir}/{META_FILE}", numPages=len(dangling), rowStarts=rowStarts, dangling=dangling)
+    if urls is not None:
+        with open(f"{shardDir}/{URLS_FILE}", mode='w', encoding='utf-8') as fp:
+            fp.write("".join(f"{url}\n" for url in urls))
+
+def writeShards(matSparse, dangling: np.ndarray, shardDir: str, numShards: int, urls=None):
+    """
+        Splits the link matrix into numShards row blocks with about the same number of links each.
+
+        :param urls: Url of each page, saved with the shards so they can be ranked again without the index
+    """
+    matSparse = matSparse.tocsr()
+    if not os.path.exists(shardDir): os.makedirs(shardDir)
+
+    rowStarts = _balancedRowStarts(matSparse.indptr, numShards)
+    for k in range(numShards):
+        block = matSparse[rowStarts[k]:rowStarts[k+1]]
+        _saveShard(shardDir, k, block.indptr, block.indices, block.data)
+
+    _saveMeta(shardDir, rowStarts, dangling, urls)
+
+def writeShardsFromLinkGraph(graphDir: str, shardDir: str, numShards: int, canonical=None, chunkLinks=1 << 22):
+    """
+        writeShards for a linkgraph directory, without ever building the link matrix.
+        The links are streamed from the memory mapped rows (see linkgraph.iterLinkChunks) into a file per shard,
+        then each shard is sorted and deduplicated on its own, so at most a chunk or a shard of links is in memory.
+        Returns (urls, dangling), duplicate pages merged into their canonical page like eigenranking.collapseDuplicates.
+
+        :param canonical: Dict of duplicate url -> canonical url
+    """
+    if not os.path.exists(shardDir): os.makedirs(shardDir)
+    urls = loadLinkGraphURLs(graphDir)
+    numLinkedPages = len(urls)
+
+    # Page id after merging duplicates, links between a page and its duplicate are dropped
+    canonicalIds = canonicalPageIds(urls, canonical or {})
+    keep = canonicalIds == np.arange(numLinkedPages)
+    newIds = np.cumsum(keep) - 1
+    numPages = int(keep.sum())
+    def chunks():
+        for sources, targets in iterLinkChunks(graphDir, numLinkedPages, chunkLinks):
+            canonicalSources, canonicalTargets = canonicalIds[sources], canonicalIds[targets]
+            real = (canonicalSources != canonicalTargets) | (sources == targets)
+            yield newIds[canonicalSources[real]], newIds[canonicalTargets[real]]
+
+    # 1) Links into each page, to balance the shards
+    inDegree = np.zeros(numPages, dtype=np.int64)
+    for _, targets in chunks():
+        inDegree += np.bincount(targets, minlength=numPages)
+    indptr = np.zeros(numPages + 1, dtype=np.int64)
+    np.cumsum(inDegree, out=indptr[1:])
+    rowStarts = _balancedRowStarts(indptr, numShards)
+    del inDegree, indptr
+
+    # 2) Each link to the file of the shard its target is in, as (row in shard, source)
+    edgePaths = [f"{shardDir}/shard-{k}/{EDGES_FILE}" for k in range(numShards)]
+    for k in range(numShards):
+        if not os.path.exists(f"{shardDir}/shard-{k}"): os.makedirs(f"{shardDir}/shard-{k}")
+        open(edgePaths[k], mode='wb').close()
+    for sources, targets in chunks():
+        shards = np.searchsorted(rowStarts, targets, side='right') - 1
+        order = np.argsort(shards, kind='stable')
+        bounds = np.searchsorted(shards[order], np.arange(numShards + 1))
+        for k in np.flatnonzero(np.diff(bounds)):
+            edges = order[bounds[k]:bounds[k+1]]
+            with open(edgePaths[k], mode='ab') as fp:
+                np.stack((targets[edges] - rowStarts[k], sources[edges]), axis=1).astype(np.int64).tofile(fp)
+
+    # 3) Sort and deduplicate each shard, counting every page's out-links as it goes
+    outDegree = np.zeros(numPages, dtype=np.int64)
+    for k in range(numShards):
+        edges = np.fromfile(edgePaths[k], dtype=np.int64)
+        keys = np.unique(edges[0::2] * max(numPages, 1) + edges[1::2])
+        del edges
+        rows, indices = np.divmod(keys, max(numPages, 1))
+        blockIndptr = np.zeros(rowStarts[k+1] - rowStarts[k] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(blockIndptr) - 1), out=blockIndptr[1:])
+        outDegree += np.bincount(indices, minlength=numPages)
+        _saveShard(shardDir, k, blockIndptr, indices.astype(np.int32), np.zeros(0))
+        os.remove(edgePaths[k])
+
+    # 4) Uniform probability of following each out-link
+    for k in range(numShards):
+        indices = np.load(f"{shardDir}/shard-{k}/indices.npy", mmap_mode='r')
+        np.save(f"{shardDir}/shard-{k}/data.npy", 1.0 / outDegree[indices])
+
+    dangling = outDegree == 0
+    urls = [url for url, isKept in zip(urls, keep) if isKept]
+    _saveMeta(shardDir, rowStarts, dangling, urls)
+    return urls, dangling
+
+def loadShardURLs(shardDir: str):
+    """
+        Returns the urls saved with the shards, None if they were written without them.
+    """
+    urlsPath = f"{shardDir}/{URLS_FILE}"
+    if not os.path.exists(urlsPath):
+        return None
+    with open(urlsPath, mode='r', encoding='utf-8') as fp:
+        return fp.read().splitlines()
+
+def loadShard(shardDir: str, k: int, numPages: int):
+    blockDir = f"{shardDir}/shard-{k}"
+    indptr = np.load(f"{blockDir}/indptr.npy", mmap_mode='r')
+    indices = np.load(f"{blockDir}/indices.npy", mmap_mode='r')
+    data = np.load(f"{blockDir}/data.npy", mmap_mode='r')
+    return csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, numPages), copy=False)
+
+def loadShardedMatrix(shardDir: str):
+    """
+        Stacks the shards back into the whole link matrix (e.g. for BlockRank).
+        Returns (matrix, dangling)
+    """
+    meta = np.load(f"{shardDir}/{META_FILE}")
+    numPages = int(meta["numPages"])
+    shards = [loadShard(shardDir, k, numPages) for k in range(len(meta["rowStarts"]) - 1)]
+    return vstack(shards, format='csr'), meta["dangling"]
+
+## ======= ##
+## Workers ##
+## ======= ##
+
+_worker = {}
+
+def _initWorker(shardDir: str, numPages: int, rowStarts: np.ndarray, vName: str, outName: str):
+    _worker["shardDir"] = shardDir
+    _worker["numPages"] = numPages
+    _worker["rowStarts"] = rowStarts
+    _worker["shards"] = OrderedDict()
+    _worker["vShm"] = SharedMemory(name=vName)
+    _worker["outShm"] = SharedMemory(name=outName)
+    _worker["v"] = np.ndarray((numPages,), dtype=np.float64, buffer=_worker["vShm"].buf)
+    _worker["out"] = np.ndarray((numPages,), dtype=np.float64, buffer=_worker["outShm"].buf)
+
+def _multiplyShard(k: int):
+    """
+        out[rows of shard k] = M[rows of shard k] @ v
+    """
+    shards = _worker["shards"]
+    if k in shards:
+        shards.move_to_end(k)
+    else:
+        shards[k] = loadShard(_worker["shardDir"], k, _worker["numPages"])
+        if MAX_OPEN_SHARDS < len(shards):
+            shards.popitem(last=False)
+    start, end = _worker["rowStarts"][k], _worker["rowStarts"][k+1]
+    _worker["out"][start:end] = shards[k] @ _worker["v"]
+    return k
+
+def shardedPowerIteration(shardDir: str, numWorkers=None, damping=0.85, epsilon=1e-6, maxIter=100000, v0=None, verbose=True):
+    """
+        Damped power iteration over a sharded link matrix, one block of M @ v per task.
+        Returns (v, numIterations, residual)
+    """
+    meta = np.load(f"{shardDir}/{META_FILE}")
+    numPages = int(meta["numPages"])
+    rowStarts = meta["rowStarts"]
+    dangling = meta["dangling"]
+    numShards = len(rowStarts) - 1
+
+    vShm = SharedMemory(create=True, size=numPages * 8)
+    outShm = SharedMemory(create=True, size=numPages * 8)
+    try:
+        v = np.ndarray((numPages,), dtype=np.float64, buffer=vShm.buf)
+        out = np.ndarray((numPages,), dtype=np.float64, buffer=outShm.buf)
+        v[:] = 1.0 / numPages if v0 is None else np.asarray(v0, dtype=np.float64) / np.sum(v0)
+
+        teleport = (1.0 - damping) / numPages
+        residual = np.inf
+        n = 0
+        with Pool(numWorkers or cpu_count(), initializer=_initWorker, initargs=(shardDir, numPages, rowStarts, vShm.name, outShm.name)) as pool:
+            while epsilon < residual and n < maxIter:
+                danglingMass = v[dangling].sum()
+                with timer("rank_spmv_seconds"):
+                    pool.map(_multiplyShard, range(numShards))
+
+                vnew = damping * out + (damping * danglingMass / numPages + teleport)
+                residual = np.abs(vnew - v).sum()
+                v[:] = vnew
+                n += 1
+                incr("rank_iterations")
+                setGauge("rank_residual", residual)
+                if verbose and n%100 == 0: print(f"n={n}, epsilon={residual:.7g}")
+
+        return v.copy(), n, residual
+    finally:
+        for shm in (vShm, outShm):
+            shm.close()
+            shm.unlink()
+
+## ========= ##
+## BlockRank ##
+## ========= ##
+
+def getHostIds(urls: list):
+    """
+        Returns (hostIds, hosts), hostIds[i] is the index into hosts of the host of urls[i].
+    """
+    hostLookup = {}
+    hostIds = np.empty(len(urls), dtype=np.int64)
+    for i, url in enumerate(urls):
+        hostIds[i] = hostLookup.setdefault(urlsplit(url).netloc, len(hostLookup))
+    return hostIds, list(hostLookup.keys())
+
+def blockRank(matSparse, dangling: np.ndarray, hostIds: np.ndarray, damping=0.85, epsilon=1e-6, maxIter=100000):
+    """
+        BlockRank (Kamvar et al.): local PageRank within each host, a PageRank of the host graph
+        weighted by those local ranks, and their product as an approximate global rank.
+        Returns (approxV, localRanks, hostRanks)
+    """
+    matSparse = matSparse.tocoo()
+    numPages = matSparse.shape[0]
+    numHosts = int(hostIds.max()) + 1
+    targets, sources = matSparse.row, matSparse.col
+
+    # 1) Local ranks, using only the links that stay within the host
+    localRanks = np.zeros(numPages, dtype=np.float64)
+    internal = hostIds[sources] == hostIds[targets]
+    for h in range(numHosts):
+        pages = np.flatnonzero(hostIds == h)
+        localIds = np.full(numPages, -1, dtype=np.int64)
+        localIds[pages] = np.arange(len(pages))
+        edges = internal & (hostIds[sources] == h)
+        localMat, localDangling = buildLinkMatrixFromEdges(localIds[sources[edges]], localIds[targets[edges]], len(pages))
+        localRanks[pages], _, _ = powerIteration(localMat, localDangling, damping, epsilon, maxIter, verbose=False)
+
+    # 2) Host graph, each link weighted by the local rank of the page it leaves from
+    weights = matSparse.data * localRanks[sources]
+    hostMat = csr_matrix((weights, (hostIds[targets], hostIds[sources])), shape=(numHosts, numHosts))
+    colSums = np.asarray(hostMat.sum(axis=0)).ravel()
+    hostDangling = colSums == 0
+    hostMat = hostMat @ csr_matrix((1.0 / np.where(hostDangling, 1.0, colSums), (np.arange(numHosts), np.arange(numHosts))), shape=(numHosts, numHosts))
+    hostRanks, _, _ = powerIteration(hostMat.tocsr(), hostDangling, damping, epsilon, maxIter, verbose=False)
+
+    # 3) Approximate global rank
+    approxV = localRanks * hostRanks[hostIds]
+    return approxV / approxV.sum(), localRanks, hostRanks
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--indexPath", help="Web index json or linkgraph directory", type=str, default="index/graph")
+    parser.add_argument("-d", "--shardDir", help="Directory to keep the matrix shards in", type=str, default="index/shards")
+    parser.add_argument("-s", "--shards", help="Number of row blocks (0 reuses the shards already in shardDir)", type=int, default=cpu_count())
+    parser.add_argument("-w", "--workers", help="Worker processes", type=int, default=cpu_count())
+    parser.add_argument("-b", "--blockrank", help="Start from the BlockRank approximation (needs the whole matrix in memory, stacked from the shards)", action="store_true")
+    parser.add_argument("-o", "--eigenRankPath", help="Where to write the ranking", type=str, default="index/eigenranking.txt")
+    parser.add_argument("-r", "--incremental", help="Warm start from the last run's ranks and save this run's (index/rankstate/)", action="store_true")
+    parser.add_argument("--dedupPath", help="Dedup db of the duplicate pages to merge", type=str, default="index/dedup.db")
+    addMetricsArguments(parser)
+    args = parser.parse_args()
+    applyMetricsArguments(args)
+
+    rankStateDir = "index/rankstate"
+
+    if 0 < args.shards:
+        print(f"Writing {args.shards} shards...")
+        canonical = loadCanonicalMap(args.dedupPath)
+        if os.path.isdir(args.indexPath):
+            urls, _ = writeShardsFromLinkGraph(args.indexPath, args.shardDir, args.shards, canonical)
+        else:
+            matSparse, dangling, urls = loadLinkMatrix(args.indexPath)
+            if matSparse is not None:
+                if canonical: matSparse, dangling, urls = collapseDuplicates(matSparse, dangling, urls, canonical)
+                writeShards(matSparse, dangling, args.shardDir, args.shards, urls)
+            del matSparse
+        if not urls:
+            print(f"\tERROR! Cannot see local index path: \"{args.indexPath}\".")
+            exit(1)
+    else:
+        urls = loadShardURLs(args.shardDir)
+        if urls is None:
+            print(f"\tERROR! No shards in \"{args.shardDir}\" to reuse, run with --shards.")
+            exit(1)
+
+    v0 = None
+    prevState = loadRankState(rankStateDir) if args.incremental else None
+    if prevState is not None:
+        print("Warm starting from the previous ranking...")
+        v0 = warmStartVector(urls, *prevState)
+    elif args.blockrank:
+        print("Computing BlockRank start vector...")
+        hostIds, hosts = getHostIds(urls)
+        matSparse, dangling = loadShardedMatrix(args.shardDir)
+        v0, _, hostRanks = blockRank(matSparse, dangling, hostIds)
+        del matSparse
+        for host, p in zip(hosts, hostRanks): print(f"\t{host}: {p}")
+
+    print("Determining eigenvector...")
+    t0 = time()
+    v, n, residual = shardedPowerIteration(args.shardDir, args.workers, v0=v0)
+    print(f"Time elapsed: {time() - t0}")
+    print(f"\tIterations: {n}. Epsilon: {residual}. Eigenvector sums to {v.sum()}")
+
+    writeEigenRankings(args.eigenRankPath, finishEigenRankings(urls, v, rankStateDir if args.incremental else None))
+    flushMetrics()
@@ -1,85 +1,183 @@
 # ====================================================================
 #
 # Crawls through pages like wikipedia and downloads them locally
-# Traverses in a randomized DFS search
-# Requests limited to 1 page / 3 sec
-# A little bit of a bodge -- Expect it to run for ~1hr at a time 
-#                            then stop due to python recursion limits
+# Traverses in a BFS search, iteratively, so there is no depth limit
+# Several hosts can be crawled at once by a pool of worker threads
+# Requests are limited per host by a token bucket (default 1 page / 3 sec)
+# With a frontier database the crawl can be stopped and resumed at any time
+# With a dedup database pages with the same bytes as an earlier page are not saved
+# Pages can be saved compressed (see pagestore.py)
+# Downloads reuse one connection per host and, when refreshing pages already
+# on disk, revalidate them so unchanged pages cost a 304 (see fetcher.py)
+# Throughput is kept in the crawl_pages_per_second gauge (see metrics.py)
 #
 import os
 import argparse
-from random import randint
+from threading import Lock, Thread
 
-from htmlparse import Host, getSoup, getSoupLocal, getLinksFromSoup, getPageNameFromURL, getFileNameFromPageName
+from htmlparse import Host, getPageContentLocal, getLinksFromHTML, getLinksFromHrefs, getPageNameFromURL, getFileNameFromPageName
+from frontier import CrawlFrontier, PersistentFrontier
+from dedup import DedupStore
+from pagestore import COMPRESSIONS, writePage
+from fetcher import Fetcher
+from metrics import incr, RateMeter, logPage, flushMetrics, addMetricsArguments, applyMetricsArguments
 
-def webpageDFS(url: str, host: Host, localWebDir: str, delay=3.0):
+SEED_URLS = {
+    "WP": ("https://en.wikipedia.org/wiki/Linear_algebra", Host.WP),
+    "SOF": ("https://stackoverflow.com/questions/45380417/optimizing-a-webcrawl", Host.SOF),
+    "MW": ("https://www.merriam-webster.com/dictionary/web%20crawler", Host.MW),
+}
+
+def getLocalPath(url: str, host: Host, localWebDir: str):
+    return f"{localWebDir}/{getFileNameFromPageName(getPageNameFromURL(url, host), host)}"
+
+def crawlPage(url: str, host: Host, localWebDir: str, fetcher: Fetcher, dedup=None, compression="none", refresh=False):
+    """
+        Downloads a page (or reads it from disk if already there).
+        Returns the set of valid links on the page, None on failure.
+        An exact duplicate of a page already crawled is not saved and has no links of its own,
+        it is recorded as a duplicate in dedup and not requested again.
+
+        refresh - Revalidate pages already on disk with the server, re-downloading them if they changed
     """
-        DFS on the host website
 
-        url        - Full url to page: (e.g. "https://en.wikipedia.org/wiki/Linear_algebra")
-        host       - Enum to indicate where the page is hosted (e.g. Host.WP <-> wikipedia)
-        localWebDir   - Directory for caching the webpage
-        fValidLink - function that dictates what is considered a valid link on this page
-        delay      - Minimum time between each request from the host
+    # A duplicate found on an earlier crawl was never saved, don't download it again
+    if dedup is not None:
+        canonicalURL = dedup.getCanonical(url)
+        if canonicalURL is not None:
+            logPage(f"Skipping known duplicate of '{canonicalURL}': '{url}'.")
+            incr("pages_duplicate_skipped")
+            return set()
+
+    # Only download if the page is not on file (or is being refreshed)
+    localPath = getLocalPath(url, host, localWebDir)
+    content = None
+    if os.path.exists(localPath):
+        content = getPageContentLocal(localPath, "stream")
+        if not content.hasHead:     # Invalid HTML file save (happens if interupted during write)
+            content = None
+        elif not refresh:
+            return getLinksFromHrefs(content.hrefs, host)
+
+    logPage(f"Making request from \"{url}\".")
+    result = fetcher.fetch(url, revalidate=content is not None)
+    if result.notModified:
+        return getLinksFromHrefs(content.hrefs, host)
+    if not result.ok:
+        print(f"HTTP connection was denied to '{url}' ({result.status}).")
+        return None
+    html = result.body
+    if dedup is not None:
+        canonicalURL = dedup.checkContent(url, html)
+        if canonicalURL is not None:
+            logPage(f"Duplicate of '{canonicalURL}': '{url}'.")
+            incr("pages_duplicate")
+            return set()
+    writePage(localPath, html, compression)
+
+    return getLinksFromHTML(html.decode('utf-8', errors='replace'), host)
+
+def webpageBFS(seeds: list, localWebDir: str, numWorkers=4, rate=1.0/3.0, maxQueue=100000, maxPages=None, fetcher=None, frontierPath=None, prioritize=False, dedupPath=None, compression="none", metadataPath=None, refresh=False):
     """
+        BFS on the host websites
 
-    pageName = getPageNameFromURL(url, host)
+        seeds       - List of (url, host) to start from (e.g. [("https://en.wikipedia.org/wiki/Linear_algebra", Host.WP)])
+        localWebDir - Directory for caching the webpages
+        numWorkers  - Number of pages processed at once
+        rate        - Max requests per second to each host, or a dict of Host -> rate
+        maxQueue    - Max urls waiting in the frontier
+        maxPages    - Stop after this many pages (None to crawl until the frontier is empty)
+        fetcher     - Fetcher to download with, defaults to one keeping its validators at metadataPath
+        frontierPath - SQLite file to keep the frontier in, the crawl resumes from it if it exists
+                       (None keeps the frontier in memory)
+        prioritize  - Crawl the queued pages with the most in-links first (frontierPath only)
+        dedupPath   - SQLite file of content hashes and canonical urls (see dedup.py), None to keep duplicates
+        compression - How to save pages, one of pagestore.COMPRESSIONS
+        metadataPath - SQLite file of each page's ETag / Last-Modified (None to always download in full)
+        refresh     - Revalidate pages already on disk instead of trusting them
+
+        Returns the number of pages crawled.
+    """
 
     # Make sure the output directory is there
     if not os.path.exists(localWebDir): os.makedirs(localWebDir)
-        
-    # Only run if the page is not on file
-    localPath = f"{localWebDir}/{getFileNameFromPageName(pageName, host)}"
-    if not os.path.exists(localPath): 
-        soup, html = getSoup(url, delay)
-        if html:
-            with open(localPath, mode="wb") as fp:
-                fp.write(html)
-        else:
-            return
+
+    ownFetcher = fetcher is None
+    if ownFetcher:
+        fetcher = Fetcher(metadataPath)
+
+    hosts = {host for _, host in seeds}
+    rates = rate if isinstance(rate, dict) else {host: rate for host in hosts}
+    if frontierPath:
+        frontier = PersistentFrontier(frontierPath, rates, maxQueue, prioritize)
     else:
-        soup = getSoupLocal(localPath)
-        if soup.head == None:   # Invalid HTML file save (happens if interupted during write)
-            soup, html = getSoup(url, delay)
-            if html:
-                with open(localPath, mode="wb") as fp:
-                    fp.write(html)
-            else:
+        frontier = CrawlFrontier(rates, maxQueue)
+    for url, host in seeds:
+        frontier.put(url, host)
+    dedup = DedupStore(dedupPath) if dedupPath else None
+
+    numCrawled = [0]
+    countLock = Lock()
+    pagesPerSecond = RateMeter("crawl_pages_per_second")
+
+    def worker():
+        while True:
+            item = frontier.get()
+            if item is None:
                 return
+            url, host = item
+            linkSet = None
+            try:
+                linkSet = crawlPage(url, host, localWebDir, fetcher, dedup, compression, refresh)
+                if linkSet is not None:
+                    incr("pages_crawled")
+                    pagesPerSecond.mark()
+                    with countLock:
+                        numCrawled[0] += 1
+                        if maxPages is not None and maxPages <= numCrawled[0]:
+                            frontier.stop()
 
+                    # The frontier's seen-set skips pages that are already queued or crawled
+                    frontier.putMany(linkSet, host)
+            except Exception as e:
+                print(f"Error crawling '{url}': {e}")
+            finally:
+                frontier.taskDone(url, linkSet is not None)
 
-    # Get all the links from the page
-    # If the link is valid then recursively call this function
-    linkSet = getLinksFromSoup(soup, host)
+    threads = [Thread(target=worker, daemon=True) for _ in range(numWorkers)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
 
-    noLinksFound = True
-    for linkPath in linkSet:
-        # Check to see if this is a new page
-        pageName_i = getPageNameFromURL(linkPath, host)
-        localPath_i = f"{localWebDir}/{getFileNameFromPageName(pageName_i, host)}"
-        if not os.path.exists(localPath_i):
-            noLinksFound = False
-            webpageDFS(linkPath, host, localWebDir)
+    print(f"Crawled {numCrawled[0]} pages in {pagesPerSecond.seconds:.1f}s ({pagesPerSecond.rate:.2f} pages/s).")
+    if 0 < frontier.numDropped:
+        print(f"Frontier full, dropped {frontier.numDropped} links.")
+    frontier.close()
+    if dedup is not None:
+        dedup.close()
+    if ownFetcher:
+        fetcher.close()
 
-    # All links on this page have been visited, recurse at random then
-    if noLinksFound:
-        irand = randint(0, len(linkSet) - 1)
-        webpageDFS(list(linkSet)[irand], host, localWebDir)
+    return numCrawled[0]
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("-c", "--siteCode", help="Website seed code", type=str, choices=["WP", "SOF", "MW"], required=True)
+    parser.add_argument("-c", "--siteCode", help="Website seed code(s)", type=str, nargs='+', choices=list(SEED_URLS.keys()), required=True)
     parser.add_argument("-o", "--localWebDir", help="Directory to save html files", type=str, required=True)
+    parser.add_argument("-w", "--workers", help="Number of pages processed at once", type=int, default=4)
+    parser.add_argument("-r", "--rate", help="Max requests per second to each host", type=float, default=1.0/3.0)
+    parser.add_argument("-q", "--maxQueue", help="Max urls waiting in the frontier", type=int, default=100000)
+    parser.add_argument("-n", "--maxPages", help="Stop after this many pages", type=int, default=None)
+    parser.add_argument("-f", "--frontier", help="SQLite file to keep (and resume) the crawl frontier in", type=str, default=None)
+    parser.add_argument("-p", "--prioritize", help="Crawl pages with the most in-links first", action="store_true")
+    parser.add_argument("-z", "--compression", help="How to save pages", type=str, choices=COMPRESSIONS, default="none")
+    parser.add_argument("-m", "--metadata", help="SQLite file to keep each page's ETag / Last-Modified in", type=str, default=None)
+    parser.add_argument("--refresh", help="Revalidate pages already downloaded, re-downloading the ones that changed", action="store_true")
+    parser.add_argument("-d", "--dedup", help="SQLite file to record content hashes and canonical urls in", type=str, default=None)
+    addMetricsArguments(parser)
     args = parser.parse_args()
+    applyMetricsArguments(args)
 
-    siteCode = args.siteCode
-    localWebDir = args.localWebDir
-
-    if siteCode == "WP":
-        webpageDFS("https://en.wikipedia.org/wiki/Linear_algebra", Host.WP, localWebDir)
-    elif siteCode == "SOF":
-        webpageDFS("https://stackoverflow.com/questions/45380417/optimizing-a-webcrawl", Host.SOF, localWebDir)
-    elif siteCode == "MW":
-        webpageDFS("https://www.merriam-webster.com/dictionary/web%20crawler", Host.MW, localWebDir)
-    
\ No newline at end of file
+    seeds = [SEED_URLS[siteCode] for siteCode in args.siteCode]
+    webpageBFS(seeds, args.localWebDir, args.workers, args.rate, args.maxQueue, args.maxPages, frontierPath=args.frontier, prioritize=args.prioritize, dedupPath=args.dedup, compression=args.compression, metadataPath=args.metadata, refresh=args.refresh)
+    flushMetrics()
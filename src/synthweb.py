@@ -0,0 +1,169 @@
+# ====================================================================
+# Generates synthetic tiny-webs for benchmarking
+#
+# Pages are written to a directory in the tinyweb/ naming scheme
+# (wikipedia-<name>.html, stackoverflow-<id>-<slug>.html, ...), so every
+# stage runs on them unchanged
+#
+#   Links - Power law: a few pages have most of the out-links, and link targets
+#           are drawn by a Zipf popularity, so a few pages have most of the in-links
+#   Text  - Zipfian words from a made up vocabulary, split into a title, headers and paragraphs
+#
+# The same (numPages, seed, ...) always gives the same web
+#
+import os
+import argparse
+import numpy as np
+from json import dumps as json_dumps
+from json import loads as json_loads
+
+from htmlparse import Host, HOSTS, getFileNameFromPageName
+from pagestore import COMPRESSIONS, writePage
+
+META_FILE = "synthweb.json"
+
+# Boilerplate every page of a host links to, which the link filters have to throw away
+_NAV_LINKS = {
+    Host.WP: ["/wiki/Main_Page", "/wiki/Special:Random", "/wiki/Help:Contents", "/w/index.php?title=Special:Search", "#top"],
+    Host.SOF: ["/questions", "/tags", "/users/1/user", "https://stackoverflow.com/questions/ask", "#answers"],
+    Host.MW: ["/dictionary", "/thesaurus", "/games", "#top"],
+}
+
+def _pagePath(host: Host, i: int):
+    """
+        Returns (page name, link path) of page i of a host.
+    """
+    if host == Host.SOF:
+        return f"{1000000 + i}-question-{i}", f"/questions/{1000000 + i}/question-{i}"
+    if host == Host.MW:
+        return f"word{i}", f"/dictionary/word{i}"
+    return f"Page_{i}", f"/wiki/Page_{i}"
+
+def makeVocabulary(vocabSize: int, rng: np.random.Generator):
+    """
+        Made up, pronounceable-ish words, 3 to 10 letters.
+    """
+    letters = np.array(list("etaoinshrdlcumwfgypbvkjxqz"))
+    letterP = 1.0 / np.arange(1, len(letters) + 1)
+    letterP /= letterP.sum()
+    lengths = rng.integers(3, 11, size=vocabSize)
+    chars = rng.choice(letters, size=(vocabSize, 10), p=letterP)
+    words = ["".join(row[:n]) for row, n in zip(chars, lengths)]
+
+    # Keep them distinct so the vocabulary size is what was asked for
+    return [f"{word}{i}" if 1 < count else word for i, (word, count) in enumerate(zip(words, _counts(words)))]
+
+def _counts(words: list):
+    counts = {}
+    for word in words:
+        counts[word] = counts.get(word, 0) + 1
+    return [counts[word] for word in words]
+
+def zipfProbabilities(n: int, exponent: float):
+    p = 1.0 / np.arange(1, n + 1) ** exponent
+    return p / p.sum()
+
+def generateLinkGraph(numPages: int, rng: np.random.Generator, avgLinks=20.0, maxLinks=500, popularityExponent=0.9):
+    """
+        Returns (offsets, targets), page i links to targets[offsets[i]:offsets[i+1]].
+        Out-degrees are Pareto distributed, targets drawn by a Zipf popularity over a random order of the pages.
+    """
+    outDegree = np.minimum(np.rint((rng.pareto(2.0, numPages) + 1.0) * avgLinks / 2.0), min(maxLinks, numPages)).astype(np.int64)
+    offsets = np.zeros(numPages + 1, dtype=np.int64)
+    np.cumsum(outDegree, out=offsets[1:])
+
+    popularity = rng.permutation(numPages)
+    targets = popularity[rng.choice(numPages, size=int(offsets[-1]), p=zipfProbabilities(numPages, popularityExponent))]
+    return offsets, targets
+
+def _sentence(words: list, wordIds: np.ndarray):
+    return " ".join(words[i] for i in wordIds)
+
+def renderPage(host: Host, title: str, headers: list, paragraphs: list, links: list):
+    """
+        Html for a page, links are spread over the paragraphs like inline article links.
+        Paragraphs are a non-empty list of word lists.
+    """
+    parts = [f"<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>{title}</title></head><body>\n<div id=\"nav\">"]
+    parts.extend(f"<a href=\"{href}\">{href}</a>" for href in _NAV_LINKS[host])
+    parts.append(f"</div>\n<h1>{title}</h1>\n")
+
+    linkChunks = np.array_split(np.arange(len(links)), len(paragraphs))
+    for k, (paragraph, chunk) in enumerate(zip(paragraphs, linkChunks)):
+        if k % 3 == 0 and headers:
+            parts.append(f"<h2>{headers[k // 3 % len(headers)]}</h2>\n")
+        anchors = " ".join(f"<a href=\"{links[j]}\" title=\"{links[j]}\">{paragraph[0]}</a>" for j in chunk)
+        parts.append(f"<p>{' '.join(paragraph)} {anchors}</p>\n")
+
+    parts.append("</body></html>\n")
+    return "".join(parts)
+
+def generateTinyWeb(outDir: str, numPages: int, hosts=(Host.WP, Host.SOF), seed=0, avgLinks=20.0, vocabSize=50000, wordsPerPage=300, zipfExponent=1.1, compression="none"):
+    """
+        Writes a synthetic tiny-web of numPages html files to outDir, split evenly across hosts.
+        Links only point within a host, like the real crawls. Skipped if outDir already has the same web.
+        Returns the list of html file names.
+
+        :param avgLinks: Mean out-links per page (before the nav links)
+        :param vocabSize: Number of distinct words
+        :param wordsPerPage: Mean words of body text per page
+        :param zipfExponent: Skew of the word frequencies
+        :param compression: How to store the pages, one of pagestore.COMPRESSIONS
+    """
+
+    meta = {"numPages": numPages, "hosts": [host.name for host in hosts], "seed": seed, "avgLinks": avgLinks,
+            "vocabSize": vocabSize, "wordsPerPage": wordsPerPage, "zipfExponent": zipfExponent, "compression": compression}
+    metaPath = f"{outDir}/{META_FILE}"
+    if os.path.exists(metaPath):
+        with open(metaPath, mode='r') as fp:
+            prev = json_loads(fp.read())
+        if prev.get("meta") == meta:
+            return prev["htmlPages"]
+
+    if not os.path.exists(outDir): os.makedirs(outDir)
+    rng = np.random.default_rng(seed)
+    words = makeVocabulary(vocabSize, rng)
+    wordP = zipfProbabilities(vocabSize, zipfExponent)
+
+    htmlPages = []
+    hostSizes = [numPages // len(hosts) + (1 if h < numPages % len(hosts) else 0) for h in range(len(hosts))]
+    for host, hostPages in zip(hosts, hostSizes):
+        if hostPages == 0:
+            continue
+        offsets, targets = generateLinkGraph(hostPages, rng, avgLinks)
+        linkPaths = [_pagePath(host, i)[1] for i in range(hostPages)]
+
+        # Draw every word of the host at once, then cut it into pages
+        pageWords = np.maximum(20, rng.poisson(wordsPerPage, hostPages))
+        wordIds = rng.choice(vocabSize, size=int(pageWords.sum()), p=wordP)
+        wordStarts = np.concatenate(([0], np.cumsum(pageWords)))
+
+        for i in range(hostPages):
+            pageName, _ = _pagePath(host, i)
+            ids = wordIds[wordStarts[i]:wordStarts[i+1]]
+            title = f"{_sentence(words, ids[:3])} {pageName}"
+            headers = [_sentence(words, ids[k:k+3]) for k in range(3, 3 + 3 * max(1, len(ids) // 100), 3)]
+            paragraphs = [[words[j] for j in ids[k:k+60]] for k in range(0, len(ids), 60)]
+            links = [linkPaths[j] for j in targets[offsets[i]:offsets[i+1]]]
+
+            htmlPage = getFileNameFromPageName(pageName, host)
+            writePage(f"{outDir}/{htmlPage}", renderPage(host, title, headers, paragraphs, links).encode('utf-8'), compression)
+            htmlPages.append(htmlPage)
+
+    with open(metaPath, mode='w') as fp:
+        fp.write(json_dumps({"meta": meta, "htmlPages": htmlPages}))
+    return htmlPages
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--outDir", help="Directory to write the html files to", type=str, default="bench/tinyweb/")
+    parser.add_argument("-n", "--numPages", help="Number of pages", type=int, default=10000)
+    parser.add_argument("-c", "--hosts", help="Hosts to split the pages across", type=str, nargs='+', choices=[host.name for host in HOSTS if HOSTS[host].linkPattern], default=["WP", "SOF"])
+    parser.add_argument("-s", "--seed", help="Random seed", type=int, default=0)
+    parser.add_argument("-l", "--avgLinks", help="Mean out-links per page", type=float, default=20.0)
+    parser.add_argument("-z", "--compression", help="How to store the pages", type=str, choices=COMPRESSIONS, default="none")
+    args = parser.parse_args()
+
+    htmlPages = generateTinyWeb(args.outDir, args.numPages, [Host[name] for name in args.hosts], args.seed, args.avgLinks, compression=args.compression)
+    print(f"Generated {len(htmlPages)} pages in \"{args.outDir}\".")
@@ -0,0 +1,230 @@
+# ====================================================================
+# Compact binary store for the term frequencies of every page
+# (replaces one small json file per page in term-freq/)
+#
+# Stored as a directory of flat files
+#   terms.txt        - One term per line, line i is the term of term id i
+#   docs.tsv         - url \t segment \t offset \t numWords, one line per write (last line wins,
+#                      segment -1 marks a removed page)
+#   segment-<k>.bin  - int32 records, one per page, appended back to back
+#
+# Each record is
+#   [numTitle, numHeader, numText, numTitleLemmas, numHeaderLemmas, numTextLemmas,
+#    titleIds..., titleCounts..., headerIds..., headerCounts..., textIds..., textCounts...]
+# followed, for pages added with positions, by
+#    titlePositions..., headerPositions..., textPositions...
+# each field's positions grouped by term in the order of its ids, count of them per term
+# (so a record with positions is longer than its ids and counts, which is how it's told apart)
+#
+# Segments are memory mapped for reading, so reading the whole corpus is a
+# sequential scan of a few large files rather than a json parse per page
+#
+import os
+import numpy as np
+
+TERMS_FILE = "terms.txt"
+DOCS_FILE = "docs.tsv"
+WORD_DTYPE = np.int32
+HEADER_WORDS = 6
+
+# Fields in the order they are stored, matching the term freq json keys
+FIELDS = ("title-tf", "header-tf", "text-tf")
+FIELD_LENGTHS = ("numTitleLemmas", "numHeaderLemmas", "numTextLemmas")
+FIELD_POSITIONS = ("title-pos", "header-pos", "text-pos")
+
+class TermFreqStore:
+    """
+        Appendable term frequency store, random access by url and sequential scans.
+        Only one process should write to a store at a time.
+    """
+
+    def __init__(self, storeDir: str, segmentBytes=64 * 2**20):
+        """
+            storeDir     - Directory of the store, created if missing
+            segmentBytes - Size at which a new segment file is started
+        """
+        self.storeDir = storeDir
+        self.segmentBytes = segmentBytes
+        if not os.path.exists(storeDir): os.makedirs(storeDir)
+
+        self.terms = []
+        termsPath = f"{storeDir}/{TERMS_FILE}"
+        if os.path.exists(termsPath):
+            with open(termsPath, mode='r', encoding='utf-8') as fp:
+                self.terms = fp.read().splitlines()
+        self.termLookup = {term: i for i, term in enumerate(self.terms)}
+        self.numTermsSaved = len(self.terms)
+
+        self.docs = {}  # url -> (segment, offset, numWords)
+        docsPath = f"{storeDir}/{DOCS_FILE}"
+        if os.path.exists(docsPath):
+            with open(docsPath, mode='r', encoding='utf-8') as fp:
+                for line in fp:
+                    url, segment, offset, numWords = line.rstrip("\n").split("\t")
+                    if segment == "-1":
+                        self.docs.pop(url, None)
+                    else:
+                        self.docs[url] = (int(segment), int(offset), int(numWords))
+
+        # Continue appending to the newest segment
+        segments = [int(name[len("segment-"):-len(".bin")]) for name in os.listdir(storeDir) if name.startswith("segment-")]
+        self.segment = max(segments) if segments else 0
+        self.segmentPath = self._segmentPath(self.segment)
+        self.segmentWords = os.path.getsize(self.segmentPath) // np.dtype(WORD_DTYPE).itemsize if os.path.exists(self.segmentPath) else 0
+
+        self.pendingDocs = []
+        self.maps = {}
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __contains__(self, url: str):
+        return url in self.docs
+
+    def _segmentPath(self, segment: int):
+        return f"{self.storeDir}/segment-{segment}.bin"
+
+    def _termId(self, term: str):
+        termId = self.termLookup.get(term)
+        if termId is None:
+            termId = len(self.terms)
+            self.termLookup[term] = termId
+            self.terms.append(term)
+        return termId
+
+    ## Writing ##
+
+    def add(self, pageIndex: dict):
+        """
+            Adds (or replaces) a page, given in the term freq json format
+            (see nlp.generateTermFreqFromPage). Call flush() to make it durable.
+        """
+        header = [len(pageIndex[field]) for field in FIELDS] + [pageIndex[length] for length in FIELD_LENGTHS]
+        parts = [np.asarray(header, dtype=WORD_DTYPE)]
+        for field in FIELDS:
+            tf = pageIndex[field]
+            parts.append(np.fromiter((self._termId(term) for term in tf.keys()), dtype=WORD_DTYPE, count=len(tf)))
+            parts.append(np.fromiter(tf.values(), dtype=WORD_DTYPE, count=len(tf)))
+        if FIELD_POSITIONS[0] in pageIndex:
+            for field, posField in zip(FIELDS, FIELD_POSITIONS):
+                positions = pageIndex[posField]
+                parts.append(np.fromiter((p for term in pageIndex[field].keys() for p in positions[term]), dtype=WORD_DTYPE, count=sum(pageIndex[field].values())))
+        record = np.concatenate(parts)
+
+        if 0 < self.segmentWords and self.segmentBytes < (self.segmentWords + len(record)) * record.itemsize:
+            self.segment += 1
+            self.segmentPath = self._segmentPath(self.segment)
+            self.segmentWords = 0
+
+        with open(self.segmentPath, mode='ab') as fp:
+            record.tofile(fp)
+        self.maps.pop(self.segment, None)
+
+        entry = (self.segment, self.segmentWords, len(record))
+        self.docs[pageIndex["url"]] = entry
+        self.pendingDocs.append(f"{pageIndex['url']}\t{entry[0]}\t{entry[1]}\t{entry[2]}\n")
+        self.segmentWords += len(record)
+
+    def remove(self, url: str):
+        if url in self.docs:
+            del self.docs[url]
+            self.pendingDocs.append(f"{url}\t-1\t0\t0\n")
+
+    def flush(self):
+        """
+            Writes new terms and doc entries. Terms go first so every entry only refers to saved terms.
+        """
+        if self.numTermsSaved < len(self.terms):
+            with open(f"{self.storeDir}/{TERMS_FILE}", mode='a', encoding='utf-8') as fp:
+                fp.write("".join(f"{term}\n" for term in self.terms[self.numTermsSaved:]))
+            self.numTermsSaved = len(self.terms)
+        if self.pendingDocs:
+            with open(f"{self.storeDir}/{DOCS_FILE}", mode='a', encoding='utf-8') as fp:
+                fp.write("".join(self.pendingDocs))
+            self.pendingDocs = []
+
+    ## Reading ##
+
+    def _segmentArray(self, segment: int):
+        words = self.maps.get(segment)
+        if words is None:
+            words = np.memmap(self._segmentPath(segment), dtype=WORD_DTYPE, mode='r')
+            self.maps[segment] = words
+        return words
+
+    def _decode(self, words: np.ndarray):
+        """
+            Returns ((ids, counts) per field, field lengths) of one record.
+        """
+        sizes = words[:3]
+        lengths = words[3:HEADER_WORDS]
+        fields = []
+        offset = HEADER_WORDS
+        for size in sizes:
+            fields.append((words[offset:offset + size], words[offset + size:offset + 2*size]))
+            offset += 2 * size
+        return fields, lengths
+
+    def _decodePositions(self, words: np.ndarray, fields: list):
+        """
+            Returns the positions of each field of a record decoded by _decode, None if it has none.
+        """
+        offset = HEADER_WORDS + 2 * sum(len(ids) for ids, _ in fields)
+        if len(words) <= offset and any(len(ids) for ids, _ in fields):
+            return None
+        positions = []
+        for _, counts in fields:
+            numPositions = int(counts.sum())
+            positions.append(words[offset:offset + numPositions])
+            offset += numPositions
+        return positions
+
+    def getArrays(self, url: str):
+        """
+            Returns ([(termIds, counts) for title, header, text], [numTitleLemmas, numHeaderLemmas, numTextLemmas]),
+            None if the page is not in the store.
+        """
+        entry = self.docs.get(url)
+        if entry is None:
+            return None
+        segment, offset, numWords = entry
+        return self._decode(self._segmentArray(segment)[offset:offset + numWords])
+
+    def get(self, url: str):
+        """
+            Returns the page in the term freq json format, None if the page is not in the store.
+        """
+        entry = self.docs.get(url)
+        if entry is None:
+            return None
+        segment, offset, numWords = entry
+        words = self._segmentArray(segment)[offset:offset + numWords]
+        fields, lengths = self._decode(words)
+        positions = self._decodePositions(words, fields)
+
+        pageIndex = {"url": url}
+        for field, (ids, counts) in zip(FIELDS, fields):
+            pageIndex[field] = {self.terms[i]: int(c) for i, c in zip(ids, counts)}
+        for lengthKey, length in zip(FIELD_LENGTHS, lengths):
+            pageIndex[lengthKey] = int(length)
+        if positions is not None:
+            for posField, (ids, counts), fieldPositions in zip(FIELD_POSITIONS, fields, positions):
+                splits = np.split(fieldPositions, np.cumsum(counts)[:-1]) if len(ids) else []
+                pageIndex[posField] = {self.terms[i]: p.tolist() for i, p in zip(ids, splits)}
+        return pageIndex
+
+    def scan(self, positions=False):
+        """
+            Yields (url, fields, lengths) for every page, in storage order
+            (segment by segment, so each segment file is read sequentially).
+
+            :param positions: Yield (url, fields, lengths, positions) instead, positions is a flat array per field
+                              grouped by term like the ids (None for pages added without positions)
+        """
+        for url, (segment, offset, numWords) in sorted(self.docs.items(), key=lambda item: item[1]):
+            words = self._segmentArray(segment)[offset:offset + numWords]
+            fields, lengths = self._decode(words)
+            if positions:
+                yield url, fields, lengths, self._decodePositions(words, fields)
+            else:
+                yield url, fields, lengths
@@ -0,0 +1,36 @@
+# ====================================================================
+# The modules in src/ import each other by name, the same as when a stage is run from src/
+#
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+class LowerCaseLemmatizer:
+    """
+        Stands in for wordnet, which can't be downloaded by the tests.
+    """
+    def lemmatize(self, word: str):
+        return word.lower()
+
+@pytest.fixture
+def lemmatizer(monkeypatch):
+    import nlp
+
+    monkeypatch.setattr(nlp, "_lemmatizer", LowerCaseLemmatizer())
+    return nlp._lemmatizer
+
+@pytest.fixture(autouse=True)
+def generationPath(tmp_path):
+    """
+        Stages bump a generation file of the test's own, never index/generation.
+    """
+    import manifest
+
+    previous = manifest.getGenerationPath()
+    path = str(tmp_path / "generation")
+    manifest.setGenerationPath(path)
+    yield path
+    manifest.setGenerationPath(previous)
@@ -0,0 +1,137 @@
+import numpy as np
+import pytest
+
+from eigenranking import (buildLinkMatrixFromEdges, powerIteration, saveRankState, loadRankState, loadRankStateLinks, SOLVERS, compareSolvers,
+                          pushSeeds, forwardPush, warmStartVector)
+
+def randomGraph(numPages, numLinks, seed=0):
+    rng = np.random.default_rng(seed)
+    sources = rng.integers(0, numPages, numLinks)
+    # Mostly links within blocks of 20 pages, like sites linking to themselves
+    targets = np.where(rng.random(numLinks) < 0.9, (sources // 20) * 20 + rng.integers(0, 20, numLinks), rng.integers(0, numPages, numLinks)) % numPages
+    return sources, targets
+
+def solve(sources, targets, numPages):
+    matSparse, dangling = buildLinkMatrixFromEdges(sources, targets, numPages)
+    v, _, _ = powerIteration(matSparse, dangling, epsilon=1e-13, verbose=False)
+    return matSparse, dangling, v
+
+@pytest.fixture
+def rankState(tmp_path):
+    numPages = 2000
+    sources, targets = randomGraph(numPages, 12000)
+    urls = [f"https://en.wikipedia.org/wiki/Page_{i}" for i in range(numPages)]
+    matSparse, _, v = solve(sources, targets, numPages)
+    saveRankState(str(tmp_path), urls, v, matSparse)
+    return str(tmp_path), urls, sources, targets
+
+def pushAndCompare(rankStateDir, urls, sources, targets, maxSeeds):
+    numPages = len(urls)
+    matSparse, dangling, truth = solve(sources, targets, numPages)
+
+    prevState = loadRankState(rankStateDir)
+    prevLinks = loadRankStateLinks(rankStateDir, len(prevState[0]))
+    assert prevLinks is not None
+    x, r = pushSeeds(matSparse, urls, *prevState, *prevLinks)
+
+    # Only the rows near the change start with a residual
+    assert 0 < np.count_nonzero(r) <= maxSeeds
+
+    # The push stays near the change instead of touching every page
+    v, numPushes, _ = forwardPush(matSparse, dangling, x, r)
+    assert numPushes < numPages
+    warm = warmStartVector(urls, *prevState)
+    assert np.abs(v - truth).sum() < np.abs(warm - truth).sum()
+
+    # Without the edge budget, pushing alone converges
+    exact, _, residual = forwardPush(matSparse, dangling, x, r, epsilon=1e-8, maxEdges=10**10)
+    assert residual < 1e-7
+    assert np.abs(exact - truth).sum() < 1e-6
+
+    # Finishing with the solver gets the same ranking as a cold solve
+    v, _, _ = powerIteration(matSparse, dangling, epsilon=1e-12, v0=v, verbose=False)
+    assert np.abs(v - truth).sum() < 1e-9
+
+def test_push_after_rewiring_one_page(rankState):
+    rankStateDir, urls, sources, targets = rankState
+    rewired = sources != 7
+    sources = np.concatenate((sources[rewired], [7, 7, 7]))
+    targets = np.concatenate((targets[rewired], [100, 1500, 1999]))
+    pushAndCompare(rankStateDir, urls, sources, targets, maxSeeds=40)
+
+def test_push_after_adding_a_page(rankState):
+    rankStateDir, urls, sources, targets = rankState
+    newPage = len(urls)
+    sources = np.concatenate((sources, [newPage, newPage, 3, 40]))
+    targets = np.concatenate((targets, [5, 6, newPage, newPage]))
+    pushAndCompare(rankStateDir, urls + ["https://en.wikipedia.org/wiki/New"], sources, targets, maxSeeds=40)
+
+def test_push_after_removing_a_page(rankState):
+    rankStateDir, urls, sources, targets = rankState
+    removed = 500
+    keep = (sources != removed) & (targets != removed)
+    renumber = lambda ids: ids - (removed < ids)
+    affected = np.unique(np.concatenate((targets[sources == removed], sources[targets == removed])))
+    pushAndCompare(rankStateDir, urls[:removed] + urls[removed + 1:], renumber(sources[keep]), renumber(targets[keep]),
+                   maxSeeds=5 * len(affected) + 50)
+
+def test_unchanged_graph_has_no_residual(rankState):
+    rankStateDir, urls, sources, targets = rankState
+    matSparse, _, _ = solve(sources, targets, len(urls))
+    prevState = loadRankState(rankStateDir)
+    x, r = pushSeeds(matSparse, urls, *prevState, *loadRankStateLinks(rankStateDir, len(urls)))
+    assert np.count_nonzero(r) == 0
+    assert np.allclose(x, prevState[1])
+
+def test_warm_start_covers_new_pages(rankState):
+    rankStateDir, urls, _, _ = rankState
+    v0 = warmStartVector(urls + ["https://en.wikipedia.org/wiki/New"], *loadRankState(rankStateDir))
+    assert v0.sum() == pytest.approx(1.0)
+    assert v0[-1] == pytest.approx(1.0 / (len(urls) + 1))
+
+## ======= ##
+## Solvers ##
+## ======= ##
+
+@pytest.fixture(scope="module")
+def linkMatrix():
+    sources, targets = randomGraph(3000, 15000, seed=1)
+    # Some dangling pages, so the warm start has to account for their mass
+    linked = 100 <= sources
+    matSparse, dangling, truth = solve(sources[linked], targets[linked], 3000)
+    assert 100 <= dangling.sum()
+    return matSparse, dangling, truth
+
+@pytest.mark.parametrize("name", sorted(SOLVERS.keys()))
+def test_solvers_agree_with_power_iteration(linkMatrix, name):
+    matSparse, dangling, truth = linkMatrix
+    v, n, residual = SOLVERS[name](matSparse, dangling, 0.85, 1e-10, 10000)
+    assert 0 < n
+    assert v.sum() == pytest.approx(1.0)
+    assert residual < 1e-8
+    assert np.abs(v - truth).sum() < 1e-7
+
+@pytest.mark.parametrize("name", ["gauss-seidel", "sor", "gmres", "bicgstab"])
+def test_linear_solvers_warm_start_from_the_answer(linkMatrix, name):
+    matSparse, dangling, truth = linkMatrix
+    _, coldIterations, _ = SOLVERS[name](matSparse, dangling, 0.85, 1e-8, 10000)
+    # Any positive multiple of the ranking is as good a start
+    v, n, _ = SOLVERS[name](matSparse, dangling, 0.85, 1e-8, 10000, v0=truth * 7.0)
+    assert n <= 2 < coldIterations
+    assert np.abs(v - truth).sum() < 1e-7
+
+def test_compare_solvers_times_each_solver(linkMatrix):
+    matSparse, dangling, _ = linkMatrix
+    results = compareSolvers(matSparse, dangling, epsilon=1e-8, solvers=["power", "gauss-seidel"])
+    assert [name for name, _, _, _ in results] == ["power", "gauss-seidel"]
+    for _, n, seconds, residual in results:
+        assert 0 < n and 0 <= seconds and residual < 1e-6
+    # Gauss-Seidel uses new entries within a sweep, so needs fewer sweeps than power iteration does iterations
+    assert results[1][1] < results[0][1]
+
+def test_compare_solvers_is_quiet(capsys):
+    matSparse, dangling = buildLinkMatrixFromEdges(*randomGraph(200, 1000), 200)
+    # Never converges, so it runs up to the power iteration's progress line at 1000 iterations
+    [(name, n, _, _)] = compareSolvers(matSparse, dangling, epsilon=-1.0, maxIter=1000, solvers=["power"])
+    assert (name, n) == ("power", 1000)
+    assert capsys.readouterr().out == ""
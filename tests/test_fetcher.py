@@ -0,0 +1,110 @@
+import gzip
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+
+import pytest
+
+from fetcher import Fetcher, decodeBody
+
+PAGE = ("<html><head><title>Matrix</title></head><body>" + "eigenvalue " * 500 + "</body></html>").encode('utf-8')
+ETAG = '"v1"'
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+        A few pages of a keep-alive server, the way the spider sees real hosts.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, body=b"", headers=()):
+        self.send_response(status)
+        for key, value in headers:
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        if self.path == "/page":
+            if self.headers.get("If-None-Match") == ETAG:
+                self._send(304, headers=[("ETag", ETAG)])
+            elif "gzip" in self.headers.get("Accept-Encoding", ""):
+                self._send(200, gzip.compress(PAGE), [("Content-Encoding", "gzip"), ("ETag", ETAG)])
+            else:
+                self._send(200, PAGE, [("ETag", ETAG)])
+        elif self.path == "/moved":
+            self._send(301, headers=[("Location", "/page")])
+        elif self.path == "/closing":
+            self._send(200, PAGE, [("Connection", "close")])
+            self.close_connection = True
+        else:
+            self._send(404, b"not found")
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    httpd.requests = []
+    thread = Thread(target=httpd.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True)
+    thread.start()
+    yield httpd, f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+def test_fetch_decodes_and_reuses_the_connection(server):
+    httpd, base = server
+    fetcher = Fetcher()
+    for _ in range(3):
+        result = fetcher.fetch(f"{base}/page")
+        assert result.ok and result.body == PAGE
+    assert fetcher.stats["requests"] == 3
+    assert fetcher.stats["connections"] == 1
+    assert fetcher.stats["bytesReceived"] < fetcher.stats["bytesDecoded"] == 3 * len(PAGE)
+    assert "gzip" in httpd.requests[0][1]["Accept-Encoding"]
+    fetcher.close()
+
+def test_revalidation_gets_a_304(tmp_path, server):
+    httpd, base = server
+    fetcher = Fetcher(str(tmp_path / "metadata.db"))
+    assert fetcher.fetch(f"{base}/page").ok
+
+    result = fetcher.fetch(f"{base}/page", revalidate=True)
+    assert result.notModified and result.body is None
+    assert httpd.requests[-1][1]["If-None-Match"] == ETAG
+    assert fetcher.stats["notModified"] == 1
+
+    # Without revalidate, the validators aren't sent
+    assert fetcher.fetch(f"{base}/page").body == PAGE
+    assert "If-None-Match" not in httpd.requests[-1][1]
+    fetcher.close()
+
+def test_redirects_and_errors(server):
+    _, base = server
+    fetcher = Fetcher()
+    result = fetcher.fetch(f"{base}/moved")
+    assert result.ok and result.url == f"{base}/page" and result.body == PAGE
+
+    result = fetcher.fetch(f"{base}/missing")
+    assert result.status == 404 and not result.ok
+    assert fetcher.fetchBytes(f"{base}/missing") is None
+    fetcher.close()
+
+def test_reconnects_after_the_server_closes(server):
+    _, base = server
+    fetcher = Fetcher()
+    assert fetcher.fetch(f"{base}/closing").body == PAGE
+    assert fetcher.fetch(f"{base}/page").body == PAGE
+    assert fetcher.stats["connections"] == 2
+    fetcher.close()
+
+@pytest.mark.parametrize("encoding, encode", [
+    ("gzip", gzip.compress),
+    ("deflate", zlib.compress),
+    ("deflate", lambda body: zlib.compress(body)[2:-4]),     # Raw deflate, the way some servers send it
+    (None, lambda body: body),
+])
+def test_decode_body(encoding, encode):
+    assert decodeBody(encode(PAGE), encoding) == PAGE
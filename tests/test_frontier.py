@@ -0,0 +1,34 @@
+import pytest
+
+from frontier import CrawlFrontier, PersistentFrontier
+from htmlparse import Host
+
+def pageURL(i: int):
+    return f"https://en.wikipedia.org/wiki/Page_{i}"
+
+@pytest.fixture(params=["memory", "sqlite", "sqlite-prioritize"])
+def frontier(request, tmp_path):
+    rates = {Host.WP: 1e9}
+    if request.param == "memory":
+        frontier = CrawlFrontier(rates, maxQueue=3)
+    else:
+        frontier = PersistentFrontier(str(tmp_path / "frontier.db"), rates, maxQueue=3, prioritize=request.param.endswith("prioritize"))
+    yield frontier
+    frontier.close()
+
+def test_full_queue_only_drops_new_urls(frontier):
+    assert frontier.putMany([pageURL(i) for i in range(3)], Host.WP) == 3
+    assert frontier.numDropped == 0
+
+    # Already queued urls are not refused, they are just skipped
+    assert frontier.putMany([pageURL(0), pageURL(1), pageURL(2), pageURL(0)], Host.WP) == 0
+    assert frontier.numDropped == 0
+
+    assert frontier.putMany([pageURL(1), pageURL(3), pageURL(4)], Host.WP) == 0
+    assert frontier.numDropped == 2
+
+    # Crawled urls are still seen once there is room again
+    url, _ = frontier.get()
+    frontier.taskDone(url, True)
+    assert frontier.putMany([url, pageURL(5)], Host.WP) == 1
+    assert frontier.numDropped == 2
@@ -0,0 +1,67 @@
+import os
+import numpy as np
+import pytest
+from bs4 import BeautifulSoup
+
+from htmlparse import Host, HrefExtractor, getLinksFromSoup, getLinksFromHTML, getHrefsFromHTML, getPageContent
+from synthweb import generateTinyWeb
+
+TRICKY_HTML = """<html><head><title>t</title>
+<script>var s = '<a href="/questions/1/in-script">';</script>
+<style>a[href="/questions/2/in-style"] { color: red }</style>
+</head><body>
+<!-- <a href="/questions/3/in-comment">old</a> -->
+<a data-href="/questions/4/data-attr" href="/questions/5/real-link">x</a>
+<div title='<a href="/questions/6/in-attribute">'>y</div>
+<a HREF='/questions/7/upper-case?tab=votes#answer'>z</a>
+<a href=/questions/8/bare-value>w</a>
+<a href="/questions/9/first" href="/questions/10/second">dup</a>
+<a href="https://stackoverflow.com/questions/11/escaped&amp;x">e</a>
+<a name="no-href">n</a>
+<p>text <a href="/questions/12/in-paragraph">link</a></p>
+</body></html>"""
+
+def test_tricky_anchors_match_soup():
+    expected = getLinksFromSoup(BeautifulSoup(TRICKY_HTML, 'html.parser'), Host.SOF)
+    assert getLinksFromHTML(TRICKY_HTML, Host.SOF) == expected
+    assert "https://stackoverflow.com/questions/5/real-link" in expected
+    assert not any(part in link for link in expected for part in ("in-script", "in-style", "in-comment", "data-attr", "in-attribute"))
+
+def test_hrefs_match_soup_and_stream_parser():
+    soupHrefs = [a.get("href") for a in BeautifulSoup(TRICKY_HTML, 'html.parser').find_all('a') if a.get("href") is not None]
+    assert getHrefsFromHTML(TRICKY_HTML) == soupHrefs
+    assert getPageContent(TRICKY_HTML, "stream").hrefs == soupHrefs
+
+@pytest.mark.parametrize("host", [Host.WP, Host.SOF])
+def test_synthetic_pages_match_soup(tmp_path, host):
+    webDir = str(tmp_path / "web")
+    htmlPages = generateTinyWeb(webDir, 40, hosts=(Host.WP, Host.SOF), seed=3)
+    numLinks = 0
+    for htmlPage in htmlPages:
+        with open(os.path.join(webDir, htmlPage), encoding='utf-8') as fp:
+            html = fp.read()
+        links = getLinksFromHTML(html, host)
+        assert links == getLinksFromSoup(BeautifulSoup(html, 'html.parser'), host)
+        numLinks += len(links)
+    assert 0 < numLinks
+
+# Pieces of well and badly formed markup, glued together at random
+FRAGMENTS = ['<a href="/wiki/A">', "<a href='/wiki/B'>", '<a href=/wiki/C>', '<A HREF="/wiki/D&amp;e">', '</a>', '<p>', '</p>', 'text ', ' < ', ' > ', '&amp;', '&#',
+             '<!-- <a href="/c"> -->', '<!--', '-->', '-- >', '<!---->', '<script>', '</script>', '<script type="x">', '<style>', '</style >', '</ script>',
+             '<SCRIPT>', '</SCRIPT >', '<script/>', '<style a=/>', '</style', '<scriptx>', '<![CDATA[<a href="/cd">]]>', '<!DOCTYPE html>', '<?pi <a href="/pi">?>',
+             '<div title=\'<a href="/attr">\'>', '<a title=it\'s href="/q">', '<a\nhref="/nl">', '<a/href="/slash">', '<a href>', '<a href="/x" href="/y">',
+             '<abbr href="/abbr">', '<a data-href="/d">', '<a href = "/sp" >', '<a href="/unterminated', "'", '"', '<', '<a', '<br/>', '<a href="/self"/>',
+             '<img src=x alt="<a href=/img>">', '<a =x href="/eq">', '<a href=="/dbl">', '<a href="/ok"', "<a href='/m'x>", "<a href='/gt' title='>'>",
+             '<A\tHREF=/tab>', '<a href=x/>', '<a href="/p"/ x>', '<p <a href="/inp">', '</a <a href="/end">', '<a\x00href="/z">', '<a href="" >', '<a href="/é">']
+
+def streamHrefs(html: str):
+    extractor = HrefExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return extractor.hrefs
+
+def test_scan_matches_stream_parser_on_broken_markup():
+    rng = np.random.default_rng(0)
+    for _ in range(5000):
+        html = "".join(FRAGMENTS[i] for i in rng.integers(0, len(FRAGMENTS), rng.integers(1, 12)))
+        assert getHrefsFromHTML(html) == streamHrefs(html), html
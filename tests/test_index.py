@@ -0,0 +1,58 @@
+import pytest
+
+from index import updateWebIndex, reindexWebPages
+from linkgraph import LinkGraph, UnresolvedLinks, loadLinkGraph
+from synthweb import generateTinyWeb
+
+@pytest.fixture(scope="module")
+def web(tmp_path_factory):
+    webDir = str(tmp_path_factory.mktemp("web"))
+    return webDir, generateTinyWeb(webDir, 40, seed=5)
+
+def asSets(index: dict):
+    return {url: set(links) for url, links in index.items()}
+
+def graphAsSets(graph: LinkGraph):
+    urls, offsets, targets = loadLinkGraph(graph.graphDir)
+    return {url: {urls[j] for j in targets[offsets[i]:offsets[i+1]]} for i, url in enumerate(urls)}
+
+def test_dict_index_keeps_links_to_later_pages(tmp_path, web):
+    webDir, htmlPages = web
+    whole = {}
+    updateWebIndex(htmlPages, whole, webDir)
+
+    # Pages arriving in batches end up with the same links as indexing them all at once
+    index = {}
+    unresolved = UnresolvedLinks(str(tmp_path / "unresolved.db"))
+    for batch in (htmlPages[::3], htmlPages[1::3], htmlPages[2::3]):
+        updateWebIndex(batch, index, webDir, unresolved=unresolved)
+    assert asSets(index) == asSets(whole)
+
+    # Without the store, links to pages that weren't there yet are lost
+    lossy = {}
+    for batch in (htmlPages[::3], htmlPages[1::3], htmlPages[2::3]):
+        updateWebIndex(batch, lossy, webDir)
+    assert sum(map(len, lossy.values())) < sum(map(len, whole.values()))
+
+def test_dict_index_matches_link_graph(tmp_path, web):
+    webDir, htmlPages = web
+    index = {}
+    unresolved = UnresolvedLinks(str(tmp_path / "unresolved.db"))
+    graph = LinkGraph(str(tmp_path / "graph"))
+    for batch in (htmlPages[:10], htmlPages[10:]):
+        updateWebIndex(batch, index, webDir, unresolved=unresolved)
+        updateWebIndex(batch, graph, webDir)
+    assert asSets(index) == graphAsSets(graph)
+
+    # A removed page's in-links come back with it
+    removed = [htmlPage for htmlPage in htmlPages if htmlPage.endswith(".html")][4]
+    for target in (index, graph):
+        reindexWebPages([], [removed], target, webDir, unresolved=unresolved if target is index else None)
+    assert asSets(index) == graphAsSets(graph)
+    assert len(index) == len(graph) == len(htmlPages) - 1
+
+    whole = {}
+    updateWebIndex(htmlPages, whole, webDir)
+    updateWebIndex([removed], index, webDir, unresolved=unresolved)
+    updateWebIndex([removed], graph, webDir)
+    assert asSets(index) == graphAsSets(graph) == asSets(whole)
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from invertedindex import encodeVarints, decodeVarints, writeInvertedIndex, InvertedIndex
+
+def test_varint_bytes():
+    # LEB128, low 7 bits first
+    assert encodeVarints([0, 1, 127, 128, 300]).tolist() == [0x00, 0x01, 0x7f, 0x80, 0x01, 0xac, 0x02]
+    assert encodeVarints([]).dtype == np.uint8 and len(encodeVarints([])) == 0
+    assert len(decodeVarints(np.zeros(0, dtype=np.uint8))) == 0
+
+@pytest.mark.parametrize("seed", range(3))
+def test_varints_round_trip(seed):
+    rng = np.random.default_rng(seed)
+    edges = [0, 127, 128, 2**14 - 1, 2**14, 2**21, 2**32, 2**63 - 1, 2**64 - 1]
+    values = np.concatenate([np.array(edges, dtype=np.uint64)] + [rng.integers(0, 2**bits, 200, dtype=np.uint64) for bits in (7, 14, 40, 63)])
+    values = rng.permutation(values)
+    data = encodeVarints(values)
+    assert data.dtype == np.uint8
+    assert (decodeVarints(data) == values).all()
+
+def randomPostings(rng, numDocs: int, numTerms: int):
+    postings, positions, expected = {}, {}, {}
+    for t in range(numTerms):
+        docIds = np.sort(rng.choice(numDocs, rng.integers(1, numDocs), replace=False))
+        tfs = rng.integers(0, 4, (len(docIds), 3))
+        tfs[tfs.sum(axis=1) == 0, 2] = 1
+        term = f"term{t}"
+        postings[term] = np.column_stack((docIds, tfs)).ravel().tolist()
+        groups = [np.sort(rng.choice(1000, tf, replace=False)) for tf in tfs.ravel()]
+        positions[term] = np.concatenate(groups).tolist()
+        expected[term] = (docIds, tfs, groups)
+    return postings, positions, expected
+
+def test_inverted_index_round_trip(tmp_path):
+    rng = np.random.default_rng(7)
+    numDocs = 50
+    postings, positions, expected = randomPostings(rng, numDocs, 30)
+    urls = [f"https://en.wikipedia.org/wiki/Page_{i}" for i in range(numDocs)]
+    docLens = rng.integers(1, 500, (numDocs, 3)).astype(np.int32)
+    writeInvertedIndex(str(tmp_path), urls, docLens, postings, positions)
+
+    index = InvertedIndex(str(tmp_path))
+    assert index.urls == urls and index.numDocs == numDocs and index.hasPositions
+    assert (index.docLens == docLens).all()
+    for term, (docIds, tfs, groups) in expected.items():
+        assert index.docFreq(term) == len(docIds)
+        gotIds, gotTfs = index.getPostings(term)
+        assert (gotIds == docIds).all() and (gotTfs == tfs).all()
+
+        _, _, gotPositions, starts = index.getPositions(term)
+        for g, group in enumerate(groups):
+            assert (gotPositions[starts[g]:starts[g+1]] == group).all()
+
+    docIds, tfs = index.getPostings("missing")
+    assert len(docIds) == 0 and tfs.shape == (0, 3)
+    assert index.docFreq("missing") == 0
+
+def test_without_positions(tmp_path):
+    rng = np.random.default_rng(8)
+    postings, positions, _ = randomPostings(rng, 10, 5)
+    writeInvertedIndex(str(tmp_path), [f"u{i}" for i in range(10)], np.ones((10, 3), dtype=np.int32), postings, positions)
+    # Rebuilding without positions drops the stale positions.bin
+    writeInvertedIndex(str(tmp_path), [f"u{i}" for i in range(10)], np.ones((10, 3), dtype=np.int32), postings)
+    index = InvertedIndex(str(tmp_path))
+    assert not index.hasPositions
+    with pytest.raises(ValueError):
+        index.getPositions("term0")
@@ -0,0 +1,100 @@
+import os
+
+import numpy as np
+import linkgraph
+from linkgraph import LinkGraph, loadLinkGraph, mergeExtraLinks, EXTRA_FILE, OFFSETS_FILE, TARGETS_FILE, OFFSET_DTYPE, TARGET_DTYPE
+
+def pageURL(i: int):
+    return f"https://en.wikipedia.org/wiki/Page_{i}"
+
+def randomPages(numPages: int, seed=0):
+    rng = np.random.default_rng(seed)
+    return {pageURL(i): {pageURL(j) for j in rng.integers(0, numPages + 10, 4)} for i in range(numPages)}
+
+def graphLinks(graphDir: str):
+    urls, offsets, targets = loadLinkGraph(graphDir)
+    return {url: {urls[j] for j in targets[offsets[i]:offsets[i+1]]} for i, url in enumerate(urls)}
+
+def expectedLinks(pages: dict):
+    return {url: {link for link in links if link in pages} for url, links in pages.items()}
+
+def test_batches_resolve_links_through_extra(tmp_path):
+    pages = randomPages(120)
+    urls = list(pages.keys())
+    graph = LinkGraph(str(tmp_path))
+    for batch in (urls[:40], urls[40:80], urls[80:]):
+        graph.addPages({url: pages[url] for url in batch})
+
+    # Links to pages from later batches were appended to extra.bin, and are folded into their rows
+    assert 0 < graph.numExtra == os.path.getsize(tmp_path / EXTRA_FILE) // 8
+    assert graphLinks(str(tmp_path)) == expectedLinks(pages)
+    assert len(graph) == len(pages) and urls[5] in graph
+
+    # Reopening reads the same graph
+    assert graphLinks(str(tmp_path)) == expectedLinks(pages)
+    assert LinkGraph(str(tmp_path)).numExtra == graph.numExtra
+
+def test_compaction_folds_extra_into_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr(linkgraph, "COMPACT_RATIO", 0.0)
+    pages = randomPages(60, seed=1)
+    urls = list(pages.keys())
+    graph = LinkGraph(str(tmp_path))
+    graph.addPages({url: pages[url] for url in urls[:30]})
+    graph.addPages({url: pages[url] for url in urls[30:]})
+    assert graph.numExtra == 0
+    assert graphLinks(str(tmp_path)) == expectedLinks(pages)
+
+def test_interrupted_append_is_trimmed(tmp_path):
+    pages = randomPages(20, seed=2)
+    graph = LinkGraph(str(tmp_path))
+    graph.addPages(pages)
+    numLinks = graph.numLinks
+    graph.unresolved.close()
+
+    # Rows written without their urls, and half an extra link
+    with open(tmp_path / TARGETS_FILE, mode='ab') as fp:
+        np.arange(5, dtype=TARGET_DTYPE).tofile(fp)
+    with open(tmp_path / OFFSETS_FILE, mode='ab') as fp:
+        np.array([numLinks + 5], dtype=OFFSET_DTYPE).tofile(fp)
+    with open(tmp_path / EXTRA_FILE, mode='ab') as fp:
+        np.array([3], dtype=TARGET_DTYPE).tofile(fp)
+
+    assert graphLinks(str(tmp_path)) == expectedLinks(pages)
+    graph = LinkGraph(str(tmp_path))
+    assert graph.numLinks == numLinks and graph.numExtra == 0
+    assert os.path.getsize(tmp_path / TARGETS_FILE) == numLinks * np.dtype(TARGET_DTYPE).itemsize
+    assert os.path.getsize(tmp_path / EXTRA_FILE) == 0
+
+def test_merge_extra_links():
+    offsets = np.array([0, 2, 2, 3])
+    targets = np.array([1, 2, 0], dtype=TARGET_DTYPE)
+    extra = np.array([[1, 0], [0, 0], [1, 2], [2, 1]])
+    newOffsets, newTargets = mergeExtraLinks(offsets, targets, extra)
+    # Each row's own links, then its extra links in the order they were found
+    assert newOffsets.tolist() == [0, 3, 5, 7]
+    assert newTargets.tolist() == [1, 2, 0, 0, 2, 0, 1]
+
+def test_replace_and_remove_pages(tmp_path):
+    pages = randomPages(40, seed=3)
+    urls = list(pages.keys())
+    graph = LinkGraph(str(tmp_path))
+    graph.addPages(pages)
+
+    pages[urls[0]] = {urls[1], urls[2]}
+    graph.replacePages({urls[0]: pages[urls[0]]})
+    assert graphLinks(str(tmp_path)) == expectedLinks(pages)
+
+    removed = pages.pop(urls[7])
+    graph.removePages([urls[7]])
+    assert urls[7] not in graph
+    assert graphLinks(str(tmp_path)) == expectedLinks(pages)
+
+    # Links to a removed page come back with it
+    pages[urls[7]] = removed
+    graph.addPages({urls[7]: removed})
+    assert graphLinks(str(tmp_path)) == expectedLinks(pages)
+
+def test_empty_graph(tmp_path):
+    LinkGraph(str(tmp_path))
+    urls, offsets, targets = loadLinkGraph(str(tmp_path))
+    assert urls == [] and offsets.tolist() == [0] and len(targets) == 0
@@ -0,0 +1,14 @@
+from threading import Thread
+
+from metrics import RateMeter, getMetrics
+
+def test_rate_meter():
+    meter = RateMeter("test_events_per_second")
+    threads = [Thread(target=lambda: [meter.mark() for _ in range(1000)]) for _ in range(4)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    rate = meter.mark(2)
+
+    assert meter.count == 4002
+    assert 0 < rate and abs(rate * meter.seconds - 4002) < 0.05 * 4002
+    assert getMetrics()["gauges"]["test_events_per_second"] == rate
@@ -0,0 +1,118 @@
+import os
+import json
+from time import sleep
+from threading import Thread
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+from manifest import Manifest
+import nlp
+from nlp import LemmaCache, newTermFreqPool, updateTermFreqCache
+from synthweb import generateTinyWeb
+
+@pytest.fixture
+def web(tmp_path, lemmatizer):
+    webDir, termFreqDir = tmp_path / "web", tmp_path / "tf"
+    os.makedirs(termFreqDir)
+    htmlPages = generateTinyWeb(str(webDir), 8, seed=2)
+    return str(webDir), str(termFreqDir), htmlPages
+
+@pytest.mark.parametrize("numWorkers", [1, 2])
+def test_bad_page_doesnt_stop_the_batch(web, numWorkers):
+    webDir, termFreqDir, htmlPages = web
+    # Removed after the manifest saw it
+    badPage = htmlPages[3]
+    os.remove(f"{webDir}/{badPage}")
+
+    failures = updateTermFreqCache(htmlPages, webDir, termFreqDir, numWorkers=numWorkers)
+    assert [htmlPage for htmlPage, _ in failures] == [badPage]
+    assert failures[0][1].startswith("FileNotFoundError")
+    assert sorted(os.listdir(termFreqDir)) == sorted(f"{htmlPage[:-5]}.json" for htmlPage in htmlPages if htmlPage != badPage)
+
+def test_failed_pages_are_rescanned(tmp_path, web):
+    webDir, termFreqDir, htmlPages = web
+    manifest = Manifest(str(tmp_path / "manifest.db"))
+    added, _, _ = manifest.scan(webDir)
+    assert set(htmlPages) <= set(added)
+
+    badPage = htmlPages[0]
+    manifest.discard([badPage])
+    manifest.commit()
+    assert len(manifest) == len(added) - 1
+
+    added, modified, removed = manifest.scan(webDir)
+    assert (added, modified, removed) == ([badPage], [], [])
+
+class YieldingOrderedDict(OrderedDict):
+    """
+        Lets another thread run between a lookup and whatever the caller does next with it.
+    """
+    def get(self, key, default=None):
+        value = super().get(key, default)
+        sleep(0)
+        return value
+
+def test_lemma_cache_is_thread_safe(lemmatizer):
+    cache = LemmaCache(maxSize=50)
+    cache.lru = YieldingOrderedDict()
+    # More words than fit, so lookups keep hitting words that are about to be evicted
+    words = [f"Word{i}" for i in range(80)]
+    errors = []
+
+    def lookups(seed):
+        rng = np.random.default_rng(seed)
+        try:
+            for i in rng.integers(0, len(words), 1000):
+                assert cache.get(words[i]) == words[i].lower()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [Thread(target=lookups, args=(seed,)) for seed in range(8)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert errors == []
+
+    stats = cache.stats()
+    assert stats["hits"] + stats["misses"] == 8 * 1000
+    assert stats["cached"] <= 50
+    cache.resize(10)
+    assert cache.stats()["cached"] == 10
+
+def test_worker_lemmas_reach_the_parent(tmp_path, web, monkeypatch):
+    webDir, termFreqDir, htmlPages = web
+    monkeypatch.setattr(nlp, "_lemmaCache", LemmaCache())
+
+    assert updateTermFreqCache(htmlPages, webDir, termFreqDir, numWorkers=2) == []
+    stats = nlp.getLemmaCacheStats()
+    assert 0 < stats["misses"] and 0 < stats["hits"]
+    assert 0 < stats["cached"] <= stats["misses"]
+
+    # The saved table has every word the workers lemmatized
+    tablePath = str(tmp_path / "lemmas.json")
+    nlp.saveLemmaTable(tablePath)
+    with open(tablePath, mode='r') as fp:
+        table = json.load(fp)
+    with open(f"{termFreqDir}/{htmlPages[0][:-5]}.json", mode='r') as fp:
+        pageIndex = json.load(fp)
+    assert set(pageIndex["text-tf"]) <= set(table.values())
+
+def test_pool_kept_across_calls(web, monkeypatch):
+    webDir, termFreqDir, htmlPages = web
+    monkeypatch.setattr(nlp, "_lemmaCache", LemmaCache())
+
+    pool = newTermFreqPool(1)
+    try:
+        updateTermFreqCache(htmlPages[:4], webDir, termFreqDir, pool=pool)
+        first = nlp.drainLemmaCache()
+        # Same pages again, the worker still has their words cached
+        for htmlPage in htmlPages[:4]:
+            os.remove(f"{termFreqDir}/{htmlPage[:-5]}.json")
+        updateTermFreqCache(htmlPages[:4], webDir, termFreqDir, pool=pool)
+        second = nlp.drainLemmaCache()
+    finally:
+        pool.close()
+        pool.join()
+    assert 0 < first["misses"]
+    assert second["misses"] == 0 and second["hits"] == first["hits"] + first["misses"]
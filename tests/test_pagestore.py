@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+from manifest import Manifest
+from pagestore import compressDirectory, getCompression, readPage, writePage, iterPageChunks, COMPRESSIONS
+from synthweb import generateTinyWeb
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+AVAILABLE = [compression for compression in COMPRESSIONS if compression != "zstd" or zstandard is not None]
+
+@pytest.mark.parametrize("compression", AVAILABLE)
+def test_pages_read_back(tmp_path, compression):
+    html = "<html><body>" + "Matrix é " * 20000 + "</body></html>"
+    path = str(tmp_path / "page.html")
+    writePage(path, html.encode('utf-8'), compression)
+    assert getCompression(path) == compression
+    assert readPage(path) == html
+    assert "".join(iterPageChunks(path, 1000)) == html
+
+def test_recompressing_keeps_pages_processed(tmp_path):
+    webDir = str(tmp_path / "web")
+    htmlPages = [htmlPage for htmlPage in generateTinyWeb(webDir, 12, seed=6) if htmlPage.endswith(".html")]
+    before = {htmlPage: (readPage(f"{webDir}/{htmlPage}"), os.stat(f"{webDir}/{htmlPage}").st_mtime_ns) for htmlPage in htmlPages}
+
+    # One stage has processed everything, the other hasn't got to one page yet
+    manifestPaths = [str(tmp_path / "done.db"), str(tmp_path / "behind.db")]
+    for manifestPath in manifestPaths:
+        manifest = Manifest(manifestPath)
+        manifest.scan(webDir)
+        if manifestPath.endswith("behind.db"): manifest.discard([htmlPages[0]])
+        manifest.commit()
+        manifest.close()
+
+    numPages, bytesBefore, bytesAfter = compressDirectory(webDir, "gzip", manifestPaths=manifestPaths + [str(tmp_path / "missing.db")])
+    assert numPages == len(htmlPages)
+    assert bytesAfter < bytesBefore
+    for htmlPage, (html, mtime) in before.items():
+        path = f"{webDir}/{htmlPage}"
+        assert getCompression(path) == "gzip"
+        assert readPage(path) == html
+        assert os.stat(path).st_mtime_ns == mtime
+    assert not os.path.exists(tmp_path / "missing.db")
+
+    done, behind = Manifest(manifestPaths[0]), Manifest(manifestPaths[1])
+    assert done.scan(webDir) == ([], [], [])
+    assert behind.scan(webDir) == ([htmlPages[0]], [], [])
+
+    # And back
+    compressDirectory(webDir, "none", manifestPaths=manifestPaths)
+    assert done.scan(webDir) == ([], [], [])
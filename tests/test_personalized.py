@@ -0,0 +1,76 @@
+import numpy as np
+
+from eigenranking import (buildLinkMatrixFromEdges, powerIteration, personalizationMatrix, blockPowerIteration,
+                          determinePersonalizedRankings, savePersonalizedRankings, loadPersonalizedRankings)
+from linkgraph import LinkGraph
+
+def pageURL(i: int):
+    return f"https://en.wikipedia.org/wiki/Page_{i}"
+
+def randomGraph(numPages, numLinks, seed=0):
+    rng = np.random.default_rng(seed)
+    sources = rng.integers(0, numPages, numLinks)
+    targets = rng.integers(0, numPages, numLinks)
+    # Leave some pages without out-links so dangling mass is exercised
+    keep = 10 <= sources
+    return sources[keep], targets[keep]
+
+def solveDense(matSparse, dangling, p, damping=0.85):
+    # v = d*M v + (d*(dangling . v) + 1 - d) p, with sum(v) = 1
+    numPages = len(p)
+    A = np.eye(numPages) - damping * matSparse.toarray() - damping * np.outer(p, dangling.astype(np.float64))
+    v = np.linalg.solve(A, (1.0 - damping) * p)
+    return v / v.sum()
+
+def test_block_matches_separate_solves():
+    numPages = 300
+    sources, targets = randomGraph(numPages, 2000)
+    matSparse, dangling = buildLinkMatrixFromEdges(sources, targets, numPages)
+    urls = [pageURL(i) for i in range(numPages)]
+    seedSets = {
+        "one": [urls[3]],
+        "few": urls[50:60],
+        "weighted": {urls[100]: 3.0, urls[200]: 1.0},
+        "dangling": urls[:5],
+        "missing": ["https://en.wikipedia.org/wiki/Not_in_the_index"],
+    }
+    names, P = personalizationMatrix(urls, seedSets)
+    assert names == ["one", "few", "weighted", "dangling"]
+    assert np.allclose(P.sum(axis=0), 1.0)
+
+    V, _, residuals = blockPowerIteration(matSparse, dangling, P, epsilon=1e-12, verbose=False)
+    assert (residuals <= 1e-12).all()
+    for j in range(len(names)):
+        assert np.abs(V[:, j] - solveDense(matSparse, dangling, P[:, j])).sum() < 1e-9
+        # Solving a column on its own gives the same vector
+        single, _, _ = blockPowerIteration(matSparse, dangling, P[:, j:j+1], epsilon=1e-12, verbose=False)
+        assert np.abs(V[:, j] - single[:, 0]).sum() < 1e-9
+
+    # A uniform personalization is the plain PageRank
+    uniform, _, _ = blockPowerIteration(matSparse, dangling, np.full((numPages, 1), 1.0 / numPages), epsilon=1e-12, verbose=False)
+    v, _, _ = powerIteration(matSparse, dangling, epsilon=1e-12, verbose=False)
+    assert np.abs(uniform[:, 0] - v).sum() < 1e-9
+
+def test_determine_save_load(tmp_path):
+    numPages = 100
+    sources, targets = randomGraph(numPages, 600, seed=1)
+    graphDir = str(tmp_path / "linkgraph")
+    pages = {pageURL(i): set() for i in range(numPages)}
+    for source, target in zip(sources, targets):
+        pages[pageURL(source)].add(pageURL(target))
+    LinkGraph(graphDir).addPages(pages)
+
+    seedSets = {"a": [pageURL(1), pageURL(2)], "b": [pageURL(90)]}
+    names, urls, V = determinePersonalizedRankings(graphDir, seedSets, epsilon=1e-10)
+    assert names == ["a", "b"] and sorted(urls) == sorted(pages)
+    assert V.shape == (numPages, 2) and np.allclose(V.sum(axis=0), 1.0)
+    # Each ranking favours its own seeds
+    assert V[urls.index(pageURL(90)), 1] > V[urls.index(pageURL(90)), 0]
+
+    outDir = str(tmp_path / "personalized")
+    assert loadPersonalizedRankings(outDir) is None
+    savePersonalizedRankings(outDir, names, urls, V)
+    loadedNames, loadedURLs, ranks = loadPersonalizedRankings(outDir)
+    assert loadedNames == names and loadedURLs == urls
+    assert ranks.shape == (2, numPages) and ranks.dtype == np.float32
+    assert np.allclose(ranks, V.T, atol=1e-7)
@@ -0,0 +1,137 @@
+import os
+from json import dumps as json_dumps
+from threading import Event, Thread
+
+import pytest
+
+from manifest import bumpGeneration, readGeneration
+from querycache import QueryCache
+
+def test_lru_evicts_the_least_recently_used():
+    cache = QueryCache(maxSize=2, ttl=None, checkInterval=1e9)
+    cache.put("a", [1])
+    cache.put("b", [2])
+    assert cache.get("a") == [1]
+    cache.put("c", [3])
+    assert cache.get("b") is None
+    assert cache.get("a") == [1] and cache.get("c") == [3]
+    assert cache.stats()["evictions"] == 1
+
+def test_entries_expire(monkeypatch):
+    import querycache
+
+    now = [100.0]
+    monkeypatch.setattr(querycache, "monotonic", lambda: now[0])
+    cache = QueryCache(ttl=10.0, checkInterval=1e9)
+    cache.put("a", [1])
+    now[0] = 105.0
+    assert cache.get("a") == [1]
+    now[0] = 111.0
+    assert cache.get("a") is None
+    assert cache.stats()["expired"] == 1
+
+def test_new_generation_clears(generationPath):
+    cache = QueryCache(ttl=None, generationPath=generationPath, checkInterval=0.0)
+    cache.put("a", [1])
+    assert cache.get("a") == [1]
+    bumpGeneration()
+    assert cache.get("a") is None
+    assert cache.stats()["generation"] == readGeneration() == 1
+
+def test_put_after_a_clear_is_dropped():
+    cache = QueryCache(ttl=None, checkInterval=1e9)
+    assert cache.get("a") is None
+    epoch = cache.epoch
+    cache.clear()
+    cache.put("a", ["old generation"], epoch)
+    assert cache.get("a") is None
+    assert cache.stats()["stalePuts"] == 1
+
+    cache.put("a", ["new generation"], cache.epoch)
+    assert cache.get("a") == ["new generation"]
+
+def test_put_after_a_new_generation_is_dropped(generationPath):
+    cache = QueryCache(ttl=None, generationPath=generationPath, checkInterval=0.0)
+    assert cache.get("a") is None
+    epoch = cache.epoch
+    bumpGeneration()
+    assert cache.get("b") is None
+    cache.put("a", ["old generation"], epoch)
+    assert cache.get("a") is None
+
+## ====== ##
+## Search ##
+## ====== ##
+
+def writeGeneration(termFreqDir, invertedDir, pages: dict):
+    from invertedindex import buildInvertedIndex
+
+    os.makedirs(termFreqDir, exist_ok=True)
+    for i, (url, text) in enumerate(pages.items()):
+        textTF = {}
+        for word in text.split():
+            textTF[word] = textTF.get(word, 0) + 1
+        record = {"url": url, "title-tf": {}, "header-tf": {}, "text-tf": textTF, "numTitleLemmas": 0, "numHeaderLemmas": 0, "numTextLemmas": sum(textTF.values())}
+        with open(f"{termFreqDir}/page{i}.json", mode='w') as fp:
+            fp.write(json_dumps(record))
+    buildInvertedIndex(str(termFreqDir), str(invertedDir))
+
+@pytest.fixture
+def generations(tmp_path, lemmatizer):
+    writeGeneration(tmp_path / "tf1", tmp_path / "gen-1", {"https://a.org/old": "matrix eigenvector"})
+    writeGeneration(tmp_path / "tf2", tmp_path / "gen-2", {"https://a.org/new": "matrix eigenvector", "https://a.org/other": "spider"})
+    return str(tmp_path / "gen-1"), str(tmp_path / "gen-2")
+
+def test_search_caches_per_generation(generations):
+    from search import SearchEngine
+
+    cache = QueryCache(ttl=None, checkInterval=1e9)
+    old, new = (SearchEngine(path, cache=cache) for path in generations)
+    assert [url for _, url in old.search("Matrix")] == ["https://a.org/old"]
+    assert cache.stats()["cached"] == 1
+
+    # Without a clear in between, the new generation still doesn't see the old one's results
+    assert [url for _, url in new.search("matrix")] == ["https://a.org/new"]
+    assert [url for _, url in old.search("matrix")] == ["https://a.org/old"]
+    assert cache.stats()["hits"] == 1
+
+def test_query_running_over_a_swap_isnt_cached(generations, monkeypatch):
+    from search import SearchEngine
+
+    cache = QueryCache(ttl=None, checkInterval=1e9)
+    old = SearchEngine(generations[0], cache=cache)
+
+    # The old generation's query is still running when the server swaps in the new one and clears
+    started, swapped = Event(), Event()
+    searchTerms = old.searchTerms
+    def slowSearchTerms(*args):
+        started.set()
+        swapped.wait(5.0)
+        return searchTerms(*args)
+    monkeypatch.setattr(old, "searchTerms", slowSearchTerms)
+
+    query = Thread(target=old.search, args=("matrix",))
+    query.start()
+    started.wait(5.0)
+    cache.clear()
+    swapped.set()
+    query.join()
+
+    assert cache.stats()["cached"] == 0
+    assert cache.stats()["stalePuts"] == 1
+
+def test_pipeline_bumps_the_generation(tmp_path, lemmatizer, generationPath):
+    from synthweb import generateTinyWeb
+    from pipeline import updatePageCaches
+
+    webDir, termFreqDir = tmp_path / "web", tmp_path / "tf"
+    os.makedirs(termFreqDir)
+    htmlPages = generateTinyWeb(str(webDir), 6, seed=1)
+    index = {}
+    updatePageCaches(htmlPages, str(webDir), str(termFreqDir), index)
+    assert len(index) == 6
+    assert readGeneration() == 1
+
+    # Nothing new, nothing to invalidate
+    updatePageCaches(htmlPages, str(webDir), str(termFreqDir), index)
+    assert readGeneration() == 1
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from invertedindex import writeInvertedIndex, BLOCK_SIZE, BLOCKS_FILE
+from search import SearchEngine, DOCRANKS_FILE
+
+def skewedIndex(invertedDir: str, rng, numDocs: int, numTerms: int, ranks=None):
+    """
+        Terms from in nearly every doc down to a handful, with bursty tfs, and random doc ranks (unless given).
+    """
+    postings = {}
+    for t in range(numTerms):
+        docFreq = max(1, int(numDocs * 0.9 / (t + 1)))
+        docIds = np.sort(rng.choice(numDocs, docFreq, replace=False))
+        tfs = rng.geometric(0.6, (docFreq, 3)) - 1
+        tfs[tfs.sum(axis=1) == 0, 2] = 1
+        postings[f"term{t}"] = np.column_stack((docIds, tfs)).ravel().tolist()
+    docLens = rng.integers(0, 400, (numDocs, 3)).astype(np.int32)
+    writeInvertedIndex(invertedDir, [f"u{i}" for i in range(numDocs)], docLens, postings)
+    np.save(f"{invertedDir}/{DOCRANKS_FILE}", rng.random(numDocs) if ranks is None else ranks)
+
+def exhaustive(engine: SearchEngine, *args, **kwargs):
+    engine.index.hasBlocks = False
+    try:
+        return engine.searchTerms(*args, **kwargs)
+    finally:
+        engine.index.hasBlocks = True
+
+def test_block_postings_decode(tmp_path):
+    rng = np.random.default_rng(3)
+    skewedIndex(str(tmp_path), rng, 2000, 5)
+    index = SearchEngine(str(tmp_path)).index
+    assert index.hasBlocks
+    for term in index.lexicon:
+        docIds, tfs = index.getPostings(term)
+        blocks = index.getBlocks(term)
+        assert len(blocks) == -(-len(docIds) // BLOCK_SIZE)
+        blockIds = np.flatnonzero(rng.random(len(blocks)) < 0.5)
+        gotIds, gotTfs = index.getBlockPostings(term, blocks, blockIds)
+        keep = np.isin(np.arange(len(docIds)) // BLOCK_SIZE, blockIds)
+        assert (gotIds == docIds[keep]).all() and (gotTfs == tfs[keep]).all()
+
+@pytest.mark.parametrize("seed", range(3))
+def test_block_max_matches_exhaustive(tmp_path, seed):
+    rng = np.random.default_rng(seed)
+    skewedIndex(str(tmp_path), rng, 5000, 40)
+    for rankWeight in (0.0, 0.5, 5.0):
+        engine = SearchEngine(str(tmp_path), rankWeight=rankWeight)
+        for _ in range(30):
+            terms = [f"term{t}" for t in rng.choice(45, rng.integers(1, 4), replace=False)]
+            topK = int(rng.choice([1, 10, 100]))
+            results = engine.searchTerms(terms, topK)
+            expected = exhaustive(engine, terms, topK)
+            assert [url for _, url in results] == [url for _, url in expected]
+            assert [score for score, _ in results] == pytest.approx([score for score, _ in expected])
+
+def test_head_term_stops_early(tmp_path, monkeypatch):
+    # Heavy tailed ranks, like a link graph's, a few docs stand out
+    rng = np.random.default_rng(5)
+    ranks = rng.pareto(1.2, 20000)
+    skewedIndex(str(tmp_path), rng, 20000, 2, ranks / ranks.sum())
+    engine = SearchEngine(str(tmp_path))
+    decoded = []
+    getBlockPostings = engine.index.getBlockPostings
+    def countingGetBlockPostings(term, blocks, blockIds):
+        decoded.append(len(blockIds))
+        return getBlockPostings(term, blocks, blockIds)
+    monkeypatch.setattr(engine.index, "getBlockPostings", countingGetBlockPostings)
+
+    assert engine.searchTerms(["term0"], 10) == exhaustive(engine, ["term0"], 10)
+    assert sum(decoded) < len(engine.index.getBlocks("term0")) / 2
+
+def test_index_without_blocks(tmp_path):
+    # An index written before blocks.bin still searches, by scoring every posting
+    rng = np.random.default_rng(7)
+    skewedIndex(str(tmp_path), rng, 3000, 10)
+    expected = SearchEngine(str(tmp_path)).searchTerms(["term0", "term3"], 10)
+    (tmp_path / BLOCKS_FILE).unlink()
+    engine = SearchEngine(str(tmp_path))
+    assert not engine.index.hasBlocks
+    assert [url for _, url in engine.searchTerms(["term0", "term3"], 10)] == [url for _, url in expected]
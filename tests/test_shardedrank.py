@@ -0,0 +1,86 @@
+import os
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import pytest
+
+import shardedrank
+from eigenranking import loadLinkMatrix, collapseDuplicates, powerIteration
+from linkgraph import LinkGraph, EXTRA_FILE
+from shardedrank import writeShards, writeShardsFromLinkGraph, loadShardedMatrix, loadShardURLs, shardedPowerIteration
+
+def pageURL(i: int):
+    return f"https://en.wikipedia.org/wiki/Page_{i}"
+
+@pytest.fixture
+def graphDir(tmp_path):
+    rng = np.random.default_rng(4)
+    numPages = 200
+    pages = {pageURL(i): [pageURL(j) for j in rng.integers(0, numPages, 3)] for i in range(numPages)}
+    # A page linking to itself, one with no links and one linking to the same page twice
+    pages[pageURL(5)] = [pageURL(5), pageURL(6)]
+    pages[pageURL(7)] = []
+    pages[pageURL(8)] = [pageURL(9), pageURL(9)]
+
+    # The first half link to pages of the second half before they exist, those links end up in extra.bin
+    graph = LinkGraph(str(tmp_path / "graph"))
+    urls = list(pages.keys())
+    graph.addPages({url: pages[url] for url in urls[:numPages // 2]})
+    graph.addPages({url: pages[url] for url in urls[numPages // 2:]})
+    assert 0 < os.path.getsize(tmp_path / "graph" / EXTRA_FILE)
+    return str(tmp_path / "graph")
+
+@pytest.mark.parametrize("canonical", [{}, {pageURL(11): pageURL(12), pageURL(150): pageURL(3)}])
+def test_streamed_shards_match_the_link_matrix(tmp_path, graphDir, canonical):
+    matSparse, dangling, urls = loadLinkMatrix(graphDir)
+    if canonical:
+        matSparse, dangling, urls = collapseDuplicates(matSparse, dangling, urls, canonical)
+
+    # Chunks much smaller than the graph, so links are streamed over many chunks
+    shardDir = str(tmp_path / "shards")
+    shardURLs, shardDangling = writeShardsFromLinkGraph(graphDir, shardDir, 3, canonical, chunkLinks=16)
+    shardMat, metaDangling = loadShardedMatrix(shardDir)
+
+    assert shardURLs == urls == loadShardURLs(shardDir)
+    assert (shardDangling == dangling).all() and (metaDangling == dangling).all()
+    assert shardMat.shape == matSparse.shape
+    assert abs(shardMat - matSparse).max() < 1e-15
+
+def test_sharded_power_iteration(tmp_path, graphDir):
+    matSparse, dangling, urls = loadLinkMatrix(graphDir)
+    truth, _, _ = powerIteration(matSparse, dangling, epsilon=1e-12, verbose=False)
+
+    shardDir = str(tmp_path / "shards")
+    writeShards(matSparse, dangling, shardDir, 4, urls)
+    assert loadShardURLs(shardDir) == urls
+    v, n, _ = shardedPowerIteration(shardDir, numWorkers=2, epsilon=1e-12, verbose=False)
+    assert 0 < n
+    assert np.abs(v - truth).sum() < 1e-10
+
+def test_worker_keeps_few_shards_open(tmp_path, graphDir, monkeypatch):
+    matSparse, dangling, urls = loadLinkMatrix(graphDir)
+    shardDir = str(tmp_path / "shards")
+    numShards = 6
+    writeShards(matSparse, dangling, shardDir, numShards, urls)
+    meta = np.load(f"{shardDir}/meta.npz")
+
+    monkeypatch.setattr(shardedrank, "MAX_OPEN_SHARDS", 2)
+    numPages = len(urls)
+    vShm, outShm = SharedMemory(create=True, size=numPages * 8), SharedMemory(create=True, size=numPages * 8)
+    try:
+        shardedrank._initWorker(shardDir, numPages, meta["rowStarts"], vShm.name, outShm.name)
+        v = np.random.default_rng(0).random(numPages)
+        shardedrank._worker["v"][:] = v
+        for _ in range(3):
+            for k in range(numShards):
+                shardedrank._multiplyShard(k)
+                assert len(shardedrank._worker["shards"]) <= 2
+        assert np.allclose(shardedrank._worker["out"], matSparse @ v)
+    finally:
+        for name in ("v", "out", "shards"):
+            shardedrank._worker.pop(name, None)
+        for shm in (shardedrank._worker.pop("vShm"), shardedrank._worker.pop("outShm")):
+            shm.close()
+        for shm in (vShm, outShm):
+            shm.close()
+            shm.unlink()
@@ -0,0 +1,62 @@
+import os
+
+from dedup import DedupStore
+from fetcher import FetchResult
+from htmlparse import Host
+from spider import crawlPage, getLocalPath, webpageBFS
+from metrics import getMetrics
+
+PAGE = b"<html><head><title>Matrix</title></head><body><a href=\"/wiki/Eigenvalue\">Eigenvalue</a></body></html>"
+
+class StandInFetcher:
+    """
+        Serves the same bytes for every url, and counts the requests.
+    """
+    def __init__(self, body: bytes):
+        self.body = body
+        self.requested = []
+
+    def fetch(self, url: str, revalidate=False):
+        self.requested.append(url)
+        return FetchResult(200, self.body, url)
+
+def test_duplicates_are_recorded_and_skipped_later(tmp_path):
+    webDir = str(tmp_path / "web")
+    os.makedirs(webDir)
+    dedupPath = str(tmp_path / "dedup.db")
+    original, mirror = "https://en.wikipedia.org/wiki/Matrix_(mathematics)", "https://en.wikipedia.org/wiki/Matrices"
+
+    fetcher = StandInFetcher(PAGE)
+    dedup = DedupStore(dedupPath)
+    assert crawlPage(original, Host.WP, webDir, fetcher, dedup) == {"https://en.wikipedia.org/wiki/Eigenvalue"}
+    assert crawlPage(mirror, Host.WP, webDir, fetcher, dedup) == set()
+    assert not os.path.exists(getLocalPath(mirror, Host.WP, webDir))
+    dedup.close()
+
+    # A later crawl doesn't request the duplicate again
+    fetcher = StandInFetcher(PAGE)
+    dedup = DedupStore(dedupPath)
+    assert dedup.getCanonical(mirror) == original
+    assert dedup.getCanonical(original) is None
+    assert crawlPage(mirror, Host.WP, webDir, fetcher, dedup) == set()
+    assert crawlPage(original, Host.WP, webDir, fetcher, dedup) == {"https://en.wikipedia.org/wiki/Eigenvalue"}
+    assert fetcher.requested == []
+    dedup.close()
+
+class LinkedFetcher:
+    """
+        Serves a chain of pages, each linking to the next.
+    """
+    def __init__(self, numPages: int):
+        self.numPages = numPages
+
+    def fetch(self, url: str, revalidate=False):
+        i = int(url.rsplit("_", 1)[1])
+        body = f"<html><head><title>Page {i}</title></head><body><a href=\"/wiki/Page_{i+1}\">Next</a></body></html>".encode()
+        return FetchResult(200, body, url) if i < self.numPages else FetchResult(404, None, url)
+
+def test_crawl_throughput_gauge(tmp_path):
+    seeds = [("https://en.wikipedia.org/wiki/Page_0", Host.WP)]
+    numCrawled = webpageBFS(seeds, str(tmp_path / "web"), numWorkers=2, rate=1e9, fetcher=LinkedFetcher(20))
+    assert numCrawled == 20
+    assert 0 < getMetrics()["gauges"]["crawl_pages_per_second"]
@@ -0,0 +1,86 @@
+import json
+
+import numpy as np
+
+from tfstore import TermFreqStore, FIELDS, FIELD_LENGTHS, FIELD_POSITIONS
+from invertedindex import buildInvertedIndex, buildInvertedIndexFromStore, InvertedIndex
+
+def randomPage(rng, i: int, positions=True):
+    pageIndex = {"url": f"https://en.wikipedia.org/wiki/Page_{i}"}
+    for field, lengthKey, posField in zip(FIELDS, FIELD_LENGTHS, FIELD_POSITIONS):
+        terms = [f"term{t}" for t in rng.choice(40, rng.integers(0, 8), replace=False)]
+        counts = rng.integers(1, 4, len(terms)).tolist()
+        pageIndex[field] = dict(zip(terms, counts))
+        pageIndex[lengthKey] = sum(counts) + int(rng.integers(0, 5))
+        if positions:
+            places = rng.permutation(pageIndex[lengthKey])[:sum(counts)]
+            splits = np.split(places, np.cumsum(counts)[:-1]) if terms else []
+            pageIndex[posField] = {term: sorted(p.tolist()) for term, p in zip(terms, splits)}
+    return pageIndex
+
+def test_add_get_remove_reopen(tmp_path):
+    rng = np.random.default_rng(0)
+    pages = [randomPage(rng, i, positions=i % 2 == 0) for i in range(30)]
+    # Small segments so the pages are spread over several files
+    store = TermFreqStore(str(tmp_path), segmentBytes=512)
+    for pageIndex in pages:
+        store.add(pageIndex)
+    assert 1 < len({segment for segment, _, _ in store.docs.values()})
+    for pageIndex in pages:
+        assert store.get(pageIndex["url"]) == pageIndex
+
+    # Replacing and removing write new doc entries, the last one wins
+    pages[3] = randomPage(rng, 3)
+    store.add(pages[3])
+    store.remove(pages[4]["url"])
+    store.remove("https://en.wikipedia.org/wiki/Missing")
+    store.flush()
+
+    store = TermFreqStore(str(tmp_path), segmentBytes=512)
+    expected = {pageIndex["url"]: pageIndex for i, pageIndex in enumerate(pages) if i != 4}
+    assert len(store) == len(expected) and pages[4]["url"] not in store
+    assert store.get(pages[4]["url"]) is None
+    for url, pageIndex in expected.items():
+        assert store.get(url) == pageIndex
+    assert {url for url, _, _ in store.scan()} == set(expected)
+
+    # Appending after reopening continues the newest segment
+    pages.append(randomPage(rng, 30))
+    store.add(pages[-1])
+    store.flush()
+    assert TermFreqStore(str(tmp_path)).get(pages[-1]["url"]) == pages[-1]
+
+def test_unflushed_pages_are_not_saved(tmp_path):
+    rng = np.random.default_rng(1)
+    store = TermFreqStore(str(tmp_path))
+    store.add(randomPage(rng, 0))
+    store.flush()
+    store.add(randomPage(rng, 1))
+    assert len(TermFreqStore(str(tmp_path))) == 1
+
+def test_inverted_index_from_store(tmp_path):
+    rng = np.random.default_rng(2)
+    pages = [randomPage(rng, i) for i in range(40)]
+    store = TermFreqStore(str(tmp_path / "store"), segmentBytes=1024)
+    jsonDir = tmp_path / "term-freq"
+    jsonDir.mkdir()
+    for i, pageIndex in enumerate(pages):
+        store.add(pageIndex)
+        with open(jsonDir / f"page_{i:03}.json", mode='w') as fp:
+            json.dump(pageIndex, fp)
+    store.flush()
+
+    skipURLs = {pages[5]["url"]}
+    assert buildInvertedIndex(str(jsonDir), str(tmp_path / "from-json"), skipURLs) == len(pages) - 1
+    assert buildInvertedIndexFromStore(str(tmp_path / "store"), str(tmp_path / "from-store"), skipURLs) == len(pages) - 1
+
+    fromJson = InvertedIndex(str(tmp_path / "from-json"))
+    fromStore = InvertedIndex(str(tmp_path / "from-store"))
+    assert fromJson.urls == fromStore.urls
+    assert (fromJson.docLens == fromStore.docLens).all()
+    assert fromJson.hasPositions and fromStore.hasPositions
+    for term in (f"term{t}" for t in range(40)):
+        jsonIds, jsonTfs = fromJson.getPostings(term)
+        storeIds, storeTfs = fromStore.getPostings(term)
+        assert (jsonIds == storeIds).all() and (jsonTfs == storeTfs).all()
+        assert all((a == b).all() for a, b in zip(fromJson.getPositions(term), fromStore.getPositions(term)))